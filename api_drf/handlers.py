@@ -0,0 +1,38 @@
+"""
+WSGI handler that runs a lighter middleware chain for API requests.
+
+The JSON API authenticates with JWT and never uses sessions, CSRF cookies or
+flash messages, so requests under ``API_PATH_PREFIXES`` go through
+``API_MIDDLEWARE``. Everything else (the admin in particular) keeps the full
+``MIDDLEWARE`` chain. Both chains are built once at startup.
+"""
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.handlers.base import BaseHandler
+from django.core.handlers.wsgi import WSGIHandler
+
+
+@contextmanager
+def middleware_setting(middleware):
+    # load_middleware() reads settings.MIDDLEWARE; only swapped at startup
+    original = settings.MIDDLEWARE
+    settings.MIDDLEWARE = middleware
+    try:
+        yield
+    finally:
+        settings.MIDDLEWARE = original
+
+
+class PathScopedWSGIHandler(WSGIHandler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.api_prefixes = tuple(getattr(settings, 'API_PATH_PREFIXES', ()))
+        self.api_handler = BaseHandler()
+        with middleware_setting(getattr(settings, 'API_MIDDLEWARE', settings.MIDDLEWARE)):
+            self.api_handler.load_middleware()
+
+    def get_response(self, request):
+        if self.api_prefixes and request.path_info.startswith(self.api_prefixes):
+            return self.api_handler.get_response(request)
+        return super().get_response(request)
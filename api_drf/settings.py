@@ -50,6 +50,13 @@ EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER', '')
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD', '')
 DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', 'noreply@example.com')
 
+# SMTP connections kept open per process for OTP bursts (see customer/mail.py)
+EMAIL_POOL = {
+    'SIZE': int(os.getenv('EMAIL_POOL_SIZE', 4)),
+    'IDLE_TIMEOUT': 30.0,
+    'RETRIES': 1,
+}
+
 INSTALLED_APPS = [
     'django.contrib.admin',
     'django.contrib.auth',
@@ -65,6 +72,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'customer.metrics.MetricsMiddleware',
+    'customer.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -74,6 +83,16 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Minimal chain for the JWT-authenticated JSON API (see api_drf/handlers.py);
+# sessions, CSRF, auth and messages middleware only run for other paths.
+API_PATH_PREFIXES = ('/api/', '/metrics')
+API_MIDDLEWARE = [
+    'customer.metrics.MetricsMiddleware',
+    'customer.profiling.ProfilingMiddleware',
+    'django.middleware.security.SecurityMiddleware',
+    'django.middleware.common.CommonMiddleware',
+]
+
 ROOT_URLCONF = 'api_drf.urls'
 
 TEMPLATES = [
@@ -167,6 +186,10 @@ AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
 ]
 
+# User.email is unique through the Lower(email) constraint, which the check
+# doesn't recognise; get_by_natural_key() matches emails the same way
+SILENCED_SYSTEM_CHECKS = ['auth.E003']
+
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
@@ -174,12 +197,13 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
-        'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.BasicAuthentication',
+        'customer.authentication.JWTAuthentication',
+        'customer.authentication.ApiKeyAuthentication',
+        'customer.authentication.CachedBasicAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
-        'rest_framework.permissions.IsAuthenticated',
+        # Also denies API keys on views that don't check their scopes
+        'customer.permissions.IsAuthenticated',
     ],
 }
 
@@ -191,5 +215,96 @@ SIMPLE_JWT = {
     'UPDATE_LAST_LOGIN': True,
 }
 
+# Successful HTTP Basic verifications are cached per process (customer.authentication)
+BASIC_AUTH_CACHE = {
+    'TTL': 300,
+    'MAX_ENTRIES': 10000,
+}
+
+# Resolved API keys are cached per process (customer.authentication)
+API_KEY_CACHE = {
+    'TTL': 60,
+    'MAX_ENTRIES': 10000,
+}
+
+# Above this many rows the admin shows the planner estimate instead of COUNT(*)
+ADMIN_ESTIMATED_COUNT_THRESHOLD = 100000
+
 # Disable automatic slash appending
 APPEND_SLASH = False
+
+# Audit log for staff management actions (see customer/audit.py)
+AUDIT_LOG = {
+    'SINK': os.getenv('AUDIT_LOG_SINK', 'database'),
+    'BUFFER_SIZE': 10000,
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 1.0,
+    'DIRECTORY': os.path.join(BASE_DIR, 'audit'),
+}
+
+# Webhook endpoints for user lifecycle events (see customer/webhooks.py)
+WEBHOOKS = {
+    'ENDPOINTS': [
+        {'url': url.strip(), 'events': ['*'], 'secret': os.getenv('WEBHOOK_SECRET', '')}
+        for url in os.getenv('WEBHOOK_URLS', '').split(',') if url.strip()
+    ],
+    'BATCH_SIZE': 100,
+    'CONCURRENCY': 4,
+}
+
+# Sampled request profiling (see customer/profiling.py); off unless enabled
+PROFILING = {
+    'ENABLED': os.getenv('PROFILING_ENABLED', '') == '1',
+    'MODE': os.getenv('PROFILING_MODE', 'sampling'),
+    'SAMPLE_RATE': float(os.getenv('PROFILING_SAMPLE_RATE', '0')),
+    'DIRECTORY': os.path.join(BASE_DIR, 'profiles'),
+    'MAX_FILES': 200,
+}
+
+# Request, auth and email metrics served on /metrics (see customer/metrics.py).
+# Prefork servers need METRICS_DIR so /metrics sums every worker.
+METRICS = {
+    'ENABLED': True,
+    'MULTIPROCESS_DIR': os.getenv('METRICS_DIR') or None,
+    'SNAPSHOT_INTERVAL': 5.0,
+    'ALLOWED_IPS': ['127.0.0.1', '::1'],
+}
+
+# Idempotency-Key replay for retried registrations and OTP requests
+# (see customer/idempotency.py). Stored responses must be seen by every worker,
+# so it uses the shared cache directly; in-flight claims are database rows.
+IDEMPOTENCY = {
+    'CACHE': 'shared',
+    'TTL': 24 * 60 * 60,
+    'WAIT': 10.0,
+}
+
+# Per-role password hashing policy written by `manage.py tune_hashers`
+# (see customer/hashing.py); without the file Django's default hasher is used
+PASSWORD_POLICY = {
+    'POLICY_FILE': os.getenv('PASSWORD_POLICY_FILE', os.path.join(BASE_DIR, 'password_policy.json')),
+    'TARGETS': {'default': 0.25, 'admin': 0.5, 'manager': 0.25, 'cashier': 0.05},
+    'AUTO_TUNE': False,
+}
+
+# App caches: 'default' is a per-process LRU in front of 'shared', which every
+# worker sees (see customer/cache_backends.py). Use Redis in production; the
+# file cache only spans the workers of one host.
+CACHES = {
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('REDIS_URL'),
+    } if os.getenv('REDIS_URL') else {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('CACHE_DIR', os.path.join(BASE_DIR, 'cache')),
+    },
+    'default': {
+        'BACKEND': 'customer.cache_backends.TieredCache',
+        'LOCATION': 'shared',
+        'OPTIONS': {
+            'LOCAL_MAX_ENTRIES': 1000,
+            'LOCAL_TTL': 5,
+            'GENERATION_TTL': 1,
+        },
+    },
+}
@@ -1,6 +1,7 @@
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from customer.views_metrics import metrics_view
 
 urlpatterns = [
     # Admin site
@@ -12,6 +13,9 @@ urlpatterns = [
     # JWT Token endpoints
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    
+    # Prometheus metrics
+    path('metrics', metrics_view, name='metrics'),
 ]
 
 # Add this if you want to enable browsable API in development
@@ -1,5 +1,10 @@
 import os
-from django.core.wsgi import get_wsgi_application
+
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api_drf.settings')
-application = get_wsgi_application()
+django.setup(set_prefix=False)
+
+from api_drf.handlers import PathScopedWSGIHandler  # noqa: E402
+
+application = PathScopedWSGIHandler()
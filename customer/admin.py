@@ -1,7 +1,12 @@
+from django.conf import settings
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
-from .models import User, UserRole
+from .models import AuditEvent, User, UserRole
 
 class UserCreationForm(UserCreationForm):
     class Meta(UserCreationForm.Meta):
@@ -13,16 +18,51 @@ class UserChangeForm(UserChangeForm):
         model = User
         fields = '__all__'
 
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that uses the Postgres planner's row estimate for unfiltered
+    changelists on large tables instead of an exact COUNT(*).
+    """
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if isinstance(queryset, QuerySet) and not queryset.query.where:
+            estimate = self.estimate_rows(queryset)
+            if estimate >= getattr(settings, 'ADMIN_ESTIMATED_COUNT_THRESHOLD', 100000):
+                return estimate
+        return super().count
+    
+    @staticmethod
+    def estimate_rows(queryset):
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return 0
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                [queryset.model._meta.db_table],
+            )
+            row = cursor.fetchone()
+        return row[0] if row else 0
+
 @admin.register(User)
 class UserAdmin(BaseUserAdmin):
     form = UserChangeForm
     add_form = UserCreationForm
     
-    list_display = ('email', 'name', 'user_type', 'is_active', 'is_staff', 'created_at')
+    list_display = ('email', 'name', 'user_type', 'role', 'is_active', 'is_staff', 'created_at')
     list_filter = ('is_active', 'is_staff', 'user_type', 'created_at')
+    list_select_related = ('role',)
     search_fields = ('email', 'name')
     ordering = ('-created_at',)
     
+    # Keep the changelist and change form cheap on large user tables
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    show_facets = admin.ShowFacets.NEVER
+    raw_id_fields = ('created_by',)
+    autocomplete_fields = ('role',)
+    
     fieldsets = (
         (None, {'fields': ('email', 'password')}),
         ('Personal Info', {'fields': ('name', 'phone_number', 'address')}),
@@ -55,3 +95,19 @@ class UserRoleAdmin(admin.ModelAdmin):
     list_display = ('role', 'description')
     search_fields = ('role', 'description')
     ordering = ('role',)
+
+@admin.register(AuditEvent)
+class AuditEventAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'action', 'actor_id', 'target_type', 'target_id')
+    list_filter = ('action',)
+    search_fields = ('=actor_id', '=target_id')
+    date_hierarchy = 'created_at'
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
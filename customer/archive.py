@@ -0,0 +1,151 @@
+"""
+Hot/cold split of the customer table.
+
+Dormant customers (inactive, or no login for ``ARCHIVE_INACTIVE_DAYS``) are
+moved in batches from the live ``User`` table into ``ArchivedCustomer`` so the
+indexes used by logins and staff lookups only cover the working set. An
+archived customer is moved back transparently the next time they log in or
+reset their password. Nothing is moved back until the password or the reset
+OTP has been checked against the archived row.
+
+Moving a customer between the tables is not a lifecycle change, so the
+signals that publish webhooks and change-feed tombstones skip saves and
+deletes made while ``moving_customers()`` is active.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import ArchivedCustomer, Customer, User
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ArchiveResult:
+    archived: int = 0
+    batches: int = 0
+    elapsed: float = 0.0
+
+
+_moving = threading.local()
+
+
+@contextmanager
+def moving_customers():
+    """Mark saves and deletes in this thread as moves between the hot and cold tables"""
+    previous = getattr(_moving, 'active', False)
+    _moving.active = True
+    try:
+        yield
+    finally:
+        _moving.active = previous
+
+
+def is_moving_customers():
+    return getattr(_moving, 'active', False)
+
+
+def cold_customers(inactive_days=None):
+    inactive_days = inactive_days or getattr(settings, 'ARCHIVE_INACTIVE_DAYS', 365)
+    cutoff = timezone.now() - timedelta(days=inactive_days)
+    return Customer.objects.filter(
+        Q(is_active=False)
+        | Q(last_login__lt=cutoff)
+        | Q(last_login__isnull=True, created_at__lt=cutoff)
+    )
+
+
+def archive_customers(inactive_days=None, batch_size=500, pause=0.0, max_batches=None):
+    """Move cold customers to the archive table, one short transaction per batch"""
+    result = ArchiveResult()
+    started = time.monotonic()
+    candidates = cold_customers(inactive_days).order_by('pk').only(*ArchivedCustomer.COPIED_FIELDS)
+    
+    while max_batches is None or result.batches < max_batches:
+        with transaction.atomic(), moving_customers():
+            batch = list(candidates[:batch_size])
+            if not batch:
+                break
+            ArchivedCustomer.objects.bulk_create([
+                ArchivedCustomer(**{field: getattr(user, field) for field in ArchivedCustomer.COPIED_FIELDS})
+                for user in batch
+            ])
+            User.objects.filter(pk__in=[user.pk for user in batch]).delete()
+        result.archived += len(batch)
+        result.batches += 1
+        
+        if len(batch) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    
+    result.elapsed = time.monotonic() - started
+    logger.info(f"Archived {result.archived} customers in {result.batches} batches ({result.elapsed:.2f}s)")
+    return result
+
+
+def rehydrate_customer(email, verify=None):
+    """
+    Move an archived customer back into the live table.
+    ``verify`` is called with the locked ArchivedCustomer and must return True
+    for the move to happen; unauthenticated callers check the password or OTP
+    with it. Returns the restored Customer, or None if no archived customer
+    matches or ``verify`` rejected it.
+    """
+    try:
+        with transaction.atomic(), moving_customers():
+            archived = ArchivedCustomer.objects.select_for_update().with_email(email).first()
+            if archived is None or (verify is not None and not verify(archived)):
+                return None
+            customer = Customer(**{field: getattr(archived, field) for field in ArchivedCustomer.COPIED_FIELDS})
+            customer.save(force_insert=True)
+            # auto_now_add overwrote the original signup dates on insert
+            Customer.objects.filter(pk=customer.pk).update(
+                date_joined=archived.date_joined, created_at=archived.created_at
+            )
+            customer.date_joined, customer.created_at = archived.date_joined, archived.created_at
+            archived.delete()
+    except IntegrityError:
+        # The email was registered again while archived; the live account wins
+        logger.warning(f"Could not rehydrate archived customer {email}: email is in use")
+        return None
+    
+    logger.info(f"Rehydrated archived customer {email}")
+    return customer
+
+
+def table_stats():
+    """
+    Row counts and on-disk sizes of the hot and cold tables.
+    On Postgres counts are planner estimates so this stays cheap on large tables.
+    """
+    connection = connections['default']
+    if connection.vendor != 'postgresql':
+        return {
+            'hot_customers': Customer.objects.count(),
+            'hot_staff': User.objects.filter(user_type='staff').count(),
+            'archived_customers': ArchivedCustomer.objects.count(),
+        }
+    
+    stats = {}
+    with connection.cursor() as cursor:
+        for label, model in (('users', User), ('archive', ArchivedCustomer)):
+            cursor.execute(
+                "SELECT reltuples::bigint, pg_relation_size(oid), pg_indexes_size(oid) "
+                "FROM pg_class WHERE oid = %s::regclass",
+                [model._meta.db_table],
+            )
+            rows, table_bytes, index_bytes = cursor.fetchone()
+            stats[f'{label}_rows_estimate'] = max(rows, 0)
+            stats[f'{label}_table_bytes'] = table_bytes
+            stats[f'{label}_index_bytes'] = index_bytes
+    return stats
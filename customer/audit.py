@@ -0,0 +1,260 @@
+"""
+In-process audit log for staff management actions.
+
+``record()`` only appends to a bounded in-memory buffer, so the request path
+never waits on I/O. A background thread drains the buffer in batches into the
+configured sink: ``AuditEvent`` rows via ``bulk_create`` or monthly rotated
+JSON-lines files. When the buffer is full new events are dropped and counted
+instead of blocking. Events recorded inside a transaction are only queued
+once it commits.
+
+Settings (``AUDIT_LOG``):
+    SINK            'database' or 'file'
+    BUFFER_SIZE     maximum number of pending events
+    BATCH_SIZE      maximum events written per batch
+    FLUSH_INTERVAL  seconds between background flushes; None disables the
+                    background thread so only flush() (and exit) write events
+    DIRECTORY       target directory of the file sink
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, models, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'SINK': 'database',
+    'BUFFER_SIZE': 10000,
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 1.0,
+    'DIRECTORY': 'audit',
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'AUDIT_LOG', {})}
+
+
+class AuditBuffer:
+    """Bounded FIFO of pending events that counts, rather than blocks on, overflow"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.dropped = 0
+        self._events = deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._events)
+
+    def append(self, event):
+        with self._lock:
+            if len(self._events) >= self.capacity:
+                self.dropped += 1
+                return False
+            self._events.append(event)
+            return True
+
+    def drain(self, limit):
+        with self._lock:
+            count = min(limit, len(self._events))
+            return [self._events.popleft() for _ in range(count)]
+
+
+class DatabaseSink:
+    def write(self, events):
+        from .models import AuditEvent
+        AuditEvent.objects.bulk_create([AuditEvent(**event) for event in events])
+
+    def recover(self):
+        # A failed write may have broken the connection; reconnect on the next batch
+        for connection in connections.all(initialized_only=True):
+            if connection.connection is not None and not connection.is_usable():
+                connection.close()
+
+    def close(self):
+        # The flusher thread keeps its own connection between flushes until it stops
+        connections.close_all()
+
+
+class FileSink:
+    """Appends JSON lines to one file per month, e.g. audit-2025-06.log"""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def path_for(self, moment):
+        return self.directory / f'audit-{moment:%Y-%m}.log'
+
+    def write(self, events):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        by_month = {}
+        for event in events:
+            by_month.setdefault(self.path_for(event['created_at']), []).append(event)
+        for path, month_events in by_month.items():
+            with open(path, 'a', encoding='utf-8') as handle:
+                handle.writelines(
+                    json.dumps(event, cls=DjangoJSONEncoder) + '\n' for event in month_events
+                )
+
+    def recover(self):
+        pass
+
+    def read(self, start, end, actor_id=None):
+        """Events in [start, end), only opening the files of the months in range"""
+        month = start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        while month < end:
+            path = self.path_for(month)
+            if path.exists():
+                with open(path, encoding='utf-8') as handle:
+                    for line in handle:
+                        event = json.loads(line)
+                        created_at = datetime.fromisoformat(event['created_at'])
+                        if start <= created_at < end and actor_id in (None, event['actor_id']):
+                            yield event
+            month = (month + timedelta(days=32)).replace(day=1)
+
+    def close(self):
+        pass
+
+
+class AuditLog:
+    def __init__(self, config=None):
+        config = config or get_config()
+        self.batch_size = config['BATCH_SIZE']
+        self.flush_interval = config['FLUSH_INTERVAL']
+        self.buffer = AuditBuffer(config['BUFFER_SIZE'])
+        if config['SINK'] == 'file':
+            self.sink = FileSink(config['DIRECTORY'])
+        else:
+            self.sink = DatabaseSink()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    @property
+    def dropped(self):
+        return self.buffer.dropped
+
+    def record(self, event):
+        if self.flush_interval is None:
+            self.buffer.append(event)
+            return
+        self._ensure_flusher()
+        self.buffer.append(event)
+        if len(self.buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def flush(self):
+        """Write every pending event; returns the number written"""
+        written = 0
+        with self._flush_lock:
+            while True:
+                batch = self.buffer.drain(self.batch_size)
+                if not batch:
+                    break
+                try:
+                    self.sink.write(batch)
+                    written += len(batch)
+                except Exception:
+                    logger.exception(f"Failed to write {len(batch)} audit events")
+                    if threading.current_thread() is self._thread:
+                        self.sink.recover()
+        return written
+
+    def close(self, timeout=5.0):
+        """Stop this process's flusher thread and write every pending event"""
+        self._stopping.set()
+        self._wakeup.set()
+        thread = self._thread
+        if thread is not None and self._pid == os.getpid() and thread is not threading.current_thread():
+            thread.join(timeout)
+        return self.flush()
+
+    def _ensure_flusher(self):
+        # Threads don't survive a fork, so prefork workers each start their own
+        if self._pid == os.getpid():
+            return
+        with self._flush_lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run, name='audit-flusher', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        try:
+            while not self._stopping.is_set():
+                self._wakeup.wait(self.flush_interval)
+                self._wakeup.clear()
+                self.flush()
+        finally:
+            self.sink.close()
+
+
+_audit_log = None
+_audit_log_lock = threading.Lock()
+
+
+def get_audit_log():
+    global _audit_log
+    if _audit_log is None:
+        with _audit_log_lock:
+            if _audit_log is None:
+                _audit_log = AuditLog()
+                atexit.register(_audit_log.close)
+    return _audit_log
+
+
+def reset_audit_log(*, setting, **kwargs):
+    """Rebuild the audit log from the new settings, e.g. under override_settings"""
+    global _audit_log
+    if setting == 'AUDIT_LOG':
+        with _audit_log_lock:
+            if _audit_log is not None:
+                _audit_log.close()
+                atexit.unregister(_audit_log.close)
+            _audit_log = None
+
+
+setting_changed.connect(reset_audit_log)
+
+
+def _jsonable(value):
+    if isinstance(value, models.Model):
+        return value.pk
+    return value
+
+
+def snapshot(instance, fields):
+    """Current values of the given fields, suitable for the changes payload"""
+    return {field: _jsonable(getattr(instance, field, None)) for field in fields}
+
+
+def record(action, actor, target=None, changes=None):
+    """
+    Queue an audit event without blocking the caller. Inside a transaction the
+    event is queued when it commits, so a rolled back change is never logged.
+    """
+    event = {
+        'action': action,
+        'actor_id': getattr(actor, 'pk', None),
+        'target_type': target._meta.model_name if target is not None else '',
+        'target_id': getattr(target, 'pk', None),
+        'changes': {key: _jsonable(value) for key, value in (changes or {}).items()},
+        'created_at': timezone.now(),
+    }
+    transaction.on_commit(lambda: get_audit_log().record(event))
@@ -0,0 +1,174 @@
+import copy
+import hmac
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils.crypto import salted_hmac
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import BaseAuthentication, BasicAuthentication, get_authorization_header
+from rest_framework_simplejwt.authentication import JWTAuthentication as BaseJWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+
+from .authorization import AuthorizationContext, get_auth_context
+from . import metrics
+from .caching import TTLCache, generation_of
+from .models import ApiKey
+
+_basic_auth_config = getattr(settings, 'BASIC_AUTH_CACHE', {})
+
+# HMAC(credentials) -> (user id, password hash at verification time)
+credential_cache = TTLCache(
+    max_entries=_basic_auth_config.get('MAX_ENTRIES', 10000),
+    ttl=_basic_auth_config.get('TTL', 300),
+)
+
+
+_api_key_config = getattr(settings, 'API_KEY_CACHE', {})
+
+# Key prefix -> (ApiKey with user and role loaded, narrowed authorization context,
+# generation of the user's users:<pk> cache namespace when loaded)
+api_key_cache = TTLCache(
+    max_entries=_api_key_config.get('MAX_ENTRIES', 10000),
+    ttl=_api_key_config.get('TTL', 60),
+)
+
+
+def invalidate_credentials(user):
+    """Forget cached Basic verifications of a user, e.g. after a password change"""
+    credential_cache.discard_if(lambda entry: entry[0] == user.pk)
+
+
+class RoleLoadingUsers:
+    """
+    Stands in for the user model in simplejwt's get_user(): the same lookup
+    and checks, with the user's role joined in.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.DoesNotExist = model.DoesNotExist
+
+    @property
+    def objects(self):
+        return self.model.objects.select_related('role')
+
+
+# simplejwt failure code -> auth_attempts outcome
+JWT_FAILURE_OUTCOMES = {
+    'user_not_found': 'unknown_user',
+    'user_inactive': 'inactive',
+    'password_changed': 'revoked',
+}
+
+
+class JWTAuthentication(BaseJWTAuthentication):
+    """
+    JWT authentication that loads the user and its role in a single query and
+    builds the request's authorization context up front. simplejwt's own
+    checks (CHECK_USER_IS_ACTIVE, CHECK_REVOKE_TOKEN) still apply.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user_model = RoleLoadingUsers(self.user_model)
+
+    def get_user(self, validated_token):
+        try:
+            user = super().get_user(validated_token)
+        except AuthenticationFailed as e:
+            outcome = JWT_FAILURE_OUTCOMES.get(str(e.detail.get('code')))
+            if outcome:
+                metrics.auth_attempts.inc(mechanism='jwt', outcome=outcome)
+            raise
+        get_auth_context(user)
+        return user
+
+
+class CachedBasicAuthentication(BasicAuthentication):
+    """
+    HTTP Basic authentication that remembers successful password checks for a
+    short time, so scripted clients don't pay a full password hash per request.
+
+    Entries are keyed by a keyed HMAC of the credentials, never the password
+    itself. A hit is only honoured while the user's stored password hash is
+    unchanged, so a password change invalidates it in every process.
+    """
+    def authenticate_credentials(self, userid, password, request=None):
+        key = salted_hmac('customer.CachedBasicAuthentication', f'{userid}\0{password}').hexdigest()
+        cached = credential_cache.get(key)
+        if cached is not None:
+            user_id, password_hash = cached
+            user = get_user_model().objects.select_related('role').filter(pk=user_id, is_active=True).first()
+            if user is not None and user.password == password_hash:
+                get_auth_context(user)
+                return (user, None)
+            credential_cache.delete(key)
+        
+        try:
+            user, auth = super().authenticate_credentials(userid, password, request)
+        except exceptions.AuthenticationFailed:
+            metrics.auth_attempts.inc(mechanism='basic', outcome='invalid_credentials')
+            raise
+        credential_cache.set(key, (user.pk, user.password))
+        return (user, auth)
+
+
+class ApiKeyAuthentication(BaseAuthentication):
+    """
+    Authenticates machine clients sending ``Authorization: Api-Key <key>``.
+
+    A key is resolved with one indexed query on its prefix (user and role
+    joined in) and then served from a per-process cache for API_KEY_CACHE TTL
+    seconds, so repeat requests cost no queries. Revocation is immediate in
+    the revoking process and takes at most the TTL elsewhere. Entries are
+    dropped in every process once the user's cache namespace is invalidated
+    (any change to the user, see signals.evict_cached_user).
+    """
+    keyword = 'Api-Key'
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed(_('Invalid API key header.'))
+        
+        try:
+            prefix, secret = auth[1].decode().split('.', 1)
+        except (UnicodeError, ValueError):
+            raise exceptions.AuthenticationFailed(_('Invalid API key.'))
+        
+        cached = api_key_cache.get(prefix)
+        if cached is not None and cached[2] != generation_of(self.user_cache_key(cached[0].user_id)):
+            cached = None
+        if cached is None:
+            api_key = ApiKey.objects.select_related('user', 'user__role').filter(
+                prefix=prefix, revoked_at__isnull=True
+            ).first()
+            if api_key is None:
+                metrics.auth_attempts.inc(mechanism='api_key', outcome='unknown_key')
+                raise exceptions.AuthenticationFailed(_('Invalid API key.'))
+            generation = generation_of(self.user_cache_key(api_key.user_id))
+            context = AuthorizationContext.for_user(api_key.user).with_scopes(api_key.scopes)
+            cached = (api_key, context, generation)
+            api_key_cache.set(prefix, cached)
+        
+        api_key, context = cached[:2]
+        if not hmac.compare_digest(api_key.key_hash, ApiKey.hash_secret(secret)):
+            metrics.auth_attempts.inc(mechanism='api_key', outcome='invalid_credentials')
+            raise exceptions.AuthenticationFailed(_('Invalid API key.'))
+        if not api_key.is_usable or not api_key.user.is_active:
+            api_key_cache.delete(prefix)
+            metrics.auth_attempts.inc(mechanism='api_key', outcome='inactive')
+            raise exceptions.AuthenticationFailed(_('API key is expired, revoked or inactive.'))
+        
+        # The cached user is shared between requests; hand each one its own copy
+        user = copy.copy(api_key.user)
+        user._auth_context = context
+        return (user, api_key)
+
+    def authenticate_header(self, request):
+        return self.keyword
+
+    @staticmethod
+    def user_cache_key(user_id):
+        return f'users:{user_id}:api-key'
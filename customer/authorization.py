@@ -0,0 +1,130 @@
+"""
+Request-scoped authorization context.
+
+The context is built once per request from the authenticated user (whose role
+is loaded together with the user by the authenticator) and is then read by
+permission classes, queryset scopes and serializer validators, so none of them
+touch the lazy ``User.role`` relation again.
+"""
+from .models import UserRole
+
+ALL_ROLES = tuple(role for role, _ in UserRole.ROLE_CHOICES)
+
+# Permission prefix an API key scope needs for each HTTP method
+METHOD_ACTIONS = {
+    'GET': 'view', 'HEAD': 'view', 'OPTIONS': 'view',
+    'POST': 'add', 'PUT': 'change', 'PATCH': 'change', 'DELETE': 'delete',
+}
+
+
+def request_action(request, view=None):
+    """
+    Permission prefix a request needs. Views whose POST changes or deletes
+    existing users (the bulk endpoints) declare it as ``scope_action``.
+    """
+    return getattr(view, 'scope_action', None) or METHOD_ACTIONS.get(request.method)
+
+
+class AuthorizationContext:
+    __slots__ = ('user_id', 'role', 'is_superuser', 'is_staff', 'permissions', 'creatable_roles', 'scoped')
+
+    def __init__(self, user_id=None, role=None, is_superuser=False, is_staff=False,
+                 permissions=frozenset(), creatable_roles=(), scoped=False):
+        self.user_id = user_id
+        self.role = role
+        self.is_superuser = is_superuser
+        self.is_staff = is_staff
+        self.permissions = permissions
+        self.creatable_roles = creatable_roles
+        # Scoped contexts (API keys) may only perform actions their permissions cover
+        self.scoped = scoped
+
+    def __repr__(self):
+        return f'<AuthorizationContext user={self.user_id} role={self.role}>'
+
+    @classmethod
+    def for_user(cls, user):
+        if user is None or not user.is_authenticated:
+            return cls()
+        
+        role = user.role.role if user.role_id else None
+        if user.is_superuser:
+            permissions = frozenset(p for perms in UserRole.ROLE_PERMISSIONS.values() for p in perms)
+            creatable_roles = ALL_ROLES
+        else:
+            permissions = frozenset(UserRole.ROLE_PERMISSIONS.get(role, ()))
+            creatable_roles = tuple(UserRole.get_creatable_roles(role))
+        return cls(
+            user_id=user.pk,
+            role=role,
+            is_superuser=user.is_superuser,
+            is_staff=user.is_staff,
+            permissions=permissions,
+            creatable_roles=creatable_roles,
+        )
+
+    def with_scopes(self, scopes):
+        """
+        Copy of this context restricted to the given permission scopes.
+        Only roles with an ``add_<role>`` scope remain creatable.
+        """
+        permissions = self.permissions & frozenset(scopes)
+        return AuthorizationContext(
+            user_id=self.user_id,
+            role=self.role,
+            is_superuser=self.is_superuser,
+            is_staff=self.is_staff,
+            permissions=permissions,
+            creatable_roles=tuple(role for role in self.creatable_roles if f'add_{role}' in permissions),
+            scoped=True,
+        )
+
+    def allows(self, action, role=None):
+        """
+        Whether the scopes cover ``action`` on users of ``role``, or on users
+        of at least one role when no role is given. Unscoped contexts are
+        limited by their role alone.
+        """
+        if not self.scoped:
+            return True
+        if role is None:
+            return any(perm.startswith(f'{action}_') for perm in self.permissions)
+        return f'{action}_{role}' in self.permissions
+
+    def scoped_roles(self, action):
+        """Roles whose users the scopes allow ``action`` on, or None when unscoped"""
+        if not self.scoped:
+            return None
+        return tuple(role for role in ALL_ROLES if self.allows(action, role))
+
+    @property
+    def is_admin(self):
+        return self.is_staff and self.role == 'admin'
+
+    @property
+    def is_manager(self):
+        return self.is_staff and self.role == 'manager'
+
+    @property
+    def is_cashier(self):
+        return self.is_staff and self.role == 'cashier'
+
+    def can_create(self, role):
+        return role in self.creatable_roles
+
+    def has_perm(self, perm):
+        return perm in self.permissions
+
+
+def get_auth_context(request):
+    """
+    Return the authorization context for a request (or a user), building and
+    caching it on the user the first time it is needed.
+    """
+    user = getattr(request, 'user', request)
+    context = getattr(user, '_auth_context', None)
+    if context is None:
+        context = AuthorizationContext.for_user(user)
+        if user is not None:
+            user._auth_context = context
+    return context
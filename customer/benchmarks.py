@@ -0,0 +1,293 @@
+"""
+Benchmarks run with ``manage.py benchmark <scenario>``.
+
+Each scenario is a function taking the command (for output) and the parsed
+options, registered with ``@scenario``. They run against the configured
+database, so point them at a seeded copy rather than production.
+"""
+import json
+import socket
+import socketserver
+import threading
+import time
+from io import BytesIO
+from statistics import median
+from wsgiref.util import setup_testing_defaults
+
+SCENARIOS = {}
+
+BENCHMARK_DOMAIN = 'benchmark.example.com'
+
+
+def scenario(name):
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+def timed(func, iterations):
+    """Per-call wall times in microseconds, after one warm-up call"""
+    func()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1e6)
+    return samples
+
+
+def report(command, label, samples):
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    command.stdout.write(
+        f'{label:<40} median {median(samples):9.1f}us   p95 {p95:9.1f}us   n={len(samples)}'
+    )
+
+
+def wsgi_get(handler, path, headers=None):
+    return wsgi_request(handler, 'GET', path, headers=headers)
+
+
+def wsgi_post(handler, path, data, headers=None):
+    return wsgi_request(handler, 'POST', path, json.dumps(data).encode(), headers)
+
+
+def wsgi_request(handler, method, path, body=b'', headers=None):
+    environ = {'PATH_INFO': path, 'REQUEST_METHOD': method, 'HTTP_HOST': '127.0.0.1',
+               'SERVER_NAME': '127.0.0.1', 'CONTENT_TYPE': 'application/json',
+               'CONTENT_LENGTH': str(len(body))}
+    environ.update(headers or {})
+    setup_testing_defaults(environ)
+
+    def call():
+        environ['wsgi.input'] = BytesIO(body)
+        response = handler(environ, lambda status, headers: None)
+        response.close()
+    return call
+
+
+def staff_token_headers(email=None):
+    """Authorization header for the given (or first) staff user, if any"""
+    from rest_framework_simplejwt.tokens import AccessToken
+    from .models import User
+
+    users = User.objects.filter(is_staff=True, is_active=True)
+    user = users.filter(email=email).first() if email else users.order_by('pk').first()
+    if user is None:
+        return {}
+    return {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(user)}'}
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib: every command succeeds, messages are discarded"""
+
+    def reply(self, *lines):
+        self.wfile.write(b''.join(f'{line}\r\n'.encode() for line in lines))
+
+    def handle(self):
+        self.server.opened(self.request)
+        try:
+            self.reply('220 sink ESMTP')
+            for line in self.rfile:
+                command = line[:4].upper()
+                if command == b'EHLO':
+                    self.reply('250-sink', '250 8BITMIME')
+                elif command == b'DATA':
+                    self.reply('354 End data with <CR><LF>.<CR><LF>')
+                    for data in self.rfile:
+                        if data == b'.\r\n':
+                            break
+                    self.server.received()
+                    self.reply('250 OK')
+                elif command == b'QUIT':
+                    self.reply('221 Bye')
+                    break
+                else:
+                    self.reply('250 OK')
+        except OSError:
+            pass  # dropped by drop_connections()
+        finally:
+            self.server.closed(self.request)
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """Local SMTP server that counts connections and messages"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+        self.connections = self.messages = 0
+        self.sockets = set()
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, name='smtp-sink', daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.drop_connections()
+        self.shutdown()
+        self.server_close()
+
+    def opened(self, sock):
+        with self.lock:
+            self.connections += 1
+            self.sockets.add(sock)
+
+    def closed(self, sock):
+        with self.lock:
+            self.sockets.discard(sock)
+
+    def received(self):
+        with self.lock:
+            self.messages += 1
+
+    def drop_connections(self):
+        """Close every client connection, as a server dropping idle clients would"""
+        with self.lock:
+            sockets = list(self.sockets)
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def settings(self):
+        """Settings that point Django's SMTP backend at this sink"""
+        return {
+            'EMAIL_BACKEND': 'django.core.mail.backends.smtp.EmailBackend',
+            'EMAIL_HOST': '127.0.0.1', 'EMAIL_PORT': self.port,
+            'EMAIL_USE_TLS': False, 'EMAIL_USE_SSL': False,
+            'EMAIL_HOST_USER': '', 'EMAIL_HOST_PASSWORD': '',
+        }
+
+
+@scenario('middleware')
+def middleware_overhead(command, options):
+    """Per-request cost of the full vs the API-only middleware chain"""
+    from django.core.handlers.wsgi import WSGIHandler
+    from api_drf.handlers import PathScopedWSGIHandler
+
+    handlers = {'full chain': WSGIHandler(), 'api chain': PathScopedWSGIHandler()}
+    auth = staff_token_headers(options.get('email'))
+    for path, headers in (('/api/', {}), ('/api/user/roles/', auth)):
+        for label, handler in handlers.items():
+            report(command, f'GET {path} ({label})', timed(wsgi_get(handler, path, headers), options['iterations']))
+
+
+@scenario('staff')
+def staff_paths(command, options):
+    """
+    Staff login and listing latency, plus the plans of their queries.
+    Meant for a table seeded with many customers (see seed_users).
+    """
+    from django.db.models import Q
+    from api_drf.handlers import PathScopedWSGIHandler
+    from .models import Staff, User
+
+    staff = Staff.objects.filter(is_active=True, is_superuser=False)
+    user = staff.filter(email=options['email']).first() if options.get('email') else staff.order_by('pk').first()
+    if user is None:
+        command.stderr.write('No staff user to benchmark with; run seed_users first')
+        return
+
+    command.stdout.write(
+        f"{User.objects.filter(user_type='customer').count()} customers, {staff.count()} staff"
+    )
+    queries = {
+        'staff login lookup': Staff.objects.with_email(user.email),
+        'staff list': User.objects.filter(is_staff=True).exclude(is_superuser=True).select_related('role'),
+        'staff subtree': User.objects.filter(Q(is_staff=True), hierarchy_path__startswith=user.subtree_prefix),
+    }
+    for label, queryset in queries.items():
+        command.stdout.write(f'-- {label}\n{queryset.explain()}')
+    for label, queryset in queries.items():
+        report(command, f'{label} (query)', timed(lambda: list(queryset[:100]), options['iterations']))
+
+    handler = PathScopedWSGIHandler()
+    auth = staff_token_headers(user.email)
+    login = wsgi_post(handler, '/api/user/login/', {'email': user.email, 'password': options['password']})
+    # Every login pays one full password hash; keep the iteration count sane
+    report(command, 'POST /api/user/login/', timed(login, max(1, options['iterations'] // 10)))
+    report(command, 'GET /api/user/', timed(wsgi_get(handler, '/api/user/', auth), options['iterations']))
+
+
+@scenario('registration')
+def registration(command, options):
+    """Round trips and latency of a customer sign-up, new and duplicate"""
+    import uuid
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from api_drf.handlers import PathScopedWSGIHandler
+    from .models import User
+
+    handler = PathScopedWSGIHandler()
+    run = uuid.uuid4().hex[:8]
+    emails = (f'bench-{run}-{i}@{BENCHMARK_DOMAIN}' for i in range(options['iterations'] + 2))
+
+    def register(email=None):
+        data = {'name': 'Benchmark', 'email': email or next(emails), 'password': 'secret-pass-1'}
+        wsgi_post(handler, '/api/customer/register/', data)()
+
+    duplicate = f'bench-{run}-duplicate@{BENCHMARK_DOMAIN}'
+    register(duplicate)
+    for label, call in (('new customer', register), ('duplicate email', lambda: register(duplicate))):
+        with CaptureQueriesContext(connection) as queries:
+            call()
+        command.stdout.write(f'{label}: {len(queries)} round trips')
+        for query in queries:
+            command.stdout.write(f'    {query["sql"][:100]}')
+
+    # Password hashing dominates; keep the iteration count sane
+    report(command, 'POST /api/customer/register/', timed(register, max(1, options['iterations'] // 10)))
+    User.objects.filter(email__startswith=f'bench-{run}-').delete()
+
+
+@scenario('mail')
+def otp_mail(command, options):
+    """
+    OTP email throughput against a local SMTP sink: rendering the template and
+    connecting for every email, against the compiled template and mail pool.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from django.conf import settings
+    from django.core.mail import EmailMultiAlternatives
+    from django.template.loader import render_to_string
+    from django.test import override_settings
+    from django.utils.html import strip_tags
+    from .mail import get_config, get_mail_pool
+    from .utils import send_otp_email
+
+    def unpooled(email, otp_code):
+        html = render_to_string('emails/otp_email.html', {'otp_code': otp_code})
+        message = EmailMultiAlternatives('Your One-Time Password (OTP)', strip_tags(html),
+                                         settings.DEFAULT_FROM_EMAIL, [email])
+        message.attach_alternative(html, 'text/html')
+        message.send()
+
+    iterations = options['iterations']
+    senders = {'render + connect per email': unpooled, 'compiled + pooled': send_otp_email}
+    with SMTPSink() as sink, override_settings(**sink.settings()):
+        for label, send in senders.items():
+            report(command, label, timed(lambda: send(f'bench@{BENCHMARK_DOMAIN}', '123456'), iterations))
+
+        workers = get_config()['SIZE']
+        for label, send in senders.items():
+            before = sink.connections
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(send, [f'bench{i}@{BENCHMARK_DOMAIN}' for i in range(iterations)],
+                              [f'{i % 1000000:06d}' for i in range(iterations)]))
+            elapsed = time.perf_counter() - started
+            command.stdout.write(
+                f'{label:<40} burst of {iterations} on {workers} threads: '
+                f'{iterations / elapsed:9.1f} emails/s, {sink.connections - before} connections'
+            )
+        get_mail_pool().close()
+        command.stdout.write(f'sink received {sink.messages} emails')
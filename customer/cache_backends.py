@@ -0,0 +1,194 @@
+"""
+Tiered cache backend: a per-process LRU in front of a shared cache.
+
+Reads are served from the process's bounded LRU for at most ``LOCAL_TTL``
+seconds, then from the shared tier (any configured cache alias, e.g. Redis or
+a file cache), which also receives every write. The local tier keeps pickled
+copies, so callers never share mutable objects.
+
+Invalidation across processes works with namespace generations. A key
+``"users:42:profile"`` belongs to the namespaces ``users`` and ``users:42``.
+Each namespace has a generation token stored in the shared tier, and the token
+is part of the real key. ``invalidate("users:42")`` writes a new token, so
+every entry of the namespace becomes unreachable in all processes once their
+locally remembered token is older than ``GENERATION_TTL`` seconds. Keys
+without a ``:`` belong to no namespace.
+
+Configuration::
+
+    CACHES = {
+        'shared': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': ...},
+        'default': {
+            'BACKEND': 'customer.cache_backends.TieredCache',
+            'LOCATION': 'shared',  # alias of the shared tier
+            'OPTIONS': {'LOCAL_MAX_ENTRIES': 1000, 'LOCAL_TTL': 5, 'GENERATION_TTL': 1},
+        },
+    }
+
+Options:
+    LOCAL_MAX_ENTRIES  entries kept in the per-process tier
+    LOCAL_TTL          seconds an entry is served locally without the shared tier
+    GENERATION_TTL     seconds a namespace generation is trusted before re-reading it
+    LOCAL_NAME         per-process tier to use (defaults to LOCATION); backends
+                       with the same name share one local tier
+"""
+import pickle
+import secrets
+import threading
+import time
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+from .caching import TTLCache
+
+GENERATION_KEY = 'tiered-generation:{}'
+
+_MISSING = object()
+
+
+class TierState:
+    """The per-process part of a tiered cache, shared by every thread's backend instance"""
+
+    def __init__(self, max_entries, local_ttl, generation_ttl):
+        self.local = TTLCache(max_entries=max_entries, ttl=local_ttl)
+        self.generations = TTLCache(max_entries=max_entries, ttl=generation_ttl)
+        self.shared_hits = self.shared_misses = self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        local = self.local.stats()
+        return {
+            'local_hits': local['hits'],
+            'local_misses': local['misses'],
+            'local_entries': local['entries'],
+            'local_evictions': local['evictions'],
+            'shared_hits': self.shared_hits,
+            'shared_misses': self.shared_misses,
+            'invalidations': self.invalidations,
+        }
+
+
+# Django creates a backend instance per thread; the local tier is per process
+_states = {}
+_states_lock = threading.Lock()
+
+
+class TieredCache(BaseCache):
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.shared_alias = location
+        name = options.get('LOCAL_NAME', location)
+        with _states_lock:
+            if name not in _states:
+                _states[name] = TierState(
+                    max_entries=options.get('LOCAL_MAX_ENTRIES', 1000),
+                    local_ttl=options.get('LOCAL_TTL', 5),
+                    generation_ttl=options.get('GENERATION_TTL', 1),
+                )
+            self.state = _states[name]
+
+    @property
+    def shared(self):
+        return caches[self.shared_alias]
+
+    def namespaces(self, key):
+        """'users:42:profile' -> ['users', 'users:42']"""
+        parts = key.split(':')[:-1]
+        return [':'.join(parts[:depth]) for depth in range(1, len(parts) + 1)]
+
+    def generation(self, namespace):
+        token = self.state.generations.get(namespace)
+        if token is None:
+            token = self.shared.get(GENERATION_KEY.format(namespace)) or '0'
+            self.state.generations.set(namespace, token)
+        return token
+
+    def invalidate(self, *namespaces):
+        """Make every entry of the namespaces unreachable, in every process"""
+        for namespace in namespaces:
+            # A fresh token instead of incr(): no read-modify-write race on shared tiers without atomic incr
+            token = secrets.token_hex(6)
+            self.shared.set(GENERATION_KEY.format(namespace), token, None)
+            self.state.generations.set(namespace, token)
+            self.state.count('invalidations')
+
+    def tier_key(self, key):
+        tokens = [self.generation(namespace) for namespace in self.namespaces(key)]
+        return f"{key}@{'.'.join(tokens)}" if tokens else key
+
+    def local_ttl(self, timeout):
+        timeout = self.get_backend_timeout(timeout)
+        if timeout is None:
+            return self.state.local.ttl
+        return min(self.state.local.ttl, max(timeout - time.time(), 0))
+
+    def get(self, key, default=None, version=None):
+        tier_key = self.tier_key(key)
+        local_key = self.make_and_validate_key(tier_key, version=version)
+        cached = self.state.local.get(local_key)
+        if cached is not None:
+            return pickle.loads(cached)
+
+        value = self.shared.get(tier_key, _MISSING, version=version)
+        if value is _MISSING:
+            self.state.count('shared_misses')
+            return default
+        self.state.count('shared_hits')
+        self.state.local.set(local_key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        tier_key = self.tier_key(key)
+        local_key = self.make_and_validate_key(tier_key, version=version)
+        self.shared.set(tier_key, value, self._shared_timeout(timeout), version=version)
+        ttl = self.local_ttl(timeout)
+        if ttl > 0:
+            self.state.local.set(local_key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ttl=ttl)
+        else:
+            self.state.local.delete(local_key)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        tier_key = self.tier_key(key)
+        if not self.shared.add(tier_key, value, self._shared_timeout(timeout), version=version):
+            return False
+        ttl = self.local_ttl(timeout)
+        if ttl > 0:
+            local_key = self.make_and_validate_key(tier_key, version=version)
+            self.state.local.set(local_key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ttl=ttl)
+        return True
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.shared.touch(self.tier_key(key), self._shared_timeout(timeout), version=version)
+
+    def delete(self, key, version=None):
+        tier_key = self.tier_key(key)
+        self.state.local.delete(self.make_and_validate_key(tier_key, version=version))
+        return self.shared.delete(tier_key, version=version)
+
+    def has_key(self, key, version=None):
+        return self.get(key, _MISSING, version=version) is not _MISSING
+
+    def incr(self, key, delta=1, version=None):
+        tier_key = self.tier_key(key)
+        self.state.local.delete(self.make_and_validate_key(tier_key, version=version))
+        return self.shared.incr(tier_key, delta, version=version)
+
+    def clear(self):
+        self.state.local.clear()
+        self.state.generations.clear()
+        self.shared.clear()
+
+    def close(self, **kwargs):
+        self.shared.close(**kwargs)
+
+    def stats(self):
+        return self.state.stats()
+
+    def _shared_timeout(self, timeout):
+        return self.default_timeout if timeout is DEFAULT_TIMEOUT else timeout
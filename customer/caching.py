@@ -0,0 +1,116 @@
+"""
+Small in-process caches, and helpers for the app caches in Django's cache
+framework (the tiered ``default`` cache, see ``customer/cache_backends.py``).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import transaction
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after ``ttl`` seconds.
+    Keeps hit/miss/eviction counters for metrics.
+    """
+
+    def __init__(self, max_entries=10000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_if(self, predicate):
+        """Drop every entry whose value matches; returns the number dropped"""
+        with self._lock:
+            keys = [key for key, (value, _) in self._entries.items() if predicate(value)]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+def cached(key, compute, timeout=DEFAULT_TIMEOUT, alias='default'):
+    """The cached value of ``key``, computed and stored on a miss"""
+    cache = caches[alias]
+    value = cache.get(key, _MISSING)
+    if value is _MISSING:
+        value = compute()
+        cache.set(key, value, timeout)
+    return value
+
+
+def generation_of(key, alias='default'):
+    """
+    Stamp that changes whenever a namespace of ``key`` is invalidated, for
+    in-process caches that must honour invalidate() (None without a tiered cache)
+    """
+    cache = caches[alias]
+    return cache.tier_key(key) if hasattr(cache, 'tier_key') else None
+
+
+def invalidate(*namespaces, alias='default', using=None):
+    """
+    Evict every entry of the namespaces from a tiered cache, in every process.
+    Inside a transaction the namespaces are bumped again on commit, so entries
+    other processes compute from the uncommitted state don't outlive it.
+    """
+    cache = caches[alias]
+    if not hasattr(cache, 'invalidate'):
+        return
+    cache.invalidate(*namespaces)
+    if transaction.get_connection(using).in_atomic_block:
+        transaction.on_commit(lambda: caches[alias].invalidate(*namespaces), using=using)
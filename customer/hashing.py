@@ -0,0 +1,358 @@
+"""
+Password hashing policy per role, with background upgrades of old hashes.
+
+``manage.py tune_hashers`` times the available hashers (PBKDF2, scrypt and
+argon2 when argon2-cffi is installed) on this machine and writes a policy
+file with, for every role, the algorithm and parameters whose verification
+takes about ``TARGETS[role]`` seconds. It never goes below the cost of the
+hasher registered in ``PASSWORD_HASHERS`` (Django's defaults) or ``MINIMUMS``,
+so a fast role such as cashier gets a cheaper algorithm, not a weaker one. Without
+a policy file Django's ``PASSWORD_HASHERS`` default applies to everybody.
+
+``User.set_password()`` hashes with the user's policy. ``User.check_password()``
+verifies any hash Django knows. When the stored hash uses other parameters,
+the upgrade is queued rather than done inline, so the login response does not
+pay for a second hash. A background thread rehashes and writes the new hash
+only if the stored one is still the one that was verified.
+
+Settings (``PASSWORD_POLICY``):
+    POLICY_FILE           JSON written by tune_hashers; None disables the policy
+    TARGETS               seconds one verification should take, per role
+                          ('customer', a staff role name, or 'default')
+    ALGORITHMS            algorithms the tuner tries, in order of preference
+    MINIMUMS              lowest cost the tuner may pick, per algorithm; only
+                          raises the floor of the registered hasher's cost
+    AUTO_TUNE             tune and write the policy file on first use when it
+                          does not exist
+    QUEUE_SIZE            pending rehashes before new ones are dropped
+    REHASH_IN_BACKGROUND  False leaves queued rehashes to drain_rehash_queue()
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, get_hasher, make_password
+from django.core.signals import setting_changed
+from django.db import connections
+from django.utils import timezone
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'POLICY_FILE': 'password_policy.json',
+    'TARGETS': {'default': 0.25, 'admin': 0.5, 'manager': 0.25, 'cashier': 0.05},
+    'ALGORITHMS': ['argon2', 'scrypt', 'pbkdf2_sha256'],
+    'MINIMUMS': {},
+    'AUTO_TUNE': False,
+    'QUEUE_SIZE': 1000,
+    'REHASH_IN_BACKGROUND': True,
+}
+
+# The one parameter the tuner scales per algorithm; the others keep Django's
+# values. Verification time grows linearly with each of them. scrypt scales
+# its parallelism, which costs time but no memory, so Django's default
+# maxmem keeps working.
+COST_PARAMETERS = {
+    'pbkdf2_sha256': 'iterations',
+    'scrypt': 'parallelism',
+    'argon2': 'time_cost',
+}
+PBKDF2_ROUNDING = 10_000
+CALIBRATION_PASSWORD = 'calibration-password'
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'PASSWORD_POLICY', {})}
+
+
+def configured_hasher(algorithm, params):
+    """A copy of Django's registered hasher for ``algorithm`` with ``params`` applied"""
+    hasher = copy.copy(get_hasher(algorithm))
+    for name, value in params.items():
+        if not hasattr(hasher, name):
+            raise ValueError(f"{algorithm} has no parameter {name!r}")
+        setattr(hasher, name, value)
+    return hasher
+
+
+def available_algorithms(candidates):
+    """The candidates that are in PASSWORD_HASHERS and whose library is installed"""
+    available = []
+    for algorithm in candidates:
+        try:
+            hasher = get_hasher(algorithm)
+            if hasher.library:
+                hasher._load_library()
+        except ValueError:
+            continue
+        available.append(algorithm)
+    return available
+
+
+def cost_floor(algorithm, minimums):
+    """The lowest cost the tuner may pick: the registered hasher's, or a higher minimum"""
+    default = getattr(get_hasher(algorithm), COST_PARAMETERS[algorithm])
+    return max(default, minimums.get(algorithm, default))
+
+
+def verification_time(hasher, repeat=3):
+    encoded = hasher.encode(CALIBRATION_PASSWORD, hasher.salt())
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        hasher.verify(CALIBRATION_PASSWORD, encoded)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def tune(targets=None, algorithms=None, minimums=None):
+    """
+    Time each available algorithm at its minimum cost and pick, per role, the
+    first algorithm in preference order that meets the target there. Roles
+    that no algorithm meets get the fastest one at its minimum. Returns the
+    policy as written to the policy file.
+    """
+    config = get_config()
+    targets = targets or config['TARGETS']
+    minimums = {**config['MINIMUMS'], **(minimums or {})}
+    candidates = available_algorithms(algorithms or config['ALGORITHMS'])
+    if not candidates:
+        raise ValueError("None of the requested algorithms is available in PASSWORD_HASHERS")
+
+    # Seconds per unit of cost, measured once per algorithm
+    unit_cost = {}
+    for algorithm in candidates:
+        floor = cost_floor(algorithm, minimums)
+        hasher = configured_hasher(algorithm, {COST_PARAMETERS[algorithm]: floor})
+        unit_cost[algorithm] = verification_time(hasher) / floor
+
+    roles = {}
+    for role, target in targets.items():
+        def floor_time(algorithm):
+            return cost_floor(algorithm, minimums) * unit_cost[algorithm]
+
+        algorithm = next(
+            (algorithm for algorithm in candidates if floor_time(algorithm) <= target),
+            min(candidates, key=floor_time),
+        )
+        floor = cost_floor(algorithm, minimums)
+        cost = max(floor, int(target / unit_cost[algorithm]))
+        if algorithm == 'pbkdf2_sha256':
+            cost = max(floor, cost // PBKDF2_ROUNDING * PBKDF2_ROUNDING)
+        roles[role] = {
+            'algorithm': algorithm,
+            'params': {COST_PARAMETERS[algorithm]: cost},
+            'seconds': round(cost * unit_cost[algorithm], 4),
+        }
+    return {'generated_at': timezone.now().isoformat(), 'roles': roles}
+
+
+def write_policy(policy, path=None):
+    path = Path(path or get_config()['POLICY_FILE'])
+    temporary = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    temporary.write_text(json.dumps(policy, indent=2) + '\n', encoding='utf-8')
+    os.replace(temporary, path)
+    return path
+
+
+class HashingPolicy:
+    """Role -> configured hasher, reloaded when the policy file's mtime changes"""
+
+    def __init__(self, config=None):
+        config = config or get_config()
+        self.path = Path(config['POLICY_FILE']) if config['POLICY_FILE'] else None
+        self.auto_tune = config['AUTO_TUNE']
+        self.hashers = {}
+        self._mtime = -1  # not loaded yet; a missing file has mtime None
+        self._lock = threading.Lock()
+
+    def hasher_for(self, role):
+        """The role's hasher, the policy's default, or None for Django's default"""
+        if self.path is None:
+            return None
+        self._refresh()
+        return self.hashers.get(role, self.hashers.get('default'))
+
+    def _refresh(self):
+        try:
+            mtime = self.path.stat().st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            if mtime is None and self.auto_tune:
+                logger.info(f"No password policy at {self.path}, tuning hashers")
+                write_policy(tune(), self.path)
+                mtime = self.path.stat().st_mtime
+            self.hashers = self._load() if mtime is not None else {}
+            self._mtime = mtime
+
+    def _load(self):
+        try:
+            roles = json.loads(self.path.read_text(encoding='utf-8'))['roles']
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Ignoring unreadable password policy {self.path}: {e}")
+            return {}
+        hashers = {}
+        for role, entry in roles.items():
+            try:
+                hashers[role] = configured_hasher(entry['algorithm'], entry.get('params', {}))
+            except (KeyError, ValueError) as e:
+                logger.error(f"Ignoring password policy for {role}: {e}")
+        return hashers
+
+
+class RehashQueue:
+    """Pending hash upgrades, at most one per user, written by a background thread"""
+
+    def __init__(self, capacity, background):
+        self.capacity = capacity
+        self.background = background
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, user, raw_password, hasher):
+        key = (user._state.db or 'default', user.pk)
+        with self._lock:
+            if key not in self._pending and len(self._pending) >= self.capacity:
+                metrics.password_rehashes.inc(outcome='dropped')
+                return False
+            self._pending[key] = (user.password, raw_password, hasher)
+        metrics.password_rehashes.inc(outcome='queued')
+        if self.background:
+            self._ensure_worker()
+            self._wakeup.set()
+        return True
+
+    def drain(self):
+        """Rehash every pending password; returns the number of hashes upgraded"""
+        from .models import User
+        upgraded = 0
+        while True:
+            with self._lock:
+                if not self._pending:
+                    break
+                (using, user_id), (encoded, raw_password, hasher) = self._pending.popitem()
+            try:
+                # Skip the write if the password changed since it was verified
+                updated = User._base_manager.using(using).filter(pk=user_id, password=encoded).update(
+                    password=make_password(raw_password, hasher=hasher),
+                )
+            except Exception:
+                logger.exception(f"Failed to upgrade the password hash of user {user_id}")
+                continue
+            metrics.password_rehashes.inc(outcome='upgraded' if updated else 'stale')
+            upgraded += updated
+        return upgraded
+
+    def _ensure_worker(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run, name='password-rehash', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self.drain()
+            connections.close_all()
+
+
+_policy = None
+_queue = None
+_state_lock = threading.Lock()
+
+
+def get_policy():
+    global _policy
+    if _policy is None:
+        with _state_lock:
+            if _policy is None:
+                _policy = HashingPolicy()
+    return _policy
+
+
+def get_rehash_queue():
+    global _queue
+    if _queue is None:
+        with _state_lock:
+            if _queue is None:
+                config = get_config()
+                _queue = RehashQueue(config['QUEUE_SIZE'], config['REHASH_IN_BACKGROUND'])
+                atexit.register(_queue.drain)
+    return _queue
+
+
+def drain_rehash_queue():
+    return get_rehash_queue().drain()
+
+
+def reload_policy(*, setting='PASSWORD_POLICY', **kwargs):
+    """Rebuild the policy and queue from the settings, e.g. under override_settings"""
+    global _policy, _queue
+    if setting not in ('PASSWORD_POLICY', 'PASSWORD_HASHERS'):
+        return
+    with _state_lock:
+        _policy = None
+        if _queue is not None and setting == 'PASSWORD_POLICY':
+            _queue.drain()
+            atexit.unregister(_queue.drain)
+            _queue = None
+
+
+setting_changed.connect(reload_policy)
+
+
+def policy_role(user):
+    from .models import UserRole
+    if user.user_type != 'staff':
+        return 'customer'
+    if not user.role_id:
+        return 'staff'
+    # A role that isn't loaded comes from the app cache rather than a query
+    if user._meta.get_field('role').is_cached(user):
+        role = user.role
+    else:
+        role = UserRole.cached_by_id().get(user.role_id)
+    return role.role if role else 'staff'
+
+
+def hash_user_password(user, raw_password):
+    return make_password(raw_password, hasher=get_policy().hasher_for(policy_role(user)) or 'default')
+
+
+def check_user_password(user, raw_password):
+    """
+    Verify a password against the user's stored hash. If the hash was made
+    with another algorithm or other parameters than the policy's, queue it to
+    be rehashed instead of rehashing inline.
+    """
+    preferred = get_policy().hasher_for(policy_role(user)) or get_hasher()
+
+    def setter(raw_password):
+        get_rehash_queue().submit(user, raw_password, preferred)
+
+    return check_password(raw_password, user.password, setter, preferred=preferred)
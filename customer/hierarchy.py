@@ -0,0 +1,102 @@
+"""
+Helpers for the staff hierarchy formed by ``User.created_by``.
+
+Every user stores the ids of its creators in ``hierarchy_path`` (e.g. "/1/5/"
+for a cashier created by manager 5, who was created by admin 1). Subtree and
+ancestor lookups are then a single indexed prefix/IN query. The recursive CTE
+helpers walk ``created_by`` directly and are used to validate the paths.
+"""
+from django.db import connections, router
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
+from django.utils import timezone
+
+from .models import User
+
+
+def move_subtree(old_prefix, new_prefix, using=None):
+    """
+    Rewrite the path prefix of every user below a moved or deleted node.
+    updated_at is bumped as well so the change feed picks the rows up; for a
+    deleted creator this also covers the SET_NULL of its reports' created_by.
+    """
+    if old_prefix == new_prefix:
+        return 0
+    return User.objects.db_manager(using).filter(
+        hierarchy_path__startswith=old_prefix
+    ).update(
+        hierarchy_path=Concat(Value(new_prefix), Substr('hierarchy_path', len(old_prefix) + 1)),
+        updated_at=timezone.now(),
+    )
+
+
+def _table_and_cursor(using):
+    using = using or router.db_for_read(User)
+    connection = connections[using]
+    return connection.ops.quote_name(User._meta.db_table), connection.cursor()
+
+
+def subtree_ids_recursive(user, using=None):
+    """Ids of all users below ``user`` resolved with a recursive CTE"""
+    table, cursor = _table_and_cursor(using)
+    with cursor:
+        cursor.execute(
+            f"""
+            WITH RECURSIVE subtree(id) AS (
+                SELECT id FROM {table} WHERE created_by_id = %s
+                UNION ALL
+                SELECT u.id FROM {table} u JOIN subtree s ON u.created_by_id = s.id
+            )
+            SELECT id FROM subtree
+            """,
+            [user.pk],
+        )
+        return {row[0] for row in cursor.fetchall()}
+
+
+def ancestor_ids_recursive(user, using=None):
+    """Creator chain of ``user`` (root first) resolved with a recursive CTE"""
+    table, cursor = _table_and_cursor(using)
+    with cursor:
+        cursor.execute(
+            f"""
+            WITH RECURSIVE chain(id, created_by_id, depth) AS (
+                SELECT id, created_by_id, 0 FROM {table} WHERE id = %s
+                UNION ALL
+                SELECT u.id, u.created_by_id, c.depth + 1
+                FROM {table} u JOIN chain c ON u.id = c.created_by_id
+            )
+            SELECT id FROM chain WHERE id <> %s ORDER BY depth DESC
+            """,
+            [user.pk, user.pk],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def rebuild_hierarchy_paths(user_model=None, using='default'):
+    """
+    Recompute ``hierarchy_path`` for every user, one tree level at a time.
+    Used to backfill existing data; normal saves keep paths up to date.
+    """
+    user_model = user_model or User
+    users = user_model._default_manager.db_manager(using)
+    users.filter(created_by__isnull=True).update(hierarchy_path='/')
+    
+    frontier = {pk: '/' for pk in users.filter(created_by__isnull=True).values_list('pk', flat=True)}
+    visited = set(frontier)
+    while frontier:
+        next_frontier = {}
+        children = users.filter(created_by_id__in=frontier).values_list('pk', 'created_by_id')
+        for pk, parent_id in children.iterator():
+            if pk in visited:
+                continue
+            visited.add(pk)
+            next_frontier[pk] = f'{frontier[parent_id]}{parent_id}/'
+        
+        by_path = {}
+        for pk, path in next_frontier.items():
+            by_path.setdefault(path, []).append(pk)
+        for path, pks in by_path.items():
+            users.filter(pk__in=pks).update(hierarchy_path=path)
+        frontier = next_frontier
+    return len(visited)
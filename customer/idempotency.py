@@ -0,0 +1,209 @@
+"""
+``Idempotency-Key`` handling for write endpoints that clients retry.
+
+The first request with a given key claims it by inserting an IdempotencyLock
+row, which is atomic on every database (unlike ``add`` on a file cache), runs
+the view and stores its response for ``TTL`` seconds. Retries with the same key
+and the same request get the stored response replayed, marked
+``Idempotent-Replayed: true``, without running authentication or the view
+again. A retry that arrives while the first request is still running waits up
+to ``WAIT`` seconds for its result and otherwise gets 409. Reusing a key for a
+different request gets 422. Server errors are not stored, so they can be retried.
+
+Credentials in a response (``IdempotentMixin.replay_redacted_fields``, e.g. the
+tokens issued at registration) are not stored; a replay gets fresh ones from
+``reissue_replay()``. Stored requests are identified by a keyed hash, so the
+cache holds no digest of the passwords they carried.
+
+Keys are scoped by a hash of the Authorization header, or by client address
+for anonymous requests. Clients behind one address share a scope, but a replay
+also needs the identical request body, credentials included.
+
+Settings (``IDEMPOTENCY``):
+    CACHE          cache alias holding responses; not the tiered 'default',
+                   whose local tier would miss responses stored by other workers
+    TTL            seconds a response can be replayed
+    LOCK_TIMEOUT   seconds an in-flight claim holds if its request dies
+    WAIT           seconds a concurrent retry waits for the in-flight result
+    POLL_INTERVAL  seconds between checks while waiting
+"""
+import functools
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+from django.views.decorators.csrf import csrf_exempt
+
+from .models import IdempotencyLock
+
+DEFAULTS = {
+    'CACHE': 'shared',
+    'TTL': 24 * 60 * 60,
+    'LOCK_TIMEOUT': 60,
+    'WAIT': 10.0,
+    'POLL_INTERVAL': 0.05,
+}
+
+HEADER = 'HTTP_IDEMPOTENCY_KEY'
+MAX_KEY_LENGTH = 255
+UNSAFE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+REPLAYED_HEADERS = ('Content-Type', 'Content-Language', 'Vary', 'Allow')
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'IDEMPOTENCY', {})}
+
+
+def client_scope(request):
+    authorization = request.META.get('HTTP_AUTHORIZATION')
+    if authorization:
+        return 'auth:' + hashlib.sha256(authorization.encode()).hexdigest()
+    return 'ip:' + request.META.get('REMOTE_ADDR', '')
+
+
+def make_cache_key(scope, key):
+    return 'idempotency:' + hashlib.sha256(f'{scope}\0{key}'.encode()).hexdigest()
+
+
+def fingerprint(request):
+    message = f'{request.method} {request.path}\n'.encode() + request.body
+    return salted_hmac('customer.idempotency', message, algorithm='sha256').hexdigest()
+
+
+def claim(cache_key, request_hash, timeout):
+    """Take the in-flight claim on a key; False while another request holds it"""
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=timeout)
+    try:
+        with transaction.atomic():
+            IdempotencyLock.objects.create(key=cache_key, fingerprint=request_hash, expires_at=expires_at)
+        return True
+    except IntegrityError:
+        # Take over the claim of a request that died
+        return IdempotencyLock.objects.filter(key=cache_key, expires_at__lte=now).update(
+            fingerprint=request_hash, expires_at=expires_at) > 0
+
+
+def release(cache_key):
+    IdempotencyLock.objects.filter(key=cache_key).delete()
+
+
+def dump_json(data):
+    # Same compact encoding as DRF's JSONRenderer
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def redact(content, fields):
+    """The JSON body without the given fields, or None if it has none of them"""
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not data.keys() & set(fields):
+        return None
+    return dump_json({name: value for name, value in data.items() if name not in fields})
+
+
+def error(status, message):
+    return JsonResponse({'error': message}, status=status)
+
+
+def replay(entry, reissue):
+    content = entry['content']
+    if entry.get('redacted'):
+        data = reissue(json.loads(content))
+        if data is None:
+            return error(410, 'The result of this Idempotency-Key is no longer available')
+        content = dump_json(data)
+    response = HttpResponse(content, status=entry['status'])
+    for header, value in entry['headers'].items():
+        response[header] = value
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view, redacted_fields=(), reissue=None):
+    """
+    Wrap a view function so unsafe requests honour an Idempotency-Key header.
+    ``redacted_fields`` are left out of stored responses and ``reissue(data)``
+    returns the replayed body with them filled in again.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.META.get(HEADER)
+        if not key or request.method not in UNSAFE_METHODS:
+            return view(request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return error(400, f'Idempotency-Key must be at most {MAX_KEY_LENGTH} characters')
+
+        config = get_config()
+        cache = caches[config['CACHE']]
+        cache_key = make_cache_key(client_scope(request), key)
+        request_hash = fingerprint(request)
+
+        deadline = time.monotonic() + config['WAIT']
+        while True:
+            entry = cache.get(cache_key)
+            if entry is not None:
+                if entry['fingerprint'] != request_hash:
+                    return error(422, 'Idempotency-Key was already used for a different request')
+                return replay(entry, reissue)
+            if claim(cache_key, request_hash, config['LOCK_TIMEOUT']):
+                break
+            holder = IdempotencyLock.objects.filter(key=cache_key).values_list('fingerprint', flat=True).first()
+            if holder is not None and holder != request_hash:
+                return error(422, 'Idempotency-Key was already used for a different request')
+            # In flight elsewhere; if it fails or its claim expires, run it here
+            if time.monotonic() >= deadline:
+                return error(409, 'A request with this Idempotency-Key is still in progress')
+            time.sleep(config['POLL_INTERVAL'])
+
+        try:
+            response = view(request, *args, **kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+        except BaseException:
+            release(cache_key)
+            raise
+
+        if response.status_code >= 500 or getattr(response, 'streaming', False):
+            release(cache_key)
+            return response
+        content = redact(response.content, redacted_fields) if redacted_fields else None
+        cache.set(cache_key, {
+            'fingerprint': request_hash,
+            'status': response.status_code,
+            'headers': {header: response[header] for header in REPLAYED_HEADERS if header in response},
+            'content': response.content if content is None else content,
+            'redacted': content is not None,
+        }, config['TTL'])
+        release(cache_key)
+        return response
+    return wrapper
+
+
+class IdempotentMixin:
+    """
+    Honour Idempotency-Key on the view's unsafe methods (see module docstring).
+    Replays are served before authentication, throttling and parsing run.
+    """
+    # Response fields that are not stored, such as issued tokens
+    replay_redacted_fields = ()
+
+    @classmethod
+    def reissue_replay(cls, data):
+        """Fill the redacted fields into a replayed body; None if that's no longer possible"""
+        return data
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = idempotent(super().as_view(**initkwargs), cls.replay_redacted_fields, cls.reissue_replay)
+        # APIView.as_view() marks the view csrf_exempt; keep that on the wrapper
+        return csrf_exempt(view)
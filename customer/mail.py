@@ -0,0 +1,185 @@
+"""
+Transactional email for bursts such as mass password resets.
+
+``CompiledEmail`` renders its template once per process with a placeholder
+for the per-recipient value, and keeps the HTML and the tag-stripped text
+split around it. Each email then joins the precomputed parts with the value
+instead of rendering the template and stripping its tags again. The template
+is rendered again when the year changes, for its ``{% now "Y" %}`` footer.
+
+``MailPool`` keeps a few connections of the configured ``EMAIL_BACKEND``
+open between sends, so a burst pays the SMTP handshake (EHLO, STARTTLS,
+AUTH) once per pooled connection rather than once per email. A connection
+idle for longer than ``IDLE_TIMEOUT`` is reopened before use, since servers
+drop idle clients, and a send that fails because the connection went away is
+retried on a fresh one.
+
+Settings (``EMAIL_POOL``):
+    SIZE          connections a process keeps open and sends on concurrently
+    IDLE_TIMEOUT  seconds idle after which a connection is reopened before use
+    RETRIES       sends retried on a fresh connection after a dropped one
+"""
+import atexit
+import logging
+import os
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.signals import setting_changed
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.html import escape, strip_tags
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'SIZE': 4,
+    'IDLE_TIMEOUT': 30.0,
+    'RETRIES': 1,
+}
+
+# Failures that mean the connection is gone, not that the message was refused
+RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+PLACEHOLDER = 'MAILPLACEHOLDER7Q3ZX'
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'EMAIL_POOL', {})}
+
+
+class CompiledEmail:
+    """A template rendered once, with one context variable filled in per email"""
+
+    def __init__(self, template_name, variable):
+        self.template_name = template_name
+        self.variable = variable
+        self._parts = None
+        self._year = None
+        self._lock = threading.Lock()
+
+    def render(self, value):
+        """(text, html) for ``value``; only the HTML escapes it"""
+        html_parts, text_parts = self._compiled()
+        return str(value).join(text_parts), escape(value).join(html_parts)
+
+    def _compiled(self):
+        year = timezone.now().year
+        if self._year != year:
+            with self._lock:
+                if self._year != year:
+                    html = render_to_string(self.template_name, {self.variable: PLACEHOLDER})
+                    self._parts = (html.split(PLACEHOLDER), strip_tags(html).split(PLACEHOLDER))
+                    self._year = year
+        return self._parts
+
+    def reset(self):
+        with self._lock:
+            self._year = None
+
+
+class MailPool:
+    """Open email backend connections, reused across sends"""
+
+    def __init__(self, size, idle_timeout, retries):
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        self.opened = 0
+        self._idle = []  # (connection, last_used), most recently used last
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def send(self, message):
+        """Send one message on a pooled connection; returns the number sent"""
+        with self._slots:
+            connection = self._checkout()
+            try:
+                for attempt in range(self.retries + 1):
+                    try:
+                        sent = connection.send_messages([message])
+                        break
+                    except RECONNECT_ERRORS as e:
+                        self._close(connection)
+                        if attempt == self.retries:
+                            raise
+                        logger.info(f"Email connection lost ({e!r}), reconnecting")
+                        connection = self._open()
+            except BaseException:
+                self._close(connection)
+                raise
+            self._checkin(connection)
+            return sent
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._close(connection)
+
+    def _checkout(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked: the sockets belong to the parent
+                self._idle, self._pid = [], os.getpid()
+            entry = self._idle.pop() if self._idle else None
+        if entry is not None:
+            connection, last_used = entry
+            if now - last_used <= self.idle_timeout:
+                return connection
+            self._close(connection)
+        return self._open()
+
+    def _checkin(self, connection):
+        with self._lock:
+            self._idle.append((connection, time.monotonic()))
+
+    def _open(self):
+        connection = get_connection(fail_silently=False)
+        connection.open()
+        self.opened += 1
+        return connection
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+otp_email = CompiledEmail('emails/otp_email.html', 'otp_code')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_mail_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                config = get_config()
+                _pool = MailPool(config['SIZE'], config['IDLE_TIMEOUT'], config['RETRIES'])
+                atexit.register(_pool.close)
+    return _pool
+
+
+def reset_mail(*, setting, **kwargs):
+    """Drop the pool and compiled templates when their settings change, e.g. under override_settings"""
+    global _pool
+    if setting == 'TEMPLATES':
+        otp_email.reset()
+    if not setting.startswith('EMAIL_'):
+        return
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            atexit.unregister(_pool.close)
+            _pool = None
+
+
+setting_changed.connect(reset_mail)
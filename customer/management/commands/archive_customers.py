@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from customer.archive import archive_customers, table_stats
+
+
+class Command(BaseCommand):
+    help = 'Move dormant customers out of the live user table into the archive table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--inactive-days', type=int, default=None,
+                            help='Archive customers without a login for this many days '
+                                 '(default: settings.ARCHIVE_INACTIVE_DAYS or 365)')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--pause', type=float, default=0.1,
+                            help='Seconds to sleep between batches (default: 0.1)')
+        parser.add_argument('--max-batches', type=int, default=None)
+        parser.add_argument('--stats', action='store_true',
+                            help='Only print hot/cold table statistics')
+
+    def handle(self, *args, **options):
+        if not options['stats']:
+            result = archive_customers(
+                inactive_days=options['inactive_days'],
+                batch_size=options['batch_size'],
+                pause=options['pause'],
+                max_batches=options['max_batches'],
+            )
+            self.stdout.write(self.style.SUCCESS(
+                f'Archived {result.archived} customers in {result.batches} batches ({result.elapsed:.2f}s)'
+            ))
+        for key, value in table_stats().items():
+            self.stdout.write(f'{key}: {value}')
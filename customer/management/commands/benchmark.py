@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from customer.benchmarks import SCENARIOS
+
+
+class Command(BaseCommand):
+    help = 'Run a performance benchmark scenario against the configured database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', nargs='?', help=f'One of: {", ".join(sorted(SCENARIOS))}')
+        parser.add_argument('--iterations', type=int, default=1000)
+        parser.add_argument('--email', help='Staff user to authenticate as (default: first staff user)')
+        parser.add_argument('--password', default='password',
+                            help='Password of that user, for login scenarios (default: password)')
+
+    def handle(self, *args, **options):
+        name = options['scenario']
+        if name not in SCENARIOS:
+            raise CommandError(f'Unknown scenario {name!r}; choose from: {", ".join(sorted(SCENARIOS))}')
+        SCENARIOS[name](self, options)
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from customer.webhooks import WebhookDispatcher
+
+
+class Command(BaseCommand):
+    help = 'Deliver pending user lifecycle events to the configured webhook endpoints.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Deliver one round of due events and exit')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to wait when there is nothing to deliver (default: 1)')
+
+    def handle(self, *args, **options):
+        dispatcher = WebhookDispatcher()
+        try:
+            while True:
+                delivered, failed = dispatcher.run_once()
+                if delivered or failed:
+                    self.stdout.write(f'Delivered {delivered} events, {failed} failed')
+                if options['once']:
+                    break
+                if not (delivered or failed):
+                    time.sleep(options['interval'])
+        finally:
+            dispatcher.close()
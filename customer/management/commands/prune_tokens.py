@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from customer.tokens import prune_expired_tokens
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete expired outstanding and blacklisted JWT refresh tokens in small batches. '
+        'Run it from cron, or keep it running with --every.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows deleted per transaction (default: 1000)')
+        parser.add_argument('--pause', type=float, default=0.1,
+                            help='Seconds to sleep between batches (default: 0.1)')
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help='Stop after this many batches')
+        parser.add_argument('--every', type=float, default=None,
+                            help='Repeat the pruning every N seconds instead of exiting')
+
+    def handle(self, *args, **options):
+        while True:
+            result = prune_expired_tokens(
+                batch_size=options['batch_size'],
+                pause=options['pause'],
+                max_batches=options['max_batches'],
+            )
+            self.stdout.write(self.style.SUCCESS(
+                f'Removed {result.outstanding_deleted} outstanding and '
+                f'{result.blacklisted_deleted} blacklisted tokens '
+                f'in {result.batches} batches ({result.elapsed:.2f}s)'
+            ))
+            if options['every'] is None:
+                break
+            time.sleep(options['every'])
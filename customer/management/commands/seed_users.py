@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+
+from customer.seeding import seed_users
+
+
+class Command(BaseCommand):
+    help = 'Generate synthetic customers, a staff hierarchy and outstanding tokens for benchmarks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=1000)
+        parser.add_argument('--admins', type=int, default=2)
+        parser.add_argument('--managers-per-admin', type=int, default=5)
+        parser.add_argument('--cashiers-per-manager', type=int, default=10)
+        parser.add_argument('--tokens', type=int, default=None,
+                            help='Outstanding refresh tokens to create '
+                                 '(default: one per staff member plus one per five customers)')
+        parser.add_argument('--dormant-fraction', type=float, default=0.2,
+                            help='Share of customers past the archive cutoff (default: 0.2)')
+        parser.add_argument('--expired-fraction', type=float, default=0.5,
+                            help='Share of tokens that have already expired (default: 0.5)')
+        parser.add_argument('--password', default='password',
+                            help='Password of every seeded user (default: password)')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=None, help='Random seed for repeatable data')
+
+    def handle(self, *args, **options):
+        result = seed_users(
+            customers=options['customers'],
+            admins=options['admins'],
+            managers_per_admin=options['managers_per_admin'],
+            cashiers_per_manager=options['cashiers_per_manager'],
+            tokens=options['tokens'],
+            dormant_fraction=options['dormant_fraction'],
+            expired_fraction=options['expired_fraction'],
+            password=options['password'],
+            batch_size=options['batch_size'],
+            seed=options['seed'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Seeded {result.customers} customers, {result.staff} staff and {result.tokens} '
+            f'outstanding tokens ({result.elapsed:.2f}s)'
+        ))
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from customer.hashing import get_config, tune, write_policy
+
+
+def role_target(value):
+    role, _, seconds = value.partition('=')
+    try:
+        return role, float(seconds)
+    except ValueError:
+        raise CommandError(f'Expected ROLE=SECONDS, got {value!r}')
+
+
+class Command(BaseCommand):
+    help = 'Time the available password hashers and write the per-role hashing policy.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', action='append', type=role_target, default=[],
+                            metavar='ROLE=SECONDS',
+                            help='Verification time for a role, e.g. cashier=0.05 '
+                                 '(default: settings.PASSWORD_POLICY["TARGETS"])')
+        parser.add_argument('--algorithms', default=None,
+                            help='Comma separated algorithms in order of preference '
+                                 '(default: argon2,scrypt,pbkdf2_sha256)')
+        parser.add_argument('--output', default=None,
+                            help='Policy file to write (default: settings.PASSWORD_POLICY["POLICY_FILE"])')
+        parser.add_argument('--dry-run', action='store_true', help='Print the policy without writing it')
+
+    def handle(self, *args, **options):
+        targets = dict(options['target']) or None
+        algorithms = options['algorithms'].split(',') if options['algorithms'] else None
+        try:
+            policy = tune(targets=targets, algorithms=algorithms)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        for role, entry in sorted(policy['roles'].items()):
+            params = ', '.join(f'{name}={value}' for name, value in entry['params'].items())
+            self.stdout.write(f'{role}: {entry["algorithm"]} ({params}) ~{entry["seconds"] * 1000:.0f}ms')
+        if options['dry_run']:
+            return
+        output = options['output'] or get_config()['POLICY_FILE']
+        if not output:
+            raise CommandError('No --output given and PASSWORD_POLICY["POLICY_FILE"] is None')
+        path = write_policy(policy, output)
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {path}; outdated hashes are upgraded on each user\'s next login'
+        ))
@@ -0,0 +1,344 @@
+"""
+In-process metrics in the Prometheus text format.
+
+Counters and fixed-bucket histograms keep their values in plain dicts keyed
+by label values, behind one short lock per metric. ``MetricsMiddleware``
+records request counts per resolved URL name, method and status, and request
+latency per URL name and method. The views record auth outcomes, OTPs and
+email failures. Collectors report the in-process caches, the tiers of the app
+cache and the audit log. Scrape collectors report database-wide values (the
+sizes of the hot and archived user tables); only the process serving the
+scrape runs them, so they are neither snapshotted nor summed over workers.
+
+With ``MULTIPROCESS_DIR`` set, every process writes its values as a JSON
+snapshot to that directory (at most every ``SNAPSHOT_INTERVAL`` seconds and at
+exit), and ``/metrics`` sums the snapshots of all prefork workers. Clear the
+directory when deploying.
+
+Settings (``METRICS``):
+    ENABLED            install the middleware and record request metrics
+    MULTIPROCESS_DIR   shared snapshot directory, or None for one process
+    SNAPSHOT_INTERVAL  seconds between snapshot writes of a process
+    ALLOWED_IPS        client addresses allowed to read /metrics
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import caches as app_caches
+from django.core.exceptions import MiddlewareNotUsed
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': True,
+    'MULTIPROCESS_DIR': None,
+    'SNAPSHOT_INTERVAL': 5.0,
+    'ALLOWED_IPS': ['127.0.0.1', '::1'],
+}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'METRICS', {})}
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def state(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Histogram:
+    """Per label set: a count per bucket (the last one is +Inf), the sum and the count"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def state(self):
+        with self._lock:
+            return [[list(key), list(counts)] for key, counts in self._values.items()]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self.scrape_collectors = []
+        self._pid = None
+        self._next_snapshot = 0.0
+        self._snapshot_lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def collector(self, func):
+        """Register a function returning [(name, kind, help, labelnames, [(labels, value)])]"""
+        self.collectors.append(func)
+        return func
+
+    def scrape_collector(self, func):
+        """Register a collector of values that are the same in every process, run once per scrape"""
+        self.scrape_collectors.append(func)
+        return func
+
+    def run_collectors(self, collectors, families):
+        for func in collectors:
+            try:
+                collected = func()
+            except Exception:
+                logger.exception(f"Metrics collector {func.__name__} failed")
+                continue
+            for name, kind, documentation, labelnames, samples in collected:
+                families[name] = {
+                    'kind': kind, 'help': documentation, 'labelnames': list(labelnames), 'buckets': [],
+                    'samples': [[list(labels), value] for labels, value in samples],
+                }
+        return families
+
+    def snapshot(self):
+        families = {
+            metric.name: {
+                'kind': metric.kind,
+                'help': metric.documentation,
+                'labelnames': list(metric.labelnames),
+                'buckets': list(getattr(metric, 'buckets', [])),
+                'samples': metric.state(),
+            }
+            for metric in self.metrics.values()
+        }
+        return self.run_collectors(self.collectors, families)
+
+    def write_snapshot(self, directory):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f'metrics-{os.getpid()}.json'
+        temporary = directory / f'metrics-{os.getpid()}-{threading.get_ident()}.tmp'
+        temporary.write_text(json.dumps(self.snapshot()), encoding='utf-8')
+        os.replace(temporary, path)
+
+    def maybe_write_snapshot(self, directory, interval):
+        now = time.monotonic()
+        if now < self._next_snapshot and self._pid == os.getpid():
+            return
+        with self._snapshot_lock:
+            if self._pid != os.getpid():
+                # First snapshot of this (possibly forked) process
+                self._pid = os.getpid()
+                atexit.register(self.write_snapshot, directory)
+            elif now < self._next_snapshot:
+                return
+            self._next_snapshot = now + interval
+            try:
+                self.write_snapshot(directory)
+            except OSError as e:
+                logger.warning(f"Could not write metrics snapshot: {e}")
+
+    def collect(self, directory=None):
+        """This process's families, or the sum over every process's snapshot, plus the scrape collectors"""
+        if not directory:
+            return self.run_collectors(self.scrape_collectors, self.snapshot())
+        self.write_snapshot(directory)
+        merged = {}
+        for path in Path(directory).glob('metrics-*.json'):
+            try:
+                families = json.loads(path.read_text(encoding='utf-8'))
+            except (OSError, ValueError):
+                continue
+            for name, family in families.items():
+                merge_family(merged.setdefault(name, {**family, 'samples': []}), family)
+        return self.run_collectors(self.scrape_collectors, merged)
+
+
+def merge_family(target, family):
+    samples = {tuple(labels): value for labels, value in target['samples']}
+    for labels, value in family['samples']:
+        key = tuple(labels)
+        if key not in samples:
+            samples[key] = value
+        elif isinstance(value, list):
+            samples[key] = [a + b for a, b in zip(samples[key], value)]
+        else:
+            samples[key] += value
+    target['samples'] = [[list(key), value] for key, value in samples.items()]
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def render(families):
+    """Families in the Prometheus text exposition format (version 0.0.4)"""
+    lines = []
+    for name, family in sorted(families.items()):
+        lines.append(f'# HELP {name} {family["help"]}')
+        lines.append(f'# TYPE {name} {family["kind"]}')
+        for labels, value in sorted(family['samples']):
+            if family['kind'] == 'histogram':
+                cumulative = 0
+                bounds = [str(bound) for bound in family['buckets']] + ['+Inf']
+                for bound, count in zip(bounds, value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(family["labelnames"], labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(family["labelnames"], labels)} {value[-2]}')
+                lines.append(f'{name}_count{format_labels(family["labelnames"], labels)} {value[-1]}')
+            else:
+                lines.append(f'{name}{format_labels(family["labelnames"], labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    'api_http_requests_total', 'HTTP requests by URL name, method and status.', ['route', 'method', 'status'],
+))
+http_request_duration = registry.register(Histogram(
+    'api_http_request_duration_seconds', 'HTTP request latency by URL name and method.', ['route', 'method'],
+))
+auth_attempts = registry.register(Counter(
+    'api_auth_attempts_total', 'Authentication attempts by mechanism and outcome.', ['mechanism', 'outcome'],
+))
+otp_issued = registry.register(Counter(
+    'api_otp_issued_total', 'Password reset OTPs issued.', ['user_type'],
+))
+emails_sent = registry.register(Counter(
+    'api_emails_sent_total', 'Emails sent.', ['template'],
+))
+email_failures = registry.register(Counter(
+    'api_email_failures_total', 'Emails that could not be sent.', ['template'],
+))
+password_rehashes = registry.register(Counter(
+    'api_password_rehashes_total', 'Password hash upgrades by outcome.', ['outcome'],
+))
+
+
+@registry.collector
+def cache_metrics():
+    from .authentication import api_key_cache, credential_cache
+    caches = {'credential': credential_cache.stats(), 'api_key': api_key_cache.stats()}
+    families = []
+    for stat, kind in (('hits', 'counter'), ('misses', 'counter'), ('evictions', 'counter'),
+                       ('expirations', 'counter'), ('entries', 'gauge')):
+        name = f'api_cache_{stat}_total' if kind == 'counter' else f'api_cache_{stat}'
+        families.append((name, kind, f'In-process cache {stat}.', ['cache'],
+                         [([cache], stats[stat]) for cache, stats in caches.items()]))
+
+    tiered = getattr(app_caches['default'], 'stats', None)
+    if tiered is not None:
+        stats = tiered()
+        families += [
+            ('api_app_cache_hits_total', 'counter', 'App cache hits per tier.', ['tier'],
+             [(['local'], stats['local_hits']), (['shared'], stats['shared_hits'])]),
+            ('api_app_cache_misses_total', 'counter', 'App cache misses per tier.', ['tier'],
+             [(['local'], stats['local_misses']), (['shared'], stats['shared_misses'])]),
+            ('api_app_cache_local_entries', 'gauge', 'Entries in the local tier of the app cache.',
+             [], [([], stats['local_entries'])]),
+            ('api_app_cache_local_evictions_total', 'counter', 'LRU evictions from the local tier.',
+             [], [([], stats['local_evictions'])]),
+            ('api_app_cache_invalidations_total', 'counter', 'Namespaces invalidated by this process.',
+             [], [([], stats['invalidations'])]),
+        ]
+    return families
+
+
+@registry.collector
+def audit_metrics():
+    from .audit import get_audit_log
+    audit_log = get_audit_log()
+    return [
+        ('api_audit_events_dropped_total', 'counter', 'Audit events dropped because the buffer was full.',
+         [], [([], audit_log.dropped)]),
+        ('api_audit_events_pending', 'gauge', 'Audit events waiting to be written.',
+         [], [([], len(audit_log.buffer))]),
+    ]
+
+
+@registry.scrape_collector
+def table_metrics():
+    from .archive import table_stats
+    stats = table_stats()
+    if 'users_rows_estimate' in stats:
+        rows = {table: stats[f'{table}_rows_estimate'] for table in ('users', 'archive')}
+        sizes = [([table, kind], stats[f'{table}_{kind}_bytes'])
+                 for table in ('users', 'archive') for kind in ('table', 'index')]
+    else:
+        rows = {'users': stats['hot_customers'] + stats['hot_staff'], 'archive': stats['archived_customers']}
+        sizes = []
+    families = [
+        ('api_table_rows', 'gauge', 'Rows of the hot user table and the customer archive (estimated on Postgres).',
+         ['table'], [([table], count) for table, count in rows.items()]),
+    ]
+    if sizes:
+        families.append(('api_table_bytes', 'gauge', 'On-disk size of the user tables and their indexes.',
+                         ['table', 'kind'], sizes))
+    return families
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        config = get_config()
+        if not config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.directory = config['MULTIPROCESS_DIR']
+        self.interval = config['SNAPSHOT_INTERVAL']
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = request.resolver_match
+        # Unresolved paths share one label so scanners can't blow up cardinality
+        route = (match.url_name or match.view_name) if match else 'unresolved'
+        http_requests.inc(route=route, method=request.method, status=response.status_code)
+        http_request_duration.observe(elapsed, route=route, method=request.method)
+        if self.directory:
+            registry.maybe_write_snapshot(self.directory, self.interval)
+        return response
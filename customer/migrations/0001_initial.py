@@ -0,0 +1,89 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:13
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='User',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('password', models.CharField(max_length=128, verbose_name='password')),
+                ('is_superuser', models.BooleanField(default=False, help_text='Designates that this user has all permissions without explicitly assigning them.', verbose_name='superuser status')),
+                ('email', models.EmailField(max_length=254, unique=True)),
+                ('name', models.CharField(max_length=255)),
+                ('is_active', models.BooleanField(default=True)),
+                ('is_staff', models.BooleanField(default=False)),
+                ('date_joined', models.DateTimeField(auto_now_add=True)),
+                ('last_login', models.DateTimeField(blank=True, null=True)),
+                ('user_type', models.CharField(choices=[('customer', 'Customer'), ('staff', 'Staff')], default='customer', max_length=10)),
+                ('phone_number', models.CharField(blank=True, max_length=20, null=True)),
+                ('address', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('otp_reset_code', models.CharField(blank=True, max_length=6, null=True)),
+                ('otp_reset_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='created_staff', to=settings.AUTH_USER_MODEL)),
+                ('groups', models.ManyToManyField(blank=True, help_text='The groups this user belongs to. A user will get all permissions granted to each of their groups.', related_name='user_set', related_query_name='user', to='auth.group', verbose_name='groups')),
+                ('user_permissions', models.ManyToManyField(blank=True, help_text='Specific permissions for this user.', related_name='user_set', related_query_name='user', to='auth.permission', verbose_name='user permissions')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Customer',
+            fields=[
+            ],
+            options={
+                'verbose_name': 'Customer',
+                'verbose_name_plural': 'Customers',
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('customer.user',),
+        ),
+        migrations.CreateModel(
+            name='Staff',
+            fields=[
+            ],
+            options={
+                'verbose_name': 'Staff',
+                'verbose_name_plural': 'Staff',
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('customer.user',),
+        ),
+        migrations.CreateModel(
+            name='UserRole',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(choices=[('admin', 'Admin'), ('manager', 'Manager'), ('cashier', 'Cashier')], max_length=20, unique=True)),
+                ('description', models.TextField(blank=True)),
+                ('permissions', models.JSONField(default=dict)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='customer.userrole')),
+            ],
+            options={
+                'verbose_name': 'User Role',
+                'verbose_name_plural': 'User Roles',
+            },
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='role',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='staff_users', to='customer.userrole'),
+        ),
+    ]
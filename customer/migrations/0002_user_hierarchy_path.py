@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:14
+
+from django.db import migrations, models
+
+
+def backfill_hierarchy_paths(apps, schema_editor):
+    from customer.hierarchy import rebuild_hierarchy_paths
+    rebuild_hierarchy_paths(apps.get_model('customer', 'User'), using=schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customer', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='hierarchy_path',
+            field=models.CharField(db_index=True, default='/', editable=False, max_length=255),
+        ),
+        migrations.RunPython(backfill_hierarchy_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:16
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customer', '0002_user_hierarchy_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('staff.create', 'Staff created'), ('staff.update', 'Staff updated'), ('staff.delete', 'Staff deleted'), ('role.update', 'Role updated'), ('role.delete', 'Role deleted')], max_length=32)),
+                ('actor_id', models.BigIntegerField(blank=True, null=True)),
+                ('target_type', models.CharField(blank=True, max_length=32)),
+                ('target_id', models.BigIntegerField(blank=True, null=True)),
+                ('changes', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Audit Event',
+                'verbose_name_plural': 'Audit Events',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['created_at'], name='audit_created_at_idx'), models.Index(fields=['actor_id', 'created_at'], name='audit_actor_created_at_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:18
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customer', '0003_auditevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedCustomer',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('email', models.EmailField(max_length=254, unique=True)),
+                ('name', models.CharField(max_length=255)),
+                ('password', models.CharField(max_length=128)),
+                ('is_active', models.BooleanField(default=True)),
+                ('date_joined', models.DateTimeField()),
+                ('last_login', models.DateTimeField(blank=True, null=True)),
+                ('phone_number', models.CharField(blank=True, max_length=20, null=True)),
+                ('address', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Archived Customer',
+                'verbose_name_plural': 'Archived Customers',
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:19
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('customer', '0004_archivedcustomer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserDeletion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.BigIntegerField()),
+                ('user_type', models.CharField(choices=[('customer', 'Customer'), ('staff', 'Staff')], max_length=10)),
+                ('deleted_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'User Deletion',
+                'verbose_name_plural': 'User Deletions',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['updated_at', 'id'], name='user_updated_at_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userdeletion',
+            index=models.Index(fields=['deleted_at', 'id'], name='userdeletion_deleted_at_id_idx'),
+        ),
+    ]
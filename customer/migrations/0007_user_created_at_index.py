@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('customer', '0006_webhooks'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['created_at', 'id'], name='user_created_at_id_idx'),
+        ),
+    ]
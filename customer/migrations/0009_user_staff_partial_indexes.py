@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('customer', '0008_apikey'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(condition=models.Q(('user_type', 'staff')), fields=['email'], name='user_staff_email_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(condition=models.Q(('is_staff', True)), fields=['id'], name='user_staff_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(condition=models.Q(('is_staff', True)), fields=['hierarchy_path'], name='user_staff_path_idx', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
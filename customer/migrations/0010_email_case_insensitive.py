@@ -0,0 +1,76 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:49
+
+import django.db.models.functions.text
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import Lower
+
+# Colliding emails listed per table before giving up
+REPORT_LIMIT = 50
+
+
+def report_case_collisions(apps, schema_editor):
+    """
+    Refuse to add the case-insensitive unique constraints while emails that
+    differ only in case exist, and list them so the accounts can be merged or
+    renamed first.
+    """
+    using = schema_editor.connection.alias
+    report = []
+    for model_name in ('User', 'ArchivedCustomer'):
+        rows = apps.get_model('customer', model_name).objects.using(using).annotate(email_lower=Lower('email'))
+        colliding = (
+            rows.values('email_lower').annotate(count=Count('id')).filter(count__gt=1).order_by('email_lower')
+        )
+        total = colliding.count()
+        if not total:
+            continue
+        report.append(f'{model_name}: {total} emails collide when compared case-insensitively')
+        for group in colliding[:REPORT_LIMIT]:
+            accounts = rows.filter(email_lower=group['email_lower']).order_by('id').values_list('id', 'email')
+            report.append('  ' + ', '.join(f'{email} (id {pk})' for pk, email in accounts))
+        if total > REPORT_LIMIT:
+            report.append(f'  ... and {total - REPORT_LIMIT} more')
+    if report:
+        raise RuntimeError(
+            'Cannot make emails case-insensitively unique; resolve these duplicates first:\n' + '\n'.join(report)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('customer', '0009_user_staff_partial_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(report_case_collisions, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='user',
+            name='user_staff_email_idx',
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(django.db.models.functions.text.Lower('email'), condition=models.Q(('user_type', 'staff')), name='user_staff_email_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='archivedcustomer',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('email'), name='archivedcustomer_email_ci_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='user',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('email'), name='user_email_ci_unique'),
+        ),
+        # The Lower(email) constraints replace the case-sensitive unique indexes
+        migrations.AlterField(
+            model_name='archivedcustomer',
+            name='email',
+            field=models.EmailField(max_length=254),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='email',
+            field=models.EmailField(max_length=254),
+        ),
+    ]
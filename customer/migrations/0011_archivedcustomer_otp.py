@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 20:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customer', '0010_email_case_insensitive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedcustomer',
+            name='otp_reset_code',
+            field=models.CharField(blank=True, max_length=6, null=True),
+        ),
+        migrations.AddField(
+            model_name='archivedcustomer',
+            name='otp_reset_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-19 20:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customer', '0011_archivedcustomer_otp'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyLock',
+            fields=[
+                ('key', models.CharField(max_length=80, primary_key=True, serialize=False)),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('expires_at', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name': 'Idempotency Lock',
+                'verbose_name_plural': 'Idempotency Locks',
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    Index the expiry of simplejwt's outstanding tokens, which token pruning
+    (customer/tokens.py) walks. The model belongs to token_blacklist, so the
+    index is created with SQL rather than AddIndex.
+    """
+
+    dependencies = [
+        ('customer', '0012_idempotencylock'),
+        ('token_blacklist', '0013_alter_blacklistedtoken_options_and_more'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX outstandingtoken_expires_at_idx '
+            'ON token_blacklist_outstandingtoken (expires_at, id)',
+            reverse_sql='DROP INDEX outstandingtoken_expires_at_idx',
+        ),
+    ]
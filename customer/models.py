@@ -1,11 +1,13 @@
 import logging
 from django.db import models
+from django.db.models.functions import Lower
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.utils.translation import gettext_lazy as _
 import random
 import string
 from django.utils import timezone
 from datetime import timedelta
+from django.core.exceptions import ValidationError
 from django.core.validators import MinLengthValidator
 
 # Set up logging
@@ -51,7 +53,52 @@ class UserRole(models.Model):
         """Get list of roles that can be created by the given role"""
         return cls.ROLE_HIERARCHY.get(user_role, [])
 
-class CustomUserManager(BaseUserManager):
+    @classmethod
+    def cached_by_id(cls):
+        """All roles by primary key, from the app cache; signals evict it on any role change"""
+        from .caching import cached
+        return cached('roles:all', cls.objects.in_bulk, timeout=300)
+
+class EmailQuerySet(models.QuerySet):
+    """
+    Case-insensitive email identity. Both sides go through the database's
+    LOWER(), so the lookup is one probe of the Lower(email) unique index.
+    """
+    def with_email(self, email):
+        return self.alias(email_lower=Lower('email')).filter(email_lower=Lower(models.Value(email)))
+    
+    def with_emails(self, emails):
+        return self.alias(email_lower=Lower('email')).filter(
+            email_lower__in=[Lower(models.Value(email)) for email in emails]
+        )
+    
+    def get_by_email(self, email):
+        return self.with_email(email).get()
+
+class UserQuerySet(EmailQuerySet):
+    def subtree_of(self, user, include_self=False):
+        """Users created (directly or transitively) by the given user"""
+        queryset = self.filter(hierarchy_path__startswith=user.subtree_prefix)
+        if include_self:
+            queryset = queryset | self.filter(pk=user.pk)
+        return queryset
+
+    def ancestors_of(self, user):
+        """Creator chain of the given user, ordered from the root down"""
+        ids = user.ancestor_ids
+        if not ids:
+            return self.none()
+        depth = models.Case(
+            *[models.When(pk=pk, then=models.Value(level)) for level, pk in enumerate(ids)],
+            output_field=models.IntegerField(),
+        )
+        return self.filter(pk__in=ids).order_by(depth)
+
+class CustomUserManager(BaseUserManager.from_queryset(UserQuerySet)):
+    def get_by_natural_key(self, username):
+        # Authentication backends and token views match emails case-insensitively too
+        return self.get_by_email(username)
+    
     def create_user(self, email, password=None, **extra_fields):
         """
         Create and save a user with the given email and password.
@@ -120,13 +167,64 @@ class CustomUserManager(BaseUserManager):
         extra_fields['role'] = admin_role
         return self.create_staff_user(email, password, **extra_fields)
 
-class User(AbstractBaseUser, PermissionsMixin):
+class DirtyFieldsMixin:
+    """
+    Remembers the values a row was loaded with, so a plain save() only writes
+    the columns that changed (plus auto_now fields) and is skipped entirely
+    when nothing changed. Explicit update_fields and inserts are untouched.
+    """
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._snapshot_fields()
+        return instance
+    
+    def _snapshot_fields(self, fields=None):
+        loaded = self.__dict__.setdefault('_loaded_values', {})
+        for field in self._meta.concrete_fields:
+            if (fields is None or field.name in fields or field.attname in fields) and field.attname in self.__dict__:
+                loaded[field.attname] = self.__dict__[field.attname]
+    
+    def get_dirty_fields(self):
+        """Names of loaded fields whose value differs from the database row"""
+        loaded = self.__dict__.get('_loaded_values', {})
+        return [
+            field.name for field in self._meta.concrete_fields
+            if not field.primary_key
+            and field.attname in loaded
+            and self.__dict__.get(field.attname) != loaded[field.attname]
+        ]
+    
+    def save(self, *args, **kwargs):
+        narrowable = (
+            not args
+            and not self._state.adding
+            and kwargs.get('update_fields') is None
+            and not kwargs.get('force_insert')
+            and '_loaded_values' in self.__dict__
+        )
+        if narrowable:
+            dirty = self.get_dirty_fields()
+            if not dirty:
+                return
+            auto_now = [field.name for field in self._meta.concrete_fields if getattr(field, 'auto_now', False)]
+            kwargs['update_fields'] = dirty + [name for name in auto_now if name not in dirty]
+        
+        super().save(*args, **kwargs)
+        self._snapshot_fields(kwargs.get('update_fields'))
+    
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        self._snapshot_fields(fields)
+
+class User(DirtyFieldsMixin, AbstractBaseUser, PermissionsMixin):
     USER_TYPE_CHOICES = [
         ('customer', 'Customer'),
         ('staff', 'Staff'),
     ]
     
-    email = models.EmailField(unique=True)
+    # Unique case-insensitively, through user_email_ci_unique
+    email = models.EmailField()
     name = models.CharField(max_length=255)
     is_active = models.BooleanField(default=True)
     is_staff = models.BooleanField(default=False)  # Staff users only
@@ -137,6 +235,8 @@ class User(AbstractBaseUser, PermissionsMixin):
     # Staff-specific fields
     role = models.ForeignKey(UserRole, on_delete=models.SET_NULL, null=True, blank=True, related_name='staff_users')
     created_by = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='created_staff')
+    # Materialized path of creator ids from the root down, e.g. "/1/5/"
+    hierarchy_path = models.CharField(max_length=255, default='/', db_index=True, editable=False)
     
     # Customer-specific fields
     phone_number = models.CharField(max_length=20, blank=True, null=True)
@@ -151,9 +251,94 @@ class User(AbstractBaseUser, PermissionsMixin):
     
     objects = CustomUserManager()
     
+    class Meta:
+        constraints = [
+            # Emails are unique regardless of case; also serves every login lookup
+            models.UniqueConstraint(Lower('email'), name='user_email_ci_unique'),
+        ]
+        indexes = [
+            # Keyset pagination of the change feed
+            models.Index(fields=['updated_at', 'id'], name='user_updated_at_id_idx'),
+            # Default admin changelist ordering (-created_at, -pk)
+            models.Index(fields=['created_at', 'id'], name='user_created_at_id_idx'),
+            # Staff are a tiny share of the rows. These partial indexes only
+            # hold staff, so staff logins, listings and subtree scans stay off
+            # the customer pages.
+            models.Index(Lower('email'), condition=models.Q(user_type='staff'), name='user_staff_email_idx'),
+            models.Index(fields=['id'], condition=models.Q(is_staff=True), name='user_staff_id_idx'),
+            models.Index(
+                fields=['hierarchy_path'], opclasses=['varchar_pattern_ops'],
+                condition=models.Q(is_staff=True), name='user_staff_path_idx',
+            ),
+        ]
+    
     def __str__(self):
         return self.email
     
+    def set_password(self, raw_password):
+        # Hash with the role's policy (see customer/hashing.py)
+        from .hashing import hash_user_password
+        self.password = hash_user_password(self, raw_password)
+        self._password = raw_password
+    
+    def check_password(self, raw_password):
+        # Outdated hashes are upgraded in the background, not inline
+        from .hashing import check_user_password
+        return check_user_password(self, raw_password)
+    
+    def save(self, *args, **kwargs):
+        moved_from = self._sync_hierarchy_path(kwargs)
+        super().save(*args, **kwargs)
+        if moved_from is not None:
+            # Re-root every descendant under the new path in one UPDATE
+            from .hierarchy import move_subtree
+            move_subtree(f'{moved_from}{self.pk}/', self.subtree_prefix, using=kwargs.get('using'))
+    
+    def _sync_hierarchy_path(self, save_kwargs):
+        """
+        Recompute hierarchy_path when created_by changed.
+        Returns the previous path when existing descendants need re-rooting.
+        """
+        update_fields = save_kwargs.get('update_fields')
+        if update_fields is not None and 'created_by' not in update_fields:
+            return None
+        
+        ancestor_ids = self.ancestor_ids
+        current_parent = ancestor_ids[-1] if ancestor_ids else None
+        if current_parent == self.created_by_id:
+            return None
+        
+        self._check_creator_cycle()
+        
+        old_path = self.hierarchy_path
+        if self.created_by_id is None:
+            self.hierarchy_path = '/'
+        else:
+            self.hierarchy_path = self.created_by.subtree_prefix
+        if update_fields is not None:
+            save_kwargs['update_fields'] = list(update_fields) + ['hierarchy_path']
+        return old_path if self.pk else None
+    
+    def _check_creator_cycle(self):
+        """A user's creator may not be the user or anyone below them"""
+        if self.pk is not None and self.created_by_id is not None and (
+            self.created_by_id == self.pk or self.pk in self.created_by.ancestor_ids
+        ):
+            raise ValidationError({'created_by': 'A user cannot be created by themselves or their own reports.'})
+    
+    def clean(self):
+        super().clean()
+        self._check_creator_cycle()
+    
+    @property
+    def subtree_prefix(self):
+        """Path prefix shared by every user below this one"""
+        return f'{self.hierarchy_path}{self.pk}/'
+    
+    @property
+    def ancestor_ids(self):
+        return [int(pk) for pk in self.hierarchy_path.strip('/').split('/') if pk]
+    
     @property
     def is_admin(self):
         return self.role and self.role.role == 'admin'
@@ -186,7 +371,9 @@ class User(AbstractBaseUser, PermissionsMixin):
         
         # Send the OTP via email
         from .utils import send_otp_email
+        from .metrics import otp_issued
         send_otp_email(self.email, self.otp_reset_code)
+        otp_issued.inc(user_type=self.user_type)
         
         return self.otp_reset_code
     
@@ -275,4 +462,241 @@ class Staff(User):
         """Clear the OTP after successful password reset"""
         self.otp_reset_code = None
         self.otp_reset_expires_at = None
+        # Only changed columns are written (see DirtyFieldsMixin)
+        self.save()
+
+class AuditEventQuerySet(models.QuerySet):
+    def between(self, start=None, end=None):
+        queryset = self
+        if start is not None:
+            queryset = queryset.filter(created_at__gte=start)
+        if end is not None:
+            queryset = queryset.filter(created_at__lt=end)
+        return queryset
+    
+    def by_actor(self, actor):
+        return self.filter(actor_id=getattr(actor, 'pk', actor))
+
+class AuditEvent(models.Model):
+    """
+    Append-only record of a staff management action.
+    Rows are written in batches by customer.audit, never from the request path.
+    """
+    ACTION_CHOICES = [
+        ('staff.create', 'Staff created'),
+        ('staff.update', 'Staff updated'),
+        ('staff.delete', 'Staff deleted'),
+        ('role.update', 'Role updated'),
+        ('role.delete', 'Role deleted'),
+    ]
+    
+    action = models.CharField(max_length=32, choices=ACTION_CHOICES)
+    # Plain ids rather than foreign keys: events must outlive the rows they describe
+    actor_id = models.BigIntegerField(null=True, blank=True)
+    target_type = models.CharField(max_length=32, blank=True)
+    target_id = models.BigIntegerField(null=True, blank=True)
+    changes = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    
+    objects = AuditEventQuerySet.as_manager()
+    
+    class Meta:
+        verbose_name = 'Audit Event'
+        verbose_name_plural = 'Audit Events'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at'], name='audit_created_at_idx'),
+            models.Index(fields=['actor_id', 'created_at'], name='audit_actor_created_at_idx'),
+        ]
+    
+    def __str__(self):
+        return f'{self.action} by {self.actor_id} at {self.created_at:%Y-%m-%d %H:%M:%S}'
+
+class ArchivedCustomer(models.Model):
+    """
+    Cold storage for dormant customers moved out of the live user table.
+    The original user id is kept so a rehydrated customer gets it back.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    # Unique case-insensitively, through archivedcustomer_email_ci_unique
+    email = models.EmailField()
+    name = models.CharField(max_length=255)
+    password = models.CharField(max_length=128)
+    is_active = models.BooleanField(default=True)
+    date_joined = models.DateTimeField()
+    last_login = models.DateTimeField(null=True, blank=True)
+    phone_number = models.CharField(max_length=20, blank=True, null=True)
+    address = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(default=timezone.now)
+    # A password reset requested while archived; the row is only moved back once it is used
+    otp_reset_code = models.CharField(max_length=6, null=True, blank=True)
+    otp_reset_expires_at = models.DateTimeField(null=True, blank=True)
+    
+    # Fields copied verbatim between User and ArchivedCustomer
+    COPIED_FIELDS = [
+        'id', 'email', 'name', 'password', 'is_active', 'date_joined',
+        'last_login', 'phone_number', 'address', 'created_at',
+    ]
+    
+    objects = EmailQuerySet.as_manager()
+    
+    class Meta:
+        verbose_name = 'Archived Customer'
+        verbose_name_plural = 'Archived Customers'
+        constraints = [
+            models.UniqueConstraint(Lower('email'), name='archivedcustomer_email_ci_unique'),
+        ]
+    
+    def __str__(self):
+        return self.email
+    
+    def check_password(self, raw_password):
+        from django.contrib.auth.hashers import check_password
+        return check_password(raw_password, self.password)
+    
+    def generate_otp(self):
+        self.otp_reset_code = ''.join(random.choices(string.digits, k=6))
+        self.otp_reset_expires_at = timezone.now() + timedelta(minutes=15)
         self.save(update_fields=['otp_reset_code', 'otp_reset_expires_at'])
+        
+        from .utils import send_otp_email
+        from .metrics import otp_issued
+        send_otp_email(self.email, self.otp_reset_code)
+        otp_issued.inc(user_type='customer')
+        
+        return self.otp_reset_code
+    
+    def is_otp_valid(self, otp):
+        if not self.otp_reset_code or not self.otp_reset_expires_at:
+            return False
+        return self.otp_reset_code == otp and timezone.now() < self.otp_reset_expires_at
+
+class UserDeletion(models.Model):
+    """
+    Tombstone for a deleted user, served by the change feed so downstream
+    copies can drop the row. Populated from post_delete.
+    """
+    user_id = models.BigIntegerField()
+    user_type = models.CharField(max_length=10, choices=User.USER_TYPE_CHOICES)
+    deleted_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        verbose_name = 'User Deletion'
+        verbose_name_plural = 'User Deletions'
+        indexes = [
+            models.Index(fields=['deleted_at', 'id'], name='userdeletion_deleted_at_id_idx'),
+        ]
+    
+    def __str__(self):
+        return f'{self.user_type} {self.user_id} deleted at {self.deleted_at}'
+
+class OutboxEvent(models.Model):
+    """
+    User lifecycle event waiting to be delivered to webhook endpoints.
+    Written in the same transaction as the change it describes.
+    """
+    event_type = models.CharField(max_length=64)
+    payload = models.JSONField(default=dict)
+    created_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        verbose_name = 'Outbox Event'
+        verbose_name_plural = 'Outbox Events'
+    
+    def __str__(self):
+        return f'{self.event_type} #{self.pk}'
+
+class WebhookDelivery(models.Model):
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('delivered', 'Delivered'),
+        ('failed', 'Failed'),
+    ]
+    
+    event = models.ForeignKey(OutboxEvent, on_delete=models.CASCADE, related_name='deliveries')
+    endpoint = models.URLField(max_length=500)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    
+    class Meta:
+        verbose_name = 'Webhook Delivery'
+        verbose_name_plural = 'Webhook Deliveries'
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='webhook_due_idx'),
+        ]
+    
+    def __str__(self):
+        return f'{self.event} -> {self.endpoint} ({self.status})'
+
+class ApiKey(models.Model):
+    """
+    Long-lived credential for machine clients, bound to a user.
+
+    The key handed out is "<prefix>.<secret>". Only the prefix (unique,
+    indexed) and a keyed SHA-256 of the secret are stored, so a lookup is a
+    single index probe and verification is a cheap HMAC rather than PBKDF2.
+    Scopes narrow the permissions of the user's role.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='api_keys')
+    name = models.CharField(max_length=100)
+    prefix = models.CharField(max_length=16, unique=True, editable=False)
+    key_hash = models.CharField(max_length=64, editable=False)
+    scopes = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+    revoked_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        verbose_name = 'API Key'
+        verbose_name_plural = 'API Keys'
+    
+    def __str__(self):
+        return f'{self.name} ({self.prefix})'
+    
+    @staticmethod
+    def hash_secret(secret):
+        from django.utils.crypto import salted_hmac
+        return salted_hmac('customer.ApiKey', secret, algorithm='sha256').hexdigest()
+    
+    @classmethod
+    def generate(cls, user, name, scopes=(), expires_at=None):
+        """Create a key and return (api_key, raw_key); the raw key is not stored"""
+        import secrets
+        prefix = secrets.token_hex(6)
+        secret = secrets.token_urlsafe(32)
+        api_key = cls.objects.create(
+            user=user,
+            name=name,
+            prefix=prefix,
+            key_hash=cls.hash_secret(secret),
+            scopes=list(scopes),
+            expires_at=expires_at,
+        )
+        return api_key, f'{prefix}.{secret}'
+    
+    @property
+    def is_usable(self):
+        if self.revoked_at is not None:
+            return False
+        return self.expires_at is None or self.expires_at > timezone.now()
+
+class IdempotencyLock(models.Model):
+    """
+    In-flight claim on an Idempotency-Key (see customer/idempotency.py).
+    Inserting the row is the atomic test-and-set that lets one of several
+    concurrent duplicates run; it is deleted once the response is stored.
+    """
+    key = models.CharField(max_length=80, primary_key=True)
+    fingerprint = models.CharField(max_length=64)
+    expires_at = models.DateTimeField()
+    
+    class Meta:
+        verbose_name = 'Idempotency Lock'
+        verbose_name_plural = 'Idempotency Locks'
+    
+    def __str__(self):
+        return f'{self.key} until {self.expires_at}'
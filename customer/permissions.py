@@ -1,45 +1,69 @@
 from rest_framework import permissions
-from .models import UserRole
+from .authorization import get_auth_context, request_action
 
-class IsSuperUser(permissions.BasePermission):
+class ScopedPermission(permissions.BasePermission):
+    """
+    Base of the permissions that check an API key's scopes.
+    IsAuthenticated rejects API keys on views without one of them.
+    """
+
+def checks_scopes(permission):
+    # Permissions combined with | or & keep their operands as op1/op2
+    operands = [getattr(permission, name) for name in ('op1', 'op2') if hasattr(permission, name)]
+    return isinstance(permission, ScopedPermission) or any(checks_scopes(operand) for operand in operands)
+
+class IsAuthenticated(permissions.IsAuthenticated):
+    """
+    DRF's IsAuthenticated, except that API keys are denied unless another of
+    the view's permissions checks their scopes
+    """
+    def has_permission(self, request, view):
+        if not super().has_permission(request, view):
+            return False
+        if not get_auth_context(request).scoped:
+            return True
+        return any(checks_scopes(permission) for permission in view.get_permissions())
+
+class IsSuperUser(ScopedPermission):
+    def has_permission(self, request, view):
+        context = get_auth_context(request)
+        return context.is_superuser and context.allows(request_action(request, view))
+
+class IsStaffUser(ScopedPermission):
     def has_permission(self, request, view):
-        return bool(request.user and request.user.is_superuser)
+        context = get_auth_context(request)
+        return context.is_staff and context.allows(request_action(request, view))
 
-class IsAdminUser(permissions.BasePermission):
+class IsAdminUser(ScopedPermission):
     def has_permission(self, request, view):
-        return bool(request.user and 
-                   request.user.is_staff and 
-                   request.user.role and 
-                   request.user.role.role == 'admin')
+        context = get_auth_context(request)
+        return context.is_admin and context.allows(request_action(request, view))
 
-class IsManagerUser(permissions.BasePermission):
+class IsManagerUser(ScopedPermission):
     def has_permission(self, request, view):
-        return bool(request.user and 
-                   request.user.is_staff and 
-                   request.user.role and 
-                   request.user.role.role == 'manager')
+        context = get_auth_context(request)
+        return context.is_manager and context.allows(request_action(request, view))
 
-class IsCashierUser(permissions.BasePermission):
+class IsCashierUser(ScopedPermission):
     def has_permission(self, request, view):
-        return bool(request.user and 
-                   request.user.is_staff and 
-                   request.user.role and 
-                   request.user.role.role == 'cashier')
+        context = get_auth_context(request)
+        return context.is_cashier and context.allows(request_action(request, view))
 
-class CanCreateStaff(permissions.BasePermission):
+class CanCreateStaff(ScopedPermission):
     """
     Permission to check if user can create staff members with specific roles
     """
     def has_permission(self, request, view):
-        if not request.user or not request.user.is_staff:
+        context = get_auth_context(request)
+        if not context.is_staff or not context.allows(request_action(request, view)):
             return False
             
-        # Superuser can create any role
-        if request.user.is_superuser:
+        # Superuser can create any role (an API key only those it is scoped to)
+        if context.is_superuser and not context.scoped:
             return True
             
         # Regular users can't create staff
-        if not request.user.role:
+        if not context.role:
             return False
             
         # Check if user can create the requested role
@@ -47,4 +71,11 @@ class CanCreateStaff(permissions.BasePermission):
         if not role_to_create:
             return False
             
-        return role_to_create in UserRole.ROLE_HIERARCHY.get(request.user.role.role, [])
+        return context.can_create(role_to_create)
+
+class IsNotApiKey(ScopedPermission):
+    """
+    Rejects requests authenticated with an API key
+    """
+    def has_permission(self, request, view):
+        return not get_auth_context(request).scoped
@@ -0,0 +1,195 @@
+"""
+Opt-in request profiler.
+
+``ProfilingMiddleware`` profiles a random ``SAMPLE_RATE`` share of requests
+plus any request carrying a valid signed ``X-Profile`` header, which staff
+users obtain from ``POST /api/user/profile-token/``. Every other request pays
+for one header lookup and one random number, so the middleware can stay
+installed. When ``ENABLED`` is false Django drops it from the chain entirely.
+
+Each profile is written to ``DIRECTORY`` as either a pstats dump (``cprofile``
+mode) or a collapsed-stack file for flamegraph tools (``sampling`` mode). The
+file name carries the view name, duration and query count, and only the
+newest ``MAX_FILES`` profiles are kept.
+
+Settings (``PROFILING``):
+    ENABLED          install the middleware at all
+    MODE             'cprofile' or 'sampling'
+    SAMPLE_RATE      share of requests profiled without a header (0.0 - 1.0)
+    SAMPLE_INTERVAL  seconds between stack samples in sampling mode
+    DIRECTORY        where profiles are written
+    MAX_FILES        profiles kept before the oldest are removed
+    TOKEN_MAX_AGE    seconds a signed profiling token stays valid
+"""
+import cProfile
+import logging
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': False,
+    'MODE': 'sampling',
+    'SAMPLE_RATE': 0.0,
+    'SAMPLE_INTERVAL': 0.005,
+    'DIRECTORY': 'profiles',
+    'MAX_FILES': 200,
+    'TOKEN_MAX_AGE': 3600,
+}
+
+HEADER = 'HTTP_X_PROFILE'
+TOKEN_SALT = 'customer.profiling'
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'PROFILING', {})}
+
+
+def make_profile_token(user):
+    """Signed value of the X-Profile header for a staff user"""
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign(str(user.pk))
+
+
+def read_profile_token(token, max_age):
+    """The user id a token was issued to, or None if it is invalid or expired"""
+    try:
+        return int(signing.TimestampSigner(salt=TOKEN_SALT).unsign(token, max_age=max_age))
+    except (signing.BadSignature, ValueError):
+        return None
+
+
+class StackSampler:
+    """Statistical profiler: samples one thread's stack at a fixed interval"""
+    extension = 'collapsed'
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self._thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def dump(self, path):
+        # One "frame;frame;frame count" line per stack, as flamegraph.pl expects
+        with open(path, 'w', encoding='utf-8') as handle:
+            handle.writelines(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class DeterministicProfiler:
+    extension = 'pstats'
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def dump(self, path):
+        self.profile.dump_stats(path)
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        config = get_config()
+        if not config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.mode = config['MODE']
+        self.sample_rate = config['SAMPLE_RATE']
+        self.sample_interval = config['SAMPLE_INTERVAL']
+        self.directory = Path(config['DIRECTORY'])
+        self.max_files = config['MAX_FILES']
+        self.token_max_age = config['TOKEN_MAX_AGE']
+
+    def __call__(self, request):
+        token = request.META.get(HEADER)
+        if token is None and (not self.sample_rate or random.random() >= self.sample_rate):
+            return self.get_response(request)
+
+        requested_by = read_profile_token(token, self.token_max_age) if token else None
+        if token and requested_by is None:
+            logger.warning("Ignoring invalid or expired profiling token")
+            return self.get_response(request)
+        return self.profile(request, requested_by)
+
+    def profile(self, request, requested_by=None):
+        if self.mode == 'cprofile':
+            profiler = DeterministicProfiler()
+        else:
+            profiler = StackSampler(self.sample_interval)
+        queries = QueryCounter()
+
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(queries))
+            started = time.perf_counter()
+            profiler.start()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.stop()
+                elapsed = time.perf_counter() - started
+
+        match = request.resolver_match
+        view_name = (match.view_name if match else 'unresolved').replace(':', '.')
+        name = (
+            f'{timezone.now():%Y%m%dT%H%M%S%f}-{view_name}-{elapsed * 1000:.0f}ms-{queries.count}q'
+            f'{f"-user{requested_by}" if requested_by else ""}.{profiler.extension}'
+        )
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            profiler.dump(self.directory / name)
+            self.rotate()
+        except OSError as e:
+            logger.warning(f"Could not write profile {name}: {e}")
+        return response
+
+    def rotate(self):
+        profiles = sorted(
+            (path for path in self.directory.iterdir() if path.suffix in ('.pstats', '.collapsed')),
+            key=lambda path: path.stat().st_mtime,
+        )
+        for path in profiles[:max(len(profiles) - self.max_files, 0)]:
+            path.unlink(missing_ok=True)
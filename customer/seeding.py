@@ -0,0 +1,220 @@
+"""
+Synthetic users for benchmarks and performance tests.
+
+``seed_users()`` generates customers (a share of them dormant, so the archive
+job has work), a staff hierarchy following ``UserRole.ROLE_HIERARCHY``
+(admins -> managers -> cashiers linked through ``created_by``) and outstanding
+refresh tokens, some of them already expired.
+
+Primary keys are reserved up front from the current maximum, so every row,
+including its ``created_by`` link and ``hierarchy_path``, is fully known before
+it is written. Rows are streamed through ``COPY`` on PostgreSQL and batched
+multi-row ``INSERT``s elsewhere. The password is hashed once and shared by all
+seeded users. No model signals or webhooks fire, and the database should be
+otherwise idle while seeding.
+"""
+import io
+import logging
+import random
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.color import no_style
+from django.db import connections, transaction
+from django.db.models import Max
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .models import User, UserRole
+
+logger = logging.getLogger(__name__)
+
+SEED_DOMAIN = 'seed.example.com'
+
+
+@dataclass
+class SeedResult:
+    customers: int = 0
+    staff: int = 0
+    tokens: int = 0
+    elapsed: float = 0.0
+
+
+class RowWriter:
+    """Buffers rows of one model and writes them in batches"""
+
+    def __init__(self, model, columns, batch_size, using):
+        self.connection = connections[using]
+        self.model = model
+        self.fields = [model._meta.get_field(name) for name in columns]
+        self.batch_size = batch_size
+        self.written = 0
+        self._rows = []
+
+    def add(self, values):
+        self._rows.append([
+            field.get_db_prep_save(value, self.connection) for field, value in zip(self.fields, values)
+        ])
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        table = self.connection.ops.quote_name(self.model._meta.db_table)
+        columns = ', '.join(self.connection.ops.quote_name(field.column) for field in self.fields)
+        with self.connection.cursor() as cursor:
+            if self.connection.vendor == 'postgresql':
+                self._copy(cursor, f'COPY {table} ({columns}) FROM STDIN')
+            else:
+                placeholders = ', '.join(['%s'] * len(self.fields))
+                cursor.executemany(f'INSERT INTO {table} ({columns}) VALUES ({placeholders})', self._rows)
+        self.written += len(self._rows)
+        self._rows = []
+
+    def _copy(self, cursor, sql):
+        data = ''.join('\t'.join(map(copy_text, row)) + '\n' for row in self._rows)
+        raw = cursor.cursor
+        if hasattr(raw, 'copy_expert'):
+            # psycopg2
+            raw.copy_expert(sql, io.StringIO(data))
+        else:
+            # psycopg 3
+            with raw.copy(sql) as copy:
+                copy.write(data)
+
+
+def copy_text(value):
+    """A value in COPY's text format"""
+    if value is None:
+        return '\\N'
+    return (
+        str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    )
+
+
+def user_columns():
+    return [field.attname for field in User._meta.concrete_fields]
+
+
+def user_values(**values):
+    """A full row of User values in user_columns() order"""
+    return [
+        values[field.attname] if field.attname in values else field.get_default()
+        for field in User._meta.concrete_fields
+    ]
+
+
+def ensure_roles():
+    return {
+        role: UserRole.objects.get_or_create(role=role, defaults={'permissions': {}})[0]
+        for role in ('admin', 'manager', 'cashier')
+    }
+
+
+def seed_users(customers=1000, admins=2, managers_per_admin=5, cashiers_per_manager=10,
+               tokens=None, dormant_fraction=0.2, expired_fraction=0.5, password='password',
+               batch_size=5000, seed=None, using='default'):
+    """
+    Insert synthetic users and outstanding tokens; returns a SeedResult.
+    ``tokens`` defaults to one per staff member plus one per five customers.
+    """
+    result = SeedResult()
+    started = time.monotonic()
+    rng = random.Random(seed)
+    now = timezone.now()
+    password_hash = make_password(password)
+    inactive_days = getattr(settings, 'ARCHIVE_INACTIVE_DAYS', 365)
+    roles = ensure_roles()
+    root = User.objects.using(using).filter(is_superuser=True).order_by('pk').first()
+    root_path = f'/{root.pk}/' if root else '/'
+    next_id = (User.objects.using(using).aggregate(top=Max('pk'))['top'] or 0) + 1
+
+    def joined_at(max_days):
+        return now - timedelta(days=rng.uniform(0, max_days), seconds=rng.randrange(86400))
+
+    users = RowWriter(User, user_columns(), batch_size, using)
+    staff_ids, customer_ids = [], []
+
+    def add_staff(role, creator_id, path):
+        nonlocal next_id
+        user_id, next_id = next_id, next_id + 1
+        joined = joined_at(3 * 365)
+        users.add(user_values(
+            id=user_id, email=f'{role}{user_id}@{SEED_DOMAIN}', name=f'{role.title()} {user_id}',
+            password=password_hash, is_staff=True, user_type='staff', role_id=roles[role].pk,
+            created_by_id=creator_id, hierarchy_path=path,
+            date_joined=joined, created_at=joined, updated_at=joined + (now - joined) * rng.random(),
+            last_login=now - timedelta(hours=rng.uniform(0, 72)),
+        ))
+        staff_ids.append(user_id)
+        return user_id
+
+    with transaction.atomic(using=using):
+        for _ in range(admins):
+            admin_id = add_staff('admin', root.pk if root else None, root_path)
+            admin_path = f'{root_path}{admin_id}/'
+            for _ in range(managers_per_admin):
+                manager_id = add_staff('manager', admin_id, admin_path)
+                manager_path = f'{admin_path}{manager_id}/'
+                for _ in range(cashiers_per_manager):
+                    add_staff('cashier', manager_id, manager_path)
+
+        for _ in range(customers):
+            user_id, next_id = next_id, next_id + 1
+            joined = joined_at(5 * 365)
+            if rng.random() < dormant_fraction:
+                # Long past the archive cutoff, or never logged in at all
+                joined = min(joined, now - timedelta(days=inactive_days + 30))
+                last_login = rng.choice([None, now - timedelta(days=inactive_days + rng.uniform(1, 365))])
+            else:
+                last_login = now - timedelta(days=rng.uniform(0, inactive_days / 4))
+            users.add(user_values(
+                id=user_id, email=f'customer{user_id}@{SEED_DOMAIN}', name=f'Customer {user_id}',
+                password=password_hash, date_joined=joined, created_at=joined,
+                updated_at=max(joined, last_login or joined), last_login=last_login,
+                phone_number=f'+1555{user_id % 10 ** 7:07d}',
+            ))
+            customer_ids.append(user_id)
+        users.flush()
+
+        if tokens is None:
+            tokens = len(staff_ids) + len(customer_ids) // 5
+        owners = staff_ids + customer_ids
+        outstanding = RowWriter(
+            OutstandingToken, ['user_id', 'jti', 'token', 'created_at', 'expires_at'], batch_size, using
+        )
+        lifetime = RefreshToken.lifetime
+        for _ in range(tokens if owners else 0):
+            user_id = rng.choice(owners)
+            if rng.random() < expired_fraction:
+                issued = now - lifetime - timedelta(days=rng.uniform(1, 90))
+            else:
+                issued = now - lifetime * rng.random()
+            token = RefreshToken()
+            token[api_settings.USER_ID_CLAIM] = str(user_id)
+            token.set_iat(at_time=issued)
+            token.set_exp(from_time=issued, lifetime=lifetime)
+            outstanding.add([user_id, token[api_settings.JTI_CLAIM], str(token), issued, issued + lifetime])
+        outstanding.flush()
+
+        connection = connections[using]
+        # Explicit ids bypass the sequences; move them past the seeded rows
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [User, OutstandingToken]):
+                cursor.execute(sql)
+
+    result.staff = len(staff_ids)
+    result.customers = len(customer_ids)
+    result.tokens = outstanding.written
+    result.elapsed = time.monotonic() - started
+    logger.info(
+        f"Seeded {result.customers} customers, {result.staff} staff and {result.tokens} tokens "
+        f"in {result.elapsed:.2f}s"
+    )
+    return result
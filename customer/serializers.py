@@ -1,6 +1,8 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from .models import Customer, Staff, UserRole
+from .models import ApiKey, Customer, Staff, UserRole
+from .authorization import get_auth_context
+from . import webhooks
 
 User = get_user_model()
 
@@ -10,17 +12,33 @@ class UserRoleSerializer(serializers.ModelSerializer):
         fields = ['id', 'role', 'description']
         read_only_fields = ['id']
 
+class UniqueEmailValidator:
+    """
+    Case-insensitive unique check for User.email, which is unique through
+    its Lower(email) constraint rather than unique=True
+    """
+    requires_context = True
+    
+    def __call__(self, value, field):
+        users = User.objects.with_email(value)
+        instance = getattr(field.parent, 'instance', None)
+        if instance is not None:
+            users = users.exclude(pk=instance.pk)
+        if users.exists():
+            raise serializers.ValidationError(duplicate_email_errors()['email'], code='unique')
+
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'name', 'email', 'user_type', 'is_active', 'date_joined', 'last_login']
         read_only_fields = ['id', 'date_joined', 'last_login']
+        extra_kwargs = {'email': {'validators': [UniqueEmailValidator()]}}
 
 class CustomerSerializer(UserSerializer):
     class Meta(UserSerializer.Meta):
         model = Customer
         fields = UserSerializer.Meta.fields + ['phone_number', 'address']
-        extra_kwargs = {'password': {'write_only': True}}
+        extra_kwargs = {**UserSerializer.Meta.extra_kwargs, 'password': {'write_only': True}}
 
 class StaffSerializer(UserSerializer):
     role = UserRoleSerializer(read_only=True)
@@ -34,7 +52,18 @@ class StaffSerializer(UserSerializer):
     class Meta(UserSerializer.Meta):
         model = Staff
         fields = UserSerializer.Meta.fields + ['role', 'role_id', 'is_staff']
-        extra_kwargs = {'password': {'write_only': True}}
+        extra_kwargs = {**UserSerializer.Meta.extra_kwargs, 'password': {'write_only': True}}
+    
+    def validate_role_id(self, role):
+        # Assigning a role takes the same right as creating a user with it
+        request = self.context.get('request')
+        if role is not None and request is not None:
+            context = get_auth_context(request)
+            if not context.can_create(role.role):
+                raise serializers.ValidationError(
+                    f"You can only assign these roles: {', '.join(context.creatable_roles)}"
+                )
+        return role
     
     def create(self, validated_data):
         role = validated_data.pop('role', None)
@@ -65,10 +94,20 @@ class UserRegisterSerializer(serializers.ModelSerializer):
         fields = ['name', 'email', 'password']
         extra_kwargs = {'password': {'write_only': True}}
 
+def duplicate_email_errors():
+    """The errors the unique email validator reports, for a duplicate found on insert"""
+    field = User._meta.get_field('email')
+    message = field.error_messages['unique'] % {
+        'model_name': User._meta.verbose_name, 'field_label': field.verbose_name,
+    }
+    return {'email': [message]}
+
 class CustomerRegisterSerializer(UserRegisterSerializer):
     class Meta(UserRegisterSerializer.Meta):
         model = Customer
         fields = UserRegisterSerializer.Meta.fields + ['phone_number', 'address']
+        # No SELECT for the unique check; CustomerRegisterView maps the IntegrityError
+        extra_kwargs = {**UserRegisterSerializer.Meta.extra_kwargs, 'email': {'validators': []}}
     
     def create(self, validated_data):
         return Customer.objects.create_customer(**validated_data)
@@ -84,8 +123,10 @@ class StaffRegisterSerializer(UserRegisterSerializer):
     class Meta(UserRegisterSerializer.Meta):
         model = Staff
         fields = UserRegisterSerializer.Meta.fields + ['role_id']
+        # Uniqueness is case-insensitive; StaffRegisterView maps the IntegrityError
         extra_kwargs = {
-            'password': {'write_only': True}
+            'password': {'write_only': True},
+            'email': {'validators': []},
         }
     
     def validate(self, data):
@@ -96,21 +137,17 @@ class StaffRegisterSerializer(UserRegisterSerializer):
             raise serializers.ValidationError({"role_id": "Authentication required to create staff users"})
         
         role = data.get('role')
-        creator = request.user
+        creator = get_auth_context(request)
         
-        # Superuser can create any role
-        if creator.is_superuser:
-            return data
-            
-        # Regular users can't create staff
-        if not creator.is_staff or not creator.role:
+        # Regular users can't create staff; superusers can create any role
+        # (an API key only those it is scoped to, see creatable_roles)
+        if not creator.is_superuser and (not creator.is_staff or not creator.role):
             raise serializers.ValidationError({"role_id": "Insufficient permissions"})
             
         # Check role hierarchy
-        allowed_roles = UserRole.ROLE_HIERARCHY.get(creator.role.role, [])
-        if role.role not in allowed_roles:
+        if not creator.can_create(role.role):
             raise serializers.ValidationError({
-                "role_id": f"You can only create users with these roles: {', '.join(allowed_roles)}"
+                "role_id": f"You can only create users with these roles: {', '.join(creator.creatable_roles)}"
             })
             
         return data
@@ -132,6 +169,7 @@ class StaffRegisterSerializer(UserRegisterSerializer):
             created_by=self.context['request'].user,
             **validated_data  # Only pass remaining fields
         )
+        webhooks.emit('staff.created', webhooks.user_payload(user))
         return user
 
 class ForgetPasswordSerializer(serializers.Serializer):
@@ -149,3 +187,65 @@ class ResetPasswordSerializer(serializers.Serializer):
         if data['password'] != data['confirm_password']:
             raise serializers.ValidationError("Passwords do not match")
         return data
+
+class ApiKeySerializer(serializers.ModelSerializer):
+    scopes = serializers.ListField(child=serializers.CharField(), required=False, default=list)
+
+    class Meta:
+        model = ApiKey
+        fields = ['id', 'name', 'prefix', 'scopes', 'created_at', 'expires_at', 'revoked_at']
+        read_only_fields = ['id', 'prefix', 'created_at', 'revoked_at']
+
+    def validate_scopes(self, scopes):
+        allowed = get_auth_context(self.context['request']).permissions
+        invalid = sorted(set(scopes) - allowed)
+        if invalid:
+            raise serializers.ValidationError(f"Scopes not granted to your role: {', '.join(invalid)}")
+        return sorted(set(scopes))
+
+class CommaSeparatedListField(serializers.ListField):
+    """List field that also accepts "a,b,c" as a single query parameter"""
+    def to_internal_value(self, data):
+        if isinstance(data, str):
+            data = [item for item in data.split(',') if item.strip()]
+        elif isinstance(data, list) and len(data) == 1 and isinstance(data[0], str):
+            data = [item for item in data[0].split(',') if item.strip()]
+        return super().to_internal_value(data)
+
+class StaffBatchLookupSerializer(serializers.Serializer):
+    MAX_ITEMS = 200
+    
+    ids = CommaSeparatedListField(child=serializers.IntegerField(min_value=1), required=False,
+                                  max_length=MAX_ITEMS)
+    emails = CommaSeparatedListField(child=serializers.EmailField(), required=False,
+                                     max_length=MAX_ITEMS)
+
+    def validate(self, data):
+        if bool(data.get('ids')) == bool(data.get('emails')):
+            raise serializers.ValidationError("Provide either ids or emails")
+        return data
+
+class StaffBulkCreateItemSerializer(serializers.Serializer):
+    """One user of a bulk create; roles and emails are checked for the whole batch at once"""
+    name = serializers.CharField(max_length=255)
+    email = serializers.EmailField()
+    password = serializers.CharField(write_only=True)
+    role_id = serializers.IntegerField(min_value=1)
+
+class StaffBulkCreateSerializer(serializers.Serializer):
+    MAX_ITEMS = 200
+    
+    users = serializers.ListField(child=serializers.DictField(), min_length=1, max_length=MAX_ITEMS)
+    atomic = serializers.BooleanField(default=False)
+
+class StaffBulkIdsSerializer(serializers.Serializer):
+    MAX_ITEMS = 200
+    
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), min_length=1, max_length=MAX_ITEMS)
+    atomic = serializers.BooleanField(default=False)
+
+class StaffBulkStatusSerializer(StaffBulkIdsSerializer):
+    is_active = serializers.BooleanField()
+
+class StaffBulkRoleSerializer(StaffBulkIdsSerializer):
+    role_id = serializers.PrimaryKeyRelatedField(queryset=UserRole.objects.all(), source='role')
@@ -1,10 +1,19 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth import get_user_model
-from .models import UserRole
+from .archive import is_moving_customers
+from .caching import invalidate
+from .models import Customer, Staff, UserDeletion, UserRole
 
 User = get_user_model()
 
+# Columns a login writes (last_login plus the auto_now updated_at); no
+# consumer-visible data depends on them
+LOGIN_FIELDS = frozenset({'last_login', 'updated_at'})
+
+def is_login_save(update_fields):
+    return update_fields is not None and set(update_fields) <= LOGIN_FIELDS
+
 @receiver(post_save, sender=User)
 def set_default_user_role(sender, instance, created, **kwargs):
     """
@@ -30,3 +39,75 @@ def create_user_profile(sender, instance, created, **kwargs):
     if created:
         # Create user profile or perform other post-creation tasks
         pass
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Customer)
+@receiver(post_save, sender=Staff)
+def publish_user_saved(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Signal to queue a webhook event for every user change
+    """
+    if is_moving_customers():
+        # Rehydrating an archived customer is not a new user
+        return
+    if is_login_save(update_fields):
+        # Keeps the outbox write off the login path
+        return
+    from .webhooks import emit, user_payload
+    emit('user.created' if created else 'user.updated', user_payload(instance))
+
+# Customer and Staff are proxies, which send signals under their own class
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Customer)
+@receiver(post_delete, sender=Staff)
+def reroot_created_staff(sender, instance, **kwargs):
+    """
+    Signal to keep the hierarchy paths valid when a creator is deleted.
+    created_by is SET_NULL, so the direct reports become roots. The
+    collector's SET_NULL is a plain UPDATE; move_subtree also bumps
+    updated_at so the change feed sees it.
+    """
+    if not instance.is_staff:
+        # Only staff create other users, so customers have no subtree
+        return
+    from .hierarchy import move_subtree
+    move_subtree(instance.subtree_prefix, '/', using=kwargs.get('using'))
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Customer)
+@receiver(post_delete, sender=Staff)
+def record_user_deletion(sender, instance, **kwargs):
+    """
+    Signal to leave a tombstone for the change feed
+    """
+    if is_moving_customers():
+        # Archived customers still exist, only in the cold table
+        return
+    UserDeletion.objects.using(kwargs.get('using')).create(
+        user_id=instance.pk,
+        user_type=instance.user_type,
+    )
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Customer)
+@receiver(post_save, sender=Staff)
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Customer)
+@receiver(post_delete, sender=Staff)
+def evict_cached_user(sender, instance, using=None, update_fields=None, **kwargs):
+    """
+    Signal to evict the user's entries (users:<pk>:...) in every worker, e.g.
+    the API key cache of customer/authentication.py
+    """
+    if is_login_save(update_fields):
+        # Logins don't change anything cached
+        return
+    invalidate(f'users:{instance.pk}', using=using)
+
+@receiver(post_save, sender=UserRole)
+@receiver(post_delete, sender=UserRole)
+def evict_cached_roles(sender, instance, using=None, **kwargs):
+    """
+    Signal to evict cached roles, and the user entries that embed a role, in every worker
+    """
+    invalidate('roles', 'users', using=using)
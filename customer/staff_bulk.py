@@ -0,0 +1,288 @@
+"""
+Bulk staff management: create, activate/deactivate, change role and delete.
+
+Each operation validates the whole batch in one pass against rows loaded by
+a fixed number of queries: the roles (from the app cache), the requester's
+scope, existing emails and ``UserRole.ROLE_HIERARCHY`` (what the requester may
+create, and whether a user's creator and direct reports still fit its new
+role). The valid items are then written together in one transaction, with
+``bulk_create`` or a single ``UPDATE``, and every item gets its own result.
+With ``atomic`` nothing is written unless every item is valid.
+
+Bulk writes bypass ``post_save``, so the webhook events the signals would
+queue are emitted here, two INSERTs per event type. Deletes still go through
+the collector, so the per-user ``post_delete`` handlers (tombstones, subtree
+re-rooting) run as they do for a single delete.
+
+Settings (``BULK_STAFF``):
+    HASH_WORKERS  threads hashing the passwords of a bulk create
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import audit, webhooks
+from .hashing import hash_user_password
+from .models import User, UserRole
+from .serializers import StaffBulkCreateItemSerializer, duplicate_email_errors
+
+DEFAULTS = {
+    'HASH_WORKERS': 4,
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'BULK_STAFF', {})}
+
+
+@dataclass
+class ItemResult:
+    index: int
+    status: str = 'pending'  # then 'created', 'updated', 'unchanged', 'deleted' or 'error'
+    id: int = None
+    errors: dict = None
+    user: User = None
+
+    def fail(self, errors):
+        self.status = 'error'
+        self.errors = errors
+
+
+@dataclass
+class BulkResult:
+    items: list = field(default_factory=list)
+
+    @property
+    def failed(self):
+        return sum(item.status == 'error' for item in self.items)
+
+    @property
+    def applied(self):
+        return len(self.items) - self.failed
+
+    def pending(self):
+        return [item for item in self.items if item.status == 'pending']
+
+    def abort(self):
+        """Fail every pending item because another item of an atomic batch failed"""
+        for item in self.pending():
+            item.fail({'non_field_errors': ['Not applied: another item in the atomic batch failed']})
+
+
+def hash_passwords(users, passwords):
+    workers = min(get_config()['HASH_WORKERS'], len(users))
+    if workers <= 1:
+        return [hash_user_password(user, password) for user, password in zip(users, passwords)]
+    # hashlib's PBKDF2 and scrypt release the GIL, so threads hash in parallel
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bulk-hash') as pool:
+        return list(pool.map(hash_user_password, users, passwords))
+
+
+def taken_emails(emails):
+    """The given emails already in use, in any case, lowercased"""
+    if not emails:
+        return set()
+    return {email.lower() for email in User.objects.with_emails(emails).values_list('email', flat=True)}
+
+
+def create_staff(actor, context, rows, atomic=False):
+    """Create staff users reporting to ``actor``; ``rows`` are the raw request items"""
+    result = BulkResult()
+    roles = UserRole.cached_by_id()
+    seen = set()
+    candidates = []
+    for index, row in enumerate(rows):
+        item = ItemResult(index)
+        result.items.append(item)
+        serializer = StaffBulkCreateItemSerializer(data=row)
+        if not serializer.is_valid():
+            item.fail(serializer.errors)
+            continue
+        data = serializer.validated_data
+        role = roles.get(data['role_id'])
+        if role is None:
+            item.fail({'role_id': [f'Invalid pk "{data["role_id"]}" - object does not exist.']})
+        elif not context.can_create(role.role):
+            item.fail({'role_id': [
+                f"You can only create users with these roles: {', '.join(context.creatable_roles)}"
+            ]})
+        else:
+            email = User.objects.normalize_email(data['email'])
+            if email.lower() in seen:
+                item.fail({'email': ['Duplicate email in this batch.']})
+                continue
+            seen.add(email.lower())
+            candidates.append((item, email, data, role))
+
+    existing = taken_emails([email for _, email, _, _ in candidates])
+    for item, email, data, role in candidates:
+        if email.lower() in existing:
+            item.fail(duplicate_email_errors())
+    candidates = [candidate for candidate in candidates if candidate[0].status == 'pending']
+    if atomic and result.failed:
+        result.abort()
+        return result
+
+    users = [
+        User(
+            email=email, name=data['name'], role=role, created_by=actor,
+            hierarchy_path=actor.subtree_prefix, is_staff=True, user_type='staff',
+        )
+        for item, email, data, role in candidates
+    ]
+    for user, password in zip(users, hash_passwords(users, [data['password'] for _, _, data, _ in candidates])):
+        user.password = password
+
+    try:
+        write_created(users)
+    except IntegrityError:
+        # Lost a race with another insert of one of the emails
+        taken = taken_emails([user.email for user in users])
+        if not taken:
+            raise
+        for item, email, _, _ in candidates:
+            if email.lower() in taken:
+                item.fail(duplicate_email_errors())
+        if atomic:
+            result.abort()
+            return result
+        users = [user for user in users if user.email.lower() not in taken]
+        write_created(users)
+        candidates = [candidate for candidate in candidates if candidate[1].lower() not in taken]
+
+    for (item, _, _, _), user in zip(candidates, users):
+        item.status, item.id, item.user = 'created', user.pk, user
+        audit.record('staff.create', actor, user, {'email': user.email, 'role': user.role})
+    return result
+
+
+def write_created(users):
+    # The users and their webhook events commit together
+    with transaction.atomic():
+        User.objects.bulk_create(users)
+        payloads = [webhooks.user_payload(user) for user in users]
+        webhooks.emit_many('user.created', payloads)
+        webhooks.emit_many('staff.created', payloads)
+
+
+def load_targets(queryset, ids, actor):
+    """
+    Item results for ``ids`` (duplicates dropped) and the users among them the
+    requester may change, loaded with their role and their creator's role.
+    """
+    result = BulkResult()
+    ids = list(dict.fromkeys(ids))
+    found = queryset.select_related('role', 'created_by__role').in_bulk(ids)
+    targets = []
+    for index, pk in enumerate(ids):
+        item = ItemResult(index, id=pk)
+        result.items.append(item)
+        user = found.get(pk)
+        if user is None:
+            item.fail({'id': ['Not found.']})
+        elif pk == actor.pk:
+            item.fail({'id': ['You cannot change your own account.']})
+        else:
+            item.user = user
+            targets.append(item)
+    return result, targets
+
+
+def update_staff(actor, items, changes, audit_fields):
+    """Write ``changes`` to the users of ``items`` in one UPDATE and report them"""
+    before = {item.id: audit.snapshot(item.user, audit_fields) for item in items}
+    now = timezone.now()
+    for item in items:
+        for name, value in changes.items():
+            setattr(item.user, name, value)
+        item.user.updated_at = now
+    with transaction.atomic():
+        User.objects.filter(pk__in=[item.id for item in items]).update(**changes, updated_at=now)
+        webhooks.emit_many('user.updated', [webhooks.user_payload(item.user) for item in items])
+    for item in items:
+        item.status = 'updated'
+        after = audit.snapshot(item.user, audit_fields)
+        audit.record('staff.update', actor, item.user, {
+            name: [before[item.id][name], after[name]] for name in audit_fields
+        })
+
+
+def set_active(actor, queryset, ids, is_active, atomic=False):
+    """Activate or deactivate the staff in ``queryset`` with the given ids"""
+    result, targets = load_targets(queryset, ids, actor)
+    if atomic and result.failed:
+        result.abort()
+        return result
+
+    changed = []
+    for item in targets:
+        if item.user.is_active == is_active:
+            item.status = 'unchanged'
+        else:
+            changed.append(item)
+    if changed:
+        update_staff(actor, changed, {'is_active': is_active}, ['is_active'])
+    return result
+
+
+def set_role(actor, queryset, ids, role, atomic=False):
+    """
+    Move the staff in ``queryset`` with the given ids to ``role``. Each user's
+    creator must be allowed to create ``role``, and ``role`` must be allowed to
+    create the roles of the user's direct reports.
+    """
+    result, targets = load_targets(queryset, ids, actor)
+    report_roles = {}
+    reports = User.objects.filter(created_by_id__in=[item.id for item in targets], role__isnull=False)
+    for creator_id, report_role in reports.values_list('created_by_id', 'role__role').distinct():
+        report_roles.setdefault(creator_id, set()).add(report_role)
+
+    creatable = set(UserRole.get_creatable_roles(role.role))
+    changed = []
+    for item in targets:
+        user = item.user
+        creator = user.created_by
+        creator_role = creator.role.role if creator is not None and creator.role_id else None
+        if user.role_id == role.pk:
+            item.status = 'unchanged'
+        elif creator is not None and not creator.is_superuser and (
+            role.role not in UserRole.get_creatable_roles(creator_role)
+        ):
+            item.fail({'role_id': [f'Created by a {creator_role or "user without a role"}, '
+                                   f'who cannot manage a {role.role}.']})
+        elif report_roles.get(user.pk, set()) - creatable:
+            item.fail({'role_id': [
+                f"Has direct reports with roles a {role.role} cannot manage: "
+                f"{', '.join(sorted(report_roles[user.pk] - creatable))}."
+            ]})
+        else:
+            changed.append(item)
+    if atomic and result.failed:
+        result.abort()
+        return result
+
+    if changed:
+        update_staff(actor, changed, {'role': role}, ['role'])
+    return result
+
+
+def delete_staff(actor, queryset, ids, atomic=False):
+    """Delete the staff in ``queryset`` with the given ids in one transaction"""
+    result, targets = load_targets(queryset, ids, actor)
+    if atomic and result.failed:
+        result.abort()
+        return result
+
+    if targets:
+        with transaction.atomic():
+            # Queued when the delete commits
+            for item in targets:
+                audit.record('staff.delete', actor, item.user, {'email': item.user.email})
+            User.objects.filter(pk__in=[item.id for item in targets]).delete()
+        for item in targets:
+            item.status = 'deleted'
+            item.user = None
+    return result
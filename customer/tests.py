@@ -1,3 +1,1677 @@
-from django.test import TestCase
+import base64
+import json
+import re
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, get_hasher, make_password
+from django.core.exceptions import ValidationError
+from django.core import mail
+from django.core.management import call_command
+from django.core.cache import caches
+from django.db import IntegrityError, connection
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.template.loader import render_to_string
+from django.urls import URLPattern, get_resolver, reverse
+from django.utils import timezone
+from django.utils.html import strip_tags
+from rest_framework.test import APIClient
+from rest_framework_simplejwt import authentication as jwt_authentication, tokens as jwt_tokens
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from api_drf.handlers import PathScopedWSGIHandler
+
+from .archive import archive_customers, cold_customers, rehydrate_customer
+from . import audit
+from .audit import AuditLog, get_audit_log
+from .authentication import api_key_cache, credential_cache, invalidate_credentials
+from .benchmarks import SMTPSink
+from .cache_backends import TieredCache
+from . import metrics
+from . import hashing
+from .hashing import drain_rehash_queue, write_policy
+from .idempotency import fingerprint, make_cache_key
+from .hierarchy import ancestor_ids_recursive, rebuild_hierarchy_paths, subtree_ids_recursive
+from .mail import get_mail_pool, otp_email
+from .models import (
+    ApiKey, ArchivedCustomer, AuditEvent, IdempotencyLock, OutboxEvent, User, UserDeletion, UserRole, WebhookDelivery,
+)
+from .seeding import seed_users
+from .serializers import duplicate_email_errors
+from .tokens import prune_expired_tokens
+from .utils import send_otp_email
+from .views import CustomerRegisterView
+from .views_sync import decode_cursor, encode_cursor
+from .webhooks import WebhookDispatcher
+
+
+@override_settings(AUDIT_LOG={'FLUSH_INTERVAL': None})
+class StaffTreeTestCase(TestCase):
+    """
+    Seeds superuser -> admin -> 2 managers -> 3 cashiers each, plus a customer.
+    Audit events are only written by the flush in tearDown, inside the test transaction.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.roles = {
+            role: UserRole.objects.create(role=role)
+            for role in ('admin', 'manager', 'cashier')
+        }
+        cls.root = User.objects.create_user(
+            email='root@example.com', password='pw', name='Root',
+            is_staff=True, is_superuser=True, user_type='staff', role=cls.roles['admin'],
+        )
+        cls.admin = cls.make_staff('admin', 'admin', cls.root)
+        cls.managers = [cls.make_staff(f'manager{i}', 'manager', cls.admin) for i in range(2)]
+        cls.cashiers = [
+            cls.make_staff(f'cashier{i}{j}', 'cashier', manager)
+            for i, manager in enumerate(cls.managers)
+            for j in range(3)
+        ]
+        cls.customer = User.objects.create_user(email='customer@example.com', password='pw', name='Customer')
+
+    def setUp(self):
+        # The app cache outlives each test's transaction
+        caches['default'].clear()
+
+    def tearDown(self):
+        # Write queued audit events inside the test transaction
+        get_audit_log().flush()
+
+    @classmethod
+    def make_staff(cls, name, role, creator):
+        return User.objects.create_staff_user(
+            email=f'{name}@example.com', password='pw', name=name,
+            role=cls.roles[role], created_by=creator,
+        )
+
+    def client_for(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(user).access_token}')
+        return client
+
+
+class StaffHierarchyTests(StaffTreeTestCase):
+    """
+    The materialized hierarchy paths must agree with a recursive walk of created_by.
+    """
+    def assertPathsMatchRecursiveWalk(self):
+        for user in User.objects.all():
+            self.assertEqual(
+                set(User.objects.subtree_of(user).values_list('pk', flat=True)),
+                subtree_ids_recursive(user),
+                user.email,
+            )
+            self.assertEqual(
+                list(User.objects.ancestors_of(user).values_list('pk', flat=True)),
+                ancestor_ids_recursive(user),
+                user.email,
+            )
+
+    def test_paths_follow_creators(self):
+        cashier = User.objects.get(pk=self.cashiers[0].pk)
+        self.assertEqual(cashier.ancestor_ids, [self.root.pk, self.admin.pk, self.managers[0].pk])
+        self.assertEqual(User.objects.get(pk=self.customer.pk).hierarchy_path, '/')
+        self.assertPathsMatchRecursiveWalk()
+
+    def test_subtree_is_a_single_query(self):
+        with self.assertNumQueries(1):
+            ids = list(User.objects.subtree_of(self.admin).values_list('pk', flat=True))
+        self.assertEqual(len(ids), len(self.managers) + len(self.cashiers))
+
+    def test_reassign_moves_descendants(self):
+        manager = User.objects.get(pk=self.managers[1].pk)
+        manager.created_by = self.managers[0]
+        manager.save()
+        self.assertEqual(
+            User.objects.get(pk=self.cashiers[-1].pk).ancestor_ids,
+            [self.root.pk, self.admin.pk, self.managers[0].pk, manager.pk],
+        )
+        self.assertPathsMatchRecursiveWalk()
+
+    def test_reassign_to_a_descendant_is_rejected(self):
+        admin = User.objects.get(pk=self.admin.pk)
+        for creator in (self.cashiers[0], admin):
+            admin.created_by = creator
+            with self.assertRaises(ValidationError):
+                admin.save()
+        self.assertEqual(User.objects.get(pk=self.admin.pk).hierarchy_path, f'/{self.root.pk}/')
+        self.assertPathsMatchRecursiveWalk()
+
+    def test_ancestors_are_limited_to_the_requester_scope(self):
+        url = reverse('user-ancestors', kwargs={'id': self.cashiers[0].pk})
+        as_manager = self.client_for(self.managers[0]).get(url)
+        self.assertEqual(as_manager.status_code, 200)
+        self.assertEqual(as_manager.data, [])
+        as_admin = self.client_for(self.admin).get(url)
+        self.assertEqual([user['id'] for user in as_admin.data], [self.admin.pk, self.managers[0].pk])
+
+    def test_delete_reroots_descendants(self):
+        User.objects.get(pk=self.admin.pk).delete()
+        self.assertEqual(User.objects.get(pk=self.managers[0].pk).hierarchy_path, '/')
+        self.assertPathsMatchRecursiveWalk()
+
+    def test_rebuild_restores_paths(self):
+        User.objects.update(hierarchy_path='/')
+        rebuild_hierarchy_paths()
+        self.assertPathsMatchRecursiveWalk()
+
+
+class AuthorizationContextTests(StaffTreeTestCase):
+    """
+    Once the JWT authenticator has loaded the user, no further role queries run.
+    """
+    def assertNoRoleQueries(self, client, method, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(client, method)(url)
+        self.assertLess(response.status_code, 400, response.content)
+        role_queries = [q['sql'] for q in queries if 'FROM "customer_userrole"' in q['sql']]
+        self.assertEqual(role_queries, [])
+        return response
+
+    def test_staff_list(self):
+        for user in (self.admin, self.managers[0]):
+            self.assertNoRoleQueries(self.client_for(user), 'get', reverse('user-list'))
+
+    def test_staff_detail(self):
+        client = self.client_for(self.admin)
+        url = reverse('user-detail', kwargs={'id': self.cashiers[0].pk})
+        self.assertNoRoleQueries(client, 'get', url)
+        self.assertNoRoleQueries(client, 'delete', url)
+
+    def test_role_list(self):
+        client = self.client_for(self.managers[0])
+        with self.assertNumQueries(2):  # authentication + the role listing itself
+            response = client.get(reverse('role-list'))
+        self.assertEqual([role['role'] for role in response.json()], ['cashier'])
+
+
+class WebhookReceiverStub(ThreadingHTTPServer):
+    """Local HTTP endpoint that records posted batches and answers with a fixed status"""
+    def __init__(self, status=200):
+        self.status = status
+        self.batches = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(handler):
+                body = handler.rfile.read(int(handler.headers['Content-Length']))
+                self.batches.append(json.loads(body))
+                handler.send_response(self.status)
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+
+            def log_message(handler, *args):
+                pass
+
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server_port}/hooks'
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class WebhookDispatchTests(TestCase):
+    def deliver(self, receiver, **config):
+        webhooks = {'ENDPOINTS': [{'url': receiver.url, 'events': ['*']}], **config}
+        with override_settings(WEBHOOKS=webhooks):
+            response = APIClient().post(reverse('customer-register'), {
+                'name': 'Jane', 'email': 'jane@example.com', 'password': 'secret-pass-1',
+            }, format='json')
+            self.assertEqual(response.status_code, 201)
+            dispatcher = WebhookDispatcher()
+            try:
+                return dispatcher, dispatcher.run_once()
+            finally:
+                dispatcher.close()
+
+    def test_events_are_delivered_in_one_batch(self):
+        receiver = WebhookReceiverStub()
+        self.addCleanup(receiver.close)
+        _, (delivered, failed) = self.deliver(receiver)
+        self.assertEqual((delivered, failed), (2, 0))
+        self.assertEqual(len(receiver.batches), 1)
+        self.assertEqual(
+            [event['type'] for event in receiver.batches[0]['events']],
+            ['user.created', 'customer.registered'],
+        )
+        self.assertFalse(WebhookDelivery.objects.exclude(status='delivered').exists())
+
+    def test_failures_back_off_and_open_the_breaker(self):
+        receiver = WebhookReceiverStub(status=503)
+        self.addCleanup(receiver.close)
+        dispatcher, (delivered, failed) = self.deliver(receiver, FAILURE_THRESHOLD=1)
+        self.assertEqual((delivered, failed), (0, 2))
+        self.assertEqual(dispatcher.breaker_for(receiver.url).state, 'open')
+        for delivery in WebhookDelivery.objects.all():
+            self.assertEqual((delivery.status, delivery.attempts), ('pending', 1))
+            self.assertGreater(delivery.next_attempt_at, delivery.event.created_at)
+
+
+    @override_settings(WEBHOOKS={'ENDPOINTS': [{'url': 'http://hooks.example.com/', 'events': ['*']}]})
+    def test_logins_publish_nothing(self):
+        customer = User.objects.create_user(email='jane@example.com', password='pw', name='Jane')
+        events = OutboxEvent.objects.count()
+        response = APIClient().post(reverse('customer-login'), {'email': customer.email, 'password': 'pw'},
+                                    format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(OutboxEvent.objects.count(), events)
+
+        customer.name = 'Janet'
+        customer.save()
+        self.assertEqual(OutboxEvent.objects.latest('pk').event_type, 'user.updated')
+
+
+class AdminChangelistTests(TestCase):
+    """
+    The user changelist must cost the same number of queries at any table size.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.roles = [UserRole.objects.create(role=role) for role in ('admin', 'manager', 'cashier')]
+        cls.superuser = User.objects.create_user(
+            email='root@example.com', password='pw', name='Root',
+            is_staff=True, is_superuser=True, user_type='staff', role=cls.roles[0],
+        )
+
+    def seed(self, count):
+        password = make_password('pw')
+        User.objects.bulk_create([
+            User(email=f'user{User.objects.count()}-{i}@example.com', name=f'User {i}', password=password,
+                 role=self.roles[i % 3], is_staff=bool(i % 2), user_type='staff' if i % 2 else 'customer')
+            for i in range(count)
+        ], batch_size=500)
+
+    def load_changelist(self, query=''):
+        self.client.force_login(self.superuser)
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = self.client.get(reverse('admin:customer_user_changelist') + query)
+            elapsed = time.perf_counter() - started
+        self.assertEqual(response.status_code, 200)
+        return queries, elapsed
+
+    def test_changelist_query_count_is_independent_of_size(self):
+        self.seed(20)
+        small, _ = self.load_changelist()
+        self.seed(2000)
+        large, elapsed = self.load_changelist()
+        self.assertEqual(len(small), len(large), [q['sql'] for q in large])
+        self.assertLess(sum(float(q['time']) for q in large), 2.0)
+        self.assertLess(elapsed, 5.0)
+
+    def test_filtered_changelist_skips_full_count(self):
+        self.seed(200)
+        queries, _ = self.load_changelist('?is_staff__exact=1')
+        counts = [q['sql'] for q in queries if 'COUNT(' in q['sql'] and 'customer_user' in q['sql']]
+        # Only the filtered count; show_full_result_count=False drops the unfiltered one
+        self.assertEqual(len(counts), 1, counts)
+
+
+class DirtyFieldTests(StaffTreeTestCase):
+    """
+    Saves of loaded users only write the columns that changed.
+    """
+    def user_updates(self, queries):
+        """Column sets of every UPDATE of the user table"""
+        updates = []
+        for query in queries:
+            match = re.match(r'UPDATE "customer_user" SET (.*) WHERE', query['sql'])
+            if match:
+                updates.append(set(re.findall(r'"(\w+)" = ', match.group(1))))
+        return updates
+
+    def test_unchanged_save_is_skipped(self):
+        user = User.objects.get(pk=self.customer.pk)
+        with self.assertNumQueries(0):
+            user.save()
+
+    def test_save_writes_changed_columns(self):
+        user = User.objects.get(pk=self.customer.pk)
+        user.name = 'Renamed'
+        with CaptureQueriesContext(connection) as queries:
+            user.save()
+        self.assertEqual(self.user_updates(queries), [{'name', 'updated_at'}])
+        with self.assertNumQueries(0):
+            user.save()
+
+    def test_login_writes_last_login_only(self):
+        for url, email in ((reverse('customer-login'), self.customer.email),
+                           (reverse('staff-login'), self.cashiers[0].email)):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(url, {'email': email, 'password': 'pw'}, content_type='application/json')
+            self.assertEqual(response.status_code, 200, response.content)
+            self.assertEqual(self.user_updates(queries), [{'last_login', 'updated_at'}], url)
+
+    def test_reset_password_is_one_update(self):
+        User.objects.filter(pk=self.customer.pk).update(
+            otp_reset_code='123456', otp_reset_expires_at=timezone.now() + timedelta(minutes=5),
+        )
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('reset-password'), {
+                'email': self.customer.email, 'otp': '123456',
+                'password': 'new-secret-1', 'confirm_password': 'new-secret-1',
+            }, content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(
+            self.user_updates(queries),
+            [{'password', 'otp_reset_code', 'otp_reset_expires_at', 'updated_at'}],
+        )
+        self.assertTrue(User.objects.get(pk=self.customer.pk).check_password('new-secret-1'))
+
+
+class SeedUsersTests(TestCase):
+    def test_seeded_hierarchy_and_tokens(self):
+        result = seed_users(customers=200, admins=2, managers_per_admin=2, cashiers_per_manager=3,
+                            tokens=50, batch_size=64, seed=1)
+        self.assertEqual((result.customers, result.staff, result.tokens), (200, 2 + 4 + 12, 50))
+        for user in User.objects.filter(is_staff=True):
+            self.assertEqual(set(User.objects.subtree_of(user).values_list('pk', flat=True)),
+                             subtree_ids_recursive(user))
+        self.assertTrue(cold_customers().exists())
+        self.assertTrue(OutstandingToken.objects.filter(expires_at__lt=timezone.now()).exists())
+        # The sequences moved past the reserved ids
+        self.assertGreater(User.objects.create_user(email='new@example.com', password='pw', name='New').pk,
+                           max(User.objects.exclude(email='new@example.com').values_list('pk', flat=True)))
+
+
+@dataclass(frozen=True)
+class Budget:
+    route: str
+    method: str
+    user: str | None  # StaffTreeTestCase attribute the request authenticates as
+    queries: int
+    writes: int
+
+
+# Maximum queries and writes (INSERT/UPDATE/DELETE) per request. The same
+# request must also cost exactly as much against a small and a large table.
+QUERY_BUDGETS = [
+    Budget('auth', 'get', None, 0, 0),
+    Budget('customer-register', 'post', None, 4, 2),  # in one transaction, no duplicate pre-check
+    Budget('customer-login', 'post', None, 3, 2),
+    Budget('staff-login', 'post', None, 4, 2),
+    Budget('token_obtain_pair', 'post', None, 4, 2),
+    Budget('token-refresh', 'post', None, 13, 2),
+    Budget('token_refresh', 'post', None, 13, 2),
+    Budget('logout', 'post', 'customer', 8, 1),
+    Budget('forget-password', 'post', None, 2, 1),
+    Budget('reset-password', 'post', None, 2, 1),
+    Budget('user-register', 'post', 'admin', 5, 1),  # savepoint instead of a duplicate pre-check
+    Budget('user-list', 'get', 'admin', 2, 0),
+    Budget('user-list', 'get', 'manager', 2, 0),
+    Budget('user-detail', 'get', 'admin', 2, 0),
+    Budget('user-detail', 'patch', 'admin', 3, 1),
+    Budget('user-detail', 'delete', 'admin', 13, 9),  # savepoint so a failed delete logs nothing
+    Budget('user-subtree', 'get', 'admin', 3, 0),
+    Budget('user-ancestors', 'get', 'admin', 6, 0),
+    Budget('user-batch', 'get', 'manager', 2, 0),
+    Budget('user-bulk-create', 'post', 'admin', 6, 1),  # 5 users, one INSERT
+    Budget('user-bulk-status', 'post', 'manager', 5, 1),
+    Budget('user-bulk-role', 'post', 'root', 7, 1),
+    Budget('user-bulk-delete', 'post', 'admin', 18, 14),  # 3 users; post_delete handlers run per user
+    Budget('role-list', 'get', 'manager', 2, 0),
+    Budget('role-detail', 'get', 'admin', 2, 0),
+    Budget('profile-token', 'post', 'manager', 1, 0),
+    Budget('api-key-list', 'get', 'admin', 2, 0),
+    Budget('api-key-list', 'post', 'admin', 2, 1),
+    Budget('api-key-revoke', 'delete', 'admin', 3, 1),
+    Budget('change-feed', 'get', 'admin', 3, 0),
+    Budget('metrics', 'get', None, 3, 0),  # row counts of the hot and archive tables
+]
+
+# Covered elsewhere (admin) or only routed with DEBUG on
+UNBUDGETED_NAMESPACES = {'admin'}
+UNBUDGETED_ROUTES = {'schema-swagger-ui'}
+
+
+def named_routes(resolver=None, namespace=None):
+    for pattern in (resolver or get_resolver()).url_patterns:
+        if isinstance(pattern, URLPattern):
+            if pattern.name and namespace is None:
+                yield pattern.name
+        else:
+            yield from named_routes(pattern, pattern.namespace or namespace)
+
+
+class QueryBudgetTests(StaffTreeTestCase):
+    """
+    Every route stays within its declared budget at two table sizes.
+    Requests are built by request_<route>_<method> methods; the default is a
+    bare request to the route without arguments.
+    """
+    sizes = (10, 1000)
+
+    @property
+    def manager(self):
+        return self.managers[0]
+
+    def seed(self, count):
+        """Grow every table the endpoints read by count rows"""
+        User.objects.bulk_create([
+            User(email=f'seeded{User.objects.count()}-{i}@example.com', name=f'Seeded {i}', password='!',
+                 is_staff=True, user_type='staff', role=self.roles['cashier'],
+                 created_by=self.manager, hierarchy_path=self.manager.subtree_prefix)
+            for i in range(count)
+        ])
+        seed_users(customers=count, admins=0, tokens=count)
+        ApiKey.objects.bulk_create([
+            ApiKey(user=self.admin, name=f'key {i}', prefix=f'seed{ApiKey.objects.count()}x{i}', key_hash='!')
+            for i in range(count)
+        ])
+
+    def refresh_token(self, user):
+        return str(RefreshToken.for_user(user))
+
+    def request_customer_register_post(self, route, run):
+        return reverse(route), {'name': 'New', 'email': f'new{run}@example.com', 'password': 'secret-pass-1'}
+
+    def request_customer_login_post(self, route, run):
+        return reverse(route), {'email': self.customer.email, 'password': 'pw'}
+
+    def request_staff_login_post(self, route, run):
+        return reverse(route), {'email': self.cashiers[0].email, 'password': 'pw'}
+
+    def request_token_obtain_pair_post(self, route, run):
+        return reverse(route), {'email': self.cashiers[0].email, 'password': 'pw'}
+
+    def request_token_refresh_post(self, route, run):
+        return reverse(route), {'refresh': self.refresh_token(self.cashiers[0])}
+
+    def request_logout_post(self, route, run):
+        return reverse(route), {'refresh': self.refresh_token(self.customer)}
+
+    def request_forget_password_post(self, route, run):
+        return reverse(route), {'email': self.customer.email}
+
+    def request_reset_password_post(self, route, run):
+        user = User.objects.create_user(
+            email=f'reset{run}@example.com', password='pw', name='Reset',
+            otp_reset_code='123456', otp_reset_expires_at=timezone.now() + timedelta(minutes=5),
+        )
+        return reverse(route), {'email': user.email, 'otp': '123456',
+                                'password': 'new-secret-1', 'confirm_password': 'new-secret-1'}
+
+    def request_user_register_post(self, route, run):
+        return reverse(route), {'name': 'New', 'email': f'manager-new{run}@example.com',
+                                'password': 'secret-pass-1', 'role': 'manager', 'role_id': self.roles['manager'].pk}
+
+    def request_user_detail_get(self, route, run):
+        return reverse(route, kwargs={'id': self.cashiers[0].pk}), None
+
+    def request_user_detail_patch(self, route, run):
+        return reverse(route, kwargs={'id': self.cashiers[0].pk}), {'name': f'Renamed {run}'}
+
+    def request_user_detail_delete(self, route, run):
+        return reverse(route, kwargs={'id': self.cashiers[-1 - run].pk}), None
+
+    def request_user_subtree_get(self, route, run):
+        return reverse(route, kwargs={'id': self.manager.pk}), None
+
+    def request_user_ancestors_get(self, route, run):
+        return reverse(route, kwargs={'id': self.cashiers[0].pk}), None
+
+    def request_user_batch_get(self, route, run):
+        ids = [user.pk for user in User.objects.subtree_of(self.manager)[:100]]
+        return f"{reverse(route)}?ids={','.join(map(str, ids))}", None
+
+    def bulk_targets(self, name, run, role='cashier', creator=None):
+        creator = creator or self.manager
+        return [
+            User.objects.create_staff_user(
+                email=f'{name}{run}-{i}@example.com', password='pw', name=name,
+                role=self.roles[role], created_by=creator,
+            ).pk
+            for i in range(3)
+        ]
+
+    def request_user_bulk_create_post(self, route, run):
+        return reverse(route), {'users': [
+            {'name': 'New', 'email': f'bulk{run}-{i}@example.com', 'password': 'pw', 'role_id': self.roles['manager'].pk}
+            for i in range(5)
+        ]}
+
+    def request_user_bulk_status_post(self, route, run):
+        return reverse(route), {'ids': self.bulk_targets('deactivated', run), 'is_active': False}
+
+    def request_user_bulk_role_post(self, route, run):
+        return reverse(route), {'ids': self.bulk_targets('promoted', run, creator=self.root),
+                                'role_id': self.roles['manager'].pk}
+
+    def request_user_bulk_delete_post(self, route, run):
+        return reverse(route), {'ids': self.bulk_targets('deleted', run)}
+
+    def request_role_detail_get(self, route, run):
+        return reverse(route, kwargs={'id': self.roles['cashier'].pk}), None
+
+    def request_api_key_list_post(self, route, run):
+        return reverse(route), {'name': f'ci {run}'}
+
+    def request_api_key_revoke_delete(self, route, run):
+        api_key, _ = ApiKey.generate(user=self.admin, name=f'revoked {run}')
+        return reverse(route, kwargs={'id': api_key.pk}), None
+
+    def issue(self, budget, run):
+        builder = getattr(self, f"request_{budget.route.replace('-', '_')}_{budget.method}", None)
+        url, data = builder(budget.route, run) if builder else (reverse(budget.route), None)
+        client = self.client_for(getattr(self, budget.user)) if budget.user else APIClient()
+        # Budgets hold for a cold app cache
+        caches['default'].clear()
+        with CaptureQueriesContext(connection) as captured:
+            response = getattr(client, budget.method)(url, data, format='json')
+        self.assertLess(response.status_code, 400, f'{budget}: {response.content[:500]}')
+        return [query['sql'] for query in captured]
+
+    def test_every_route_has_a_budget(self):
+        budgeted = {budget.route for budget in QUERY_BUDGETS}
+        missing = set(named_routes()) - budgeted - UNBUDGETED_ROUTES
+        self.assertEqual(missing, set(), 'Add these routes to QUERY_BUDGETS')
+
+    def test_budgets_hold_at_every_size(self):
+        measured = {}
+        seeded = 0
+        for run, size in enumerate(self.sizes):
+            self.seed(size - seeded)
+            seeded = size
+            for budget in QUERY_BUDGETS:
+                measured.setdefault(budget, []).append(self.issue(budget, run))
+
+        for budget, runs in measured.items():
+            with self.subTest(route=budget.route, method=budget.method, user=budget.user):
+                for queries in runs:
+                    writes = [sql for sql in queries if sql.lstrip().upper().startswith(('INSERT', 'UPDATE', 'DELETE'))]
+                    listing = '\n'.join(queries)
+                    self.assertLessEqual(len(queries), budget.queries, f'Over the query budget:\n{listing}')
+                    self.assertLessEqual(len(writes), budget.writes, f'Over the write budget:\n{listing}')
+                small, large = runs[0], runs[-1]
+                self.assertEqual(
+                    len(small), len(large),
+                    'Query count grows with table size:\n' + '\n'.join(large),
+                )
+
+
+class PathScopedHandlerTests(TestCase):
+    """
+    Drives the WSGI handler directly; the test client always runs the full chain.
+    """
+    def get(self, handler, path):
+        factory = RequestFactory()
+        factory.cookies['csrftoken'] = 'a' * 32
+        request = factory.get(path)
+        response = handler.get_response(request)
+        return request, response
+
+    def test_api_requests_skip_the_session_middleware(self):
+        handler = PathScopedWSGIHandler()
+        request, response = self.get(handler, reverse('auth'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(hasattr(request, 'session'))
+        self.assertFalse(hasattr(request, '_messages'))
+        self.assertNotIn('CSRF_COOKIE', request.META)
+
+    def test_admin_requests_keep_the_full_chain(self):
+        handler = PathScopedWSGIHandler()
+        request, response = self.get(handler, reverse('admin:login'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(hasattr(request, 'session'))
+        self.assertTrue(hasattr(request, '_messages'))
+        self.assertIn('CSRF_COOKIE', request.META)
+
+    def test_middleware_setting_is_restored(self):
+        middleware = settings.MIDDLEWARE
+        PathScopedWSGIHandler()
+        self.assertIs(settings.MIDDLEWARE, middleware)
+        with override_settings(API_MIDDLEWARE=['customer.missing.Middleware']):
+            with self.assertRaises(ImportError):
+                PathScopedWSGIHandler()
+            self.assertIs(settings.MIDDLEWARE, middleware)
+
+
+class ProfilingMiddlewareTests(StaffTreeTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+
+    def get_staff_list(self, mode='cprofile', sample_rate=0.0, **headers):
+        profiling = {'ENABLED': True, 'MODE': mode, 'SAMPLE_RATE': sample_rate,
+                     'SAMPLE_INTERVAL': 0.001, 'DIRECTORY': str(self.directory), 'MAX_FILES': 2}
+        with override_settings(PROFILING=profiling):
+            response = self.client_for(self.admin).get(reverse('user-list'), **headers)
+        self.assertEqual(response.status_code, 200)
+        return sorted(path.name for path in self.directory.iterdir())
+
+    def test_unsampled_requests_are_not_profiled(self):
+        self.assertEqual(self.get_staff_list(), [])
+        self.assertEqual(self.get_staff_list(HTTP_X_PROFILE='forged:token'), [])
+
+    def test_signed_header_is_profiled(self):
+        response = self.client_for(self.managers[0]).post(reverse('profile-token'))
+        profiles = self.get_staff_list(HTTP_X_PROFILE=response.json()['token'])
+        self.assertEqual(len(profiles), 1)
+        self.assertRegex(profiles[0], rf'-user-list-\d+ms-\d+q-user{self.managers[0].pk}\.pstats$')
+
+    def test_sampled_profiles_rotate(self):
+        for _ in range(3):
+            profiles = self.get_staff_list(mode='sampling', sample_rate=1.0)
+        self.assertEqual(len(profiles), 2)
+        self.assertTrue(all(name.endswith('.collapsed') for name in profiles))
+
+
+class MetricsTests(StaffTreeTestCase):
+    def scrape(self, **settings):
+        with override_settings(METRICS={'ENABLED': True, **settings}):
+            response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def sample(self, text, name, **labels):
+        label_text = ','.join(f'{key}="{value}"' for key, value in labels.items())
+        match = re.search(rf'^{re.escape(name)}{{{re.escape(label_text)}}} (\S+)$', text, re.MULTILINE)
+        return float(match.group(1)) if match else 0.0
+
+    def test_requests_and_auth_outcomes_are_counted(self):
+        before = self.scrape()
+        url = reverse('customer-login')
+        for password in ('pw', 'wrong'):
+            self.client.post(url, {'email': self.customer.email, 'password': password}, content_type='application/json')
+        after = self.scrape()
+
+        def delta(name, **labels):
+            return self.sample(after, name, **labels) - self.sample(before, name, **labels)
+
+        self.assertEqual(delta('api_http_requests_total', route='customer-login', method='POST', status='200'), 1)
+        self.assertEqual(delta('api_http_requests_total', route='customer-login', method='POST', status='401'), 1)
+        self.assertEqual(delta('api_http_request_duration_seconds_count', route='customer-login', method='POST'), 2)
+        self.assertEqual(delta('api_auth_attempts_total', mechanism='customer_login', outcome='success'), 1)
+        self.assertEqual(delta('api_auth_attempts_total', mechanism='customer_login', outcome='invalid_credentials'), 1)
+        self.assertIn('api_cache_hits_total{cache="credential"}', after)
+
+    def test_multiprocess_snapshots_are_summed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            own = self.sample(self.scrape(MULTIPROCESS_DIR=directory), 'api_otp_issued_total', user_type='customer')
+            worker = metrics.registry.snapshot()
+            worker['api_otp_issued_total']['samples'] = [[['customer'], 5]]
+            Path(directory, 'metrics-999999.json').write_text(json.dumps(worker))
+            text = self.scrape(MULTIPROCESS_DIR=directory)
+        self.assertEqual(self.sample(text, 'api_otp_issued_total', user_type='customer'), own + 5)
+
+    def test_only_allowed_addresses_can_scrape(self):
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='203.0.113.7')
+        self.assertEqual(response.status_code, 404)
+
+
+class StaffBatchLookupTests(StaffTreeTestCase):
+    def test_ids_are_scoped_and_missing_ones_reported(self):
+        cashier, foreign_cashier = self.cashiers[0], self.cashiers[-1]
+        client = self.client_for(self.managers[0])
+        with self.assertNumQueries(2):  # authentication + the batch
+            response = client.get(reverse('user-batch'), {'ids': f'{cashier.pk},{foreign_cashier.pk},999999'})
+        self.assertEqual(response.status_code, 200, response.content)
+        results = response.json()['results']
+        self.assertEqual(results[str(cashier.pk)]['email'], cashier.email)
+        self.assertEqual(results[str(cashier.pk)]['role']['role'], 'cashier')
+        # Outside the manager's subtree looks the same as not existing
+        self.assertIsNone(results[str(foreign_cashier.pk)])
+        self.assertEqual(response.json()['not_found'], [foreign_cashier.pk, 999999])
+
+    def test_lookup_by_email(self):
+        response = self.client_for(self.admin).get(
+            reverse('user-batch'), {'emails': [self.managers[0].email, 'nobody@example.com']}
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['results'][self.managers[0].email]['id'], self.managers[0].pk)
+        self.assertEqual(response.json()['not_found'], ['nobody@example.com'])
+
+    def test_lookup_by_email_ignores_case(self):
+        manager = self.managers[0]
+        response = self.client_for(self.admin).get(reverse('user-batch'), {'emails': ['Manager0@Example.COM']})
+        self.assertEqual(response.json()['results']['Manager0@Example.COM']['id'], manager.pk)
+        self.assertEqual(response.json()['not_found'], [])
+
+    def test_email_changes_reject_case_variants(self):
+        url = reverse('user-detail', kwargs={'id': self.cashiers[0].pk})
+        response = self.client_for(self.admin).patch(url, {'email': 'Manager0@Example.com'}, format='json')
+        self.assertEqual((response.status_code, response.data), (400, duplicate_email_errors()))
+        response = self.client_for(self.admin).patch(url, {'email': 'Cashier00@Example.com'}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_requires_exactly_one_kind_of_key(self):
+        client = self.client_for(self.admin)
+        self.assertEqual(client.get(reverse('user-batch')).status_code, 400)
+        too_many = ','.join(str(i) for i in range(1, 300))
+        self.assertEqual(client.get(reverse('user-batch'), {'ids': too_many}).status_code, 400)
+
+
+class CustomerRegistrationTests(TestCase):
+    def register(self, email):
+        return self.client.post(reverse('customer-register'), {
+            'name': 'Jane', 'email': email, 'password': 'secret-pass-1',
+        }, content_type='application/json')
+
+    def test_no_duplicate_pre_check(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.register('jane@example.com')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertFalse([q['sql'] for q in queries if q['sql'].startswith('SELECT')])
+
+    def test_duplicate_is_reported_from_the_unique_index(self):
+        self.register('jane@example.com')
+        response = self.register('jane@EXAMPLE.com')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['errors'], {'email': ['user with this email already exists.']})
+        # The failed registration left neither a user nor a token behind
+        self.assertEqual(User.objects.count(), 1)
+        self.assertEqual(OutstandingToken.objects.count(), 1)
+
+
+REGISTRATION = {'name': 'Jane', 'email': 'jane@example.com', 'password': 'secret-pass-1'}
+
+
+@override_settings(IDEMPOTENCY={'WAIT': 0.2, 'POLL_INTERVAL': 0.01})
+class IdempotencyKeyTests(StaffTreeTestCase):
+    def register(self, email='jane@example.com', key='retry-1', **headers):
+        return self.client.post(reverse('customer-register'), {**REGISTRATION, 'email': email},
+                                content_type='application/json', HTTP_IDEMPOTENCY_KEY=key, **headers)
+
+    def claim(self, key, request_hash, expires_in=60):
+        IdempotencyLock.objects.create(key=make_cache_key('ip:127.0.0.1', key), fingerprint=request_hash,
+                                       expires_at=timezone.now() + timedelta(seconds=expires_in))
+
+    def registration_fingerprint(self):
+        return fingerprint(RequestFactory().post(reverse('customer-register'), REGISTRATION,
+                                                 content_type='application/json'))
+
+    def test_retry_replays_the_first_response(self):
+        first = self.register()
+        retry = self.register()
+        self.assertEqual((first.status_code, retry.status_code), (201, 201))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json()['user'], first.json()['user'])
+        self.assertEqual(User.objects.filter(email='jane@example.com').count(), 1)
+        self.assertFalse(IdempotencyLock.objects.exists())
+
+    def test_tokens_are_reissued_rather_than_stored(self):
+        first = self.register()
+        stored = caches['shared'].get(make_cache_key('ip:127.0.0.1', 'retry-1'))
+        self.assertNotIn('refresh', json.loads(stored['content']))
+        self.assertNotIn(first.json()['access'].encode(), stored['content'])
+        self.assertNotIn(b'secret-pass-1', json.dumps(stored, default=str).encode())
+        retry = self.register().json()
+        self.assertNotEqual(retry['refresh'], first.json()['refresh'])
+        self.assertEqual(jwt_tokens.AccessToken(retry['access'])['user_id'], str(first.json()['user']['id']))
+
+    def test_replay_of_a_removed_user_is_gone(self):
+        self.register()
+        User.objects.filter(email='jane@example.com').delete()
+        self.assertEqual(self.register().status_code, 410)
+
+    def test_replays_run_no_queries(self):
+        def forget_password():
+            return self.client.post(reverse('forget-password'), {'email': self.customer.email},
+                                    content_type='application/json', HTTP_IDEMPOTENCY_KEY='otp-1')
+        first = forget_password()
+        with self.assertNumQueries(0):
+            retry = forget_password()
+        self.assertEqual((retry.status_code, retry.content), (first.status_code, first.content))
+
+    def test_key_reuse_with_a_different_body_is_rejected(self):
+        self.register()
+        self.assertEqual(self.register(email='other@example.com').status_code, 422)
+
+    def test_keys_are_scoped_per_client(self):
+        self.register()
+        other_client = self.register(REMOTE_ADDR='198.51.100.4')
+        self.assertEqual(other_client.status_code, 400)  # ran again: the email is taken now
+        self.assertNotIn('Idempotent-Replayed', other_client)
+
+    def test_forget_password_sends_one_otp(self):
+        for _ in range(3):
+            response = self.client.post(reverse('forget-password'), {'email': self.customer.email},
+                                        content_type='application/json', HTTP_IDEMPOTENCY_KEY='otp-1')
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_in_flight_duplicate_waits_then_conflicts(self):
+        # The key is claimed, as if the first request were still running
+        self.claim('first', self.registration_fingerprint())
+        self.assertEqual(self.register(key='first').status_code, 409)
+        self.assertFalse(User.objects.filter(email='jane@example.com').exists())
+
+    def test_in_flight_key_reuse_with_a_different_body_is_rejected(self):
+        self.claim('first', 'another-request')
+        self.assertEqual(self.register(key='first').status_code, 422)
+
+    def test_claim_of_a_dead_request_is_taken_over(self):
+        self.claim('first', self.registration_fingerprint(), expires_in=-1)
+        self.assertEqual(self.register(key='first').status_code, 201)
+        self.assertFalse(IdempotencyLock.objects.exists())
+
+
+@override_settings(IDEMPOTENCY={'WAIT': 5.0})
+class ConcurrentIdempotencyKeyTests(TransactionTestCase):
+    """
+    Duplicates racing on separate connections: the claim row lets one run.
+    """
+    def setUp(self):
+        caches['shared'].clear()
+        self.addCleanup(caches['shared'].clear)
+
+    def test_concurrent_duplicates_run_the_view_once(self):
+        first_running, claimed_elsewhere, first_done = threading.Event(), threading.Event(), threading.Event()
+        post = CustomerRegisterView.post
+
+        def held_post(view, request):
+            # The first request holds its claim until the duplicate has seen it
+            first_running.set()
+            claimed_elsewhere.wait(5)
+            return post(view, request)
+
+        def wait_for_first(seconds):
+            claimed_elsewhere.set()
+            first_done.wait(5)
+
+        responses = {}
+
+        def register(name, done=None):
+            try:
+                responses[name] = self.client_class().post(
+                    reverse('customer-register'), REGISTRATION,
+                    content_type='application/json', HTTP_IDEMPOTENCY_KEY='race-1')
+            finally:
+                connection.close()
+                if done:
+                    done.set()
+
+        with mock.patch.object(CustomerRegisterView, 'post', autospec=True, side_effect=held_post) as view, \
+                mock.patch('customer.idempotency.time.sleep', side_effect=wait_for_first):
+            first = threading.Thread(target=register, args=('first', first_done))
+            first.start()
+            self.assertTrue(first_running.wait(5))
+            duplicate = threading.Thread(target=register, args=('duplicate',))
+            duplicate.start()
+            first.join(10)
+            duplicate.join(10)
+
+        self.assertEqual(view.call_count, 1)
+        self.assertEqual((responses['first'].status_code, responses['duplicate'].status_code), (201, 201))
+        self.assertNotIn('Idempotent-Replayed', responses['first'])
+        self.assertEqual(responses['duplicate']['Idempotent-Replayed'], 'true')
+        self.assertEqual(User.objects.filter(email='jane@example.com').count(), 1)
+        self.assertFalse(IdempotencyLock.objects.exists())
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher',
+                                     'django.contrib.auth.hashers.PBKDF2PasswordHasher'])
+class PasswordPolicyTests(StaffTreeTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.policy_file = Path(directory.name) / 'policy.json'
+        write_policy({'roles': {
+            'cashier': {'algorithm': 'pbkdf2_sha256', 'params': {'iterations': 1000}},
+            'default': {'algorithm': 'pbkdf2_sha256', 'params': {'iterations': 2000}},
+        }}, self.policy_file)
+        policy = override_settings(PASSWORD_POLICY={
+            'POLICY_FILE': str(self.policy_file), 'REHASH_IN_BACKGROUND': False,
+            'MINIMUMS': {'pbkdf2_sha256': 1000},
+        })
+        policy.enable()
+        self.addCleanup(policy.disable)
+
+    def stored_hash(self, user):
+        return User.objects.values_list('password', flat=True).get(pk=user.pk)
+
+    def login(self, user, password='pw'):
+        url = reverse('staff-login' if user.is_staff else 'customer-login')
+        return self.client.post(url, {'email': user.email, 'password': password}, content_type='application/json')
+
+    def test_set_password_follows_the_role_policy(self):
+        for user, iterations in ((self.cashiers[0], 1000), (self.managers[0], 2000), (self.customer, 2000)):
+            user.set_password('new-secret')
+            self.assertTrue(user.password.startswith(f'pbkdf2_sha256${iterations}$'), user)
+            self.assertTrue(user.check_password('new-secret'))
+
+    def test_outdated_hash_is_upgraded_after_the_login(self):
+        self.assertTrue(self.stored_hash(self.customer).startswith('md5$'))
+        self.assertEqual(self.login(self.customer).status_code, 200)
+        self.assertTrue(self.stored_hash(self.customer).startswith('md5$'))
+
+        self.assertEqual(drain_rehash_queue(), 1)
+        self.assertTrue(self.stored_hash(self.customer).startswith('pbkdf2_sha256$2000$'))
+        self.assertEqual(self.login(self.customer).status_code, 200)
+        self.assertEqual(drain_rehash_queue(), 0)
+
+    def test_rehash_does_not_overwrite_a_newer_password(self):
+        cashier = self.cashiers[0]
+        self.assertEqual(self.login(cashier).status_code, 200)
+        cashier.set_password('changed')
+        cashier.save()
+        self.assertEqual(drain_rehash_queue(), 0)
+        self.assertEqual(self.login(cashier, 'changed').status_code, 200)
+        self.assertEqual(self.login(cashier).status_code, 401)
+
+    def test_tune_hashers_writes_the_policy(self):
+        output = self.policy_file.with_name('tuned.json')
+        call_command('tune_hashers', '--target', 'cashier=0.001', '--target', 'default=0.002',
+                     '--algorithms', 'pbkdf2_sha256', '--output', str(output), stdout=StringIO())
+        roles = json.loads(output.read_text())['roles']
+        self.assertEqual(set(roles), {'cashier', 'default'})
+        self.assertEqual({entry['algorithm'] for entry in roles.values()}, {'pbkdf2_sha256'})
+        self.assertGreaterEqual(roles['default']['params']['iterations'], roles['cashier']['params']['iterations'])
+        self.assertGreaterEqual(roles['cashier']['params']['iterations'], 1000)
+
+    def test_tuning_never_goes_below_djangos_parameters(self):
+        self.assertEqual(hashing.cost_floor('pbkdf2_sha256', {'pbkdf2_sha256': 1000}),
+                         get_hasher('pbkdf2_sha256').iterations)
+        self.assertEqual(hashing.cost_floor('pbkdf2_sha256', {'pbkdf2_sha256': 10**7}), 10**7)
+
+    def test_staff_policy_role_comes_from_the_role_cache(self):
+        UserRole.cached_by_id()
+        cashier = User.objects.get(pk=self.cashiers[0].pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(cashier.check_password('pw'))
+        self.assertEqual(hashing.policy_role(cashier), 'cashier')
+
+
+class StaffBulkTests(StaffTreeTestCase):
+    def post(self, user, route, data):
+        return self.client_for(user).post(reverse(route), data, format='json')
+
+    def statuses(self, response):
+        return [item['status'] for item in response.data['results']]
+
+    def test_create_validates_the_whole_batch(self):
+        manager = self.managers[0]
+        cashier = self.roles['cashier'].pk
+        response = self.post(manager, 'user-bulk-create', {'users': [
+            {'name': 'New', 'email': 'new@example.com', 'password': 'secret', 'role_id': cashier},
+            {'name': 'Boss', 'email': 'boss@example.com', 'password': 'secret', 'role_id': self.roles['manager'].pk},
+            {'name': 'Taken', 'email': self.cashiers[0].email, 'password': 'secret', 'role_id': cashier},
+            {'name': 'Twice', 'email': 'new@example.com', 'password': 'secret', 'role_id': cashier},
+            {'name': 'No password', 'email': 'nopw@example.com', 'role_id': cashier},
+        ]})
+        self.assertEqual(response.status_code, 207, response.data)
+        self.assertEqual(self.statuses(response), ['created', 'error', 'error', 'error', 'error'])
+        self.assertEqual(response.data['applied'], 1)
+
+        created = User.objects.select_related('role').get(email='new@example.com')
+        self.assertEqual((created.role.role, created.created_by_id), ('cashier', manager.pk))
+        self.assertEqual(created.hierarchy_path, manager.subtree_prefix)
+        self.assertTrue(created.check_password('secret'))
+
+    def test_create_costs_the_same_for_any_batch_size(self):
+        def create(count, prefix):
+            users = [{'name': 'New', 'email': f'{prefix}{i}@example.com', 'password': 'secret',
+                      'role_id': self.roles['cashier'].pk} for i in range(count)]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.post(self.managers[0], 'user-bulk-create', {'users': users})
+            self.assertEqual(response.status_code, 201, response.data)
+            return len(queries)
+
+        caches['default'].clear()
+        small = create(2, 'small')
+        caches['default'].clear()
+        self.assertEqual(small, create(40, 'large'))
+
+    def test_atomic_batch_writes_nothing_on_error(self):
+        response = self.post(self.managers[0], 'user-bulk-create', {'atomic': True, 'users': [
+            {'name': 'New', 'email': 'new@example.com', 'password': 'secret', 'role_id': self.roles['cashier'].pk},
+            {'name': 'Bad', 'email': 'bad@example.com', 'password': 'secret', 'role_id': 999},
+        ]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.statuses(response), ['error', 'error'])
+        self.assertFalse(User.objects.filter(email='new@example.com').exists())
+
+    def test_status_is_scoped_to_the_requesters_subtree(self):
+        manager = self.managers[0]
+        own, other = self.cashiers[0], self.cashiers[3]
+        response = self.post(manager, 'user-bulk-status', {'ids': [own.pk, other.pk, manager.pk], 'is_active': False})
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(self.statuses(response), ['updated', 'error', 'error'])
+        self.assertEqual(set(User.objects.filter(is_active=False).values_list('pk', flat=True)), {own.pk})
+        self.assertGreater(User.objects.get(pk=own.pk).updated_at, own.updated_at)
+
+        response = self.post(manager, 'user-bulk-status', {'ids': [own.pk], 'is_active': False})
+        self.assertEqual(self.statuses(response), ['unchanged'])
+
+    def test_role_change_respects_the_hierarchy(self):
+        promotable = User.objects.create_staff_user(
+            email='promotable@example.com', password='pw', name='Promotable',
+            role=self.roles['cashier'], created_by=self.root,
+        )
+        response = self.post(self.root, 'user-bulk-role', {
+            'ids': [promotable.pk, self.cashiers[0].pk, self.managers[0].pk],
+            'role_id': self.roles['manager'].pk,
+        })
+        self.assertEqual(response.status_code, 207, response.data)
+        # A manager may not create managers; managers[0] already is one
+        self.assertEqual(self.statuses(response), ['updated', 'error', 'unchanged'])
+        self.assertEqual(User.objects.get(pk=promotable.pk).role_id, self.roles['manager'].pk)
+
+        # A cashier can't keep the cashiers a manager created
+        User.objects.create_staff_user(
+            email='report@example.com', password='pw', name='Report', role=self.roles['cashier'], created_by=promotable,
+        )
+        response = self.post(self.root, 'user-bulk-role', {
+            'ids': [promotable.pk], 'role_id': self.roles['cashier'].pk,
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('direct reports', response.data['results'][0]['errors']['role_id'][0])
+
+        response = self.post(self.managers[0], 'user-bulk-role', {
+            'ids': [self.cashiers[0].pk], 'role_id': self.roles['admin'].pk,
+        })
+        self.assertEqual(response.status_code, 400)
+
+    def test_delete_is_admin_only_and_leaves_tombstones(self):
+        ids = [self.cashiers[0].pk, self.cashiers[1].pk]
+        self.assertEqual(self.post(self.managers[0], 'user-bulk-delete', {'ids': ids}).status_code, 403)
+
+        response = self.post(self.admin, 'user-bulk-delete', {'ids': ids + [self.admin.pk]})
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(self.statuses(response), ['deleted', 'deleted', 'error'])
+        self.assertFalse(User.objects.filter(pk__in=ids).exists())
+        self.assertEqual(set(UserDeletion.objects.values_list('user_id', flat=True)), set(ids))
+
+
+class CaseInsensitiveEmailTests(StaffTreeTestCase):
+    def post(self, route, data, client=None):
+        return (client or self.client).post(reverse(route), data, content_type='application/json')
+
+    def test_login_ignores_email_case(self):
+        for route, email in (('customer-login', 'CUSTOMER@Example.com'), ('staff-login', 'Cashier00@EXAMPLE.COM'),
+                             ('token_obtain_pair', 'Admin@Example.COM')):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.post(route, {'email': email, 'password': 'pw'})
+            self.assertEqual(response.status_code, 200, route)
+            self.assertIn('LOWER("customer_user"."email") = (LOWER(', queries[0]['sql'])
+
+    def test_forget_password_ignores_email_case(self):
+        self.assertEqual(self.post('forget-password', {'email': 'Customer@Example.com'}).status_code, 200)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_case_variants_are_duplicates(self):
+        response = self.post('customer-register', {'name': 'Again', 'email': 'CUSTOMER@example.com',
+                                                   'password': 'secret-pass-1'})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client_for(self.admin).post(reverse('user-register'), {
+            'name': 'Again', 'email': 'Manager0@Example.com', 'password': 'secret-pass-1',
+            'role': 'manager', 'role_id': self.roles['manager'].pk,
+        }, format='json')
+        self.assertEqual((response.status_code, response.data), (400, duplicate_email_errors()))
+
+        response = self.client_for(self.managers[0]).post(reverse('user-bulk-create'), {'users': [
+            {'name': 'Again', 'email': 'CASHIER00@example.com', 'password': 'pw', 'role_id': self.roles['cashier'].pk},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(User.objects.with_email('cashier00@example.com').count(), 1)
+
+
+class TieredCacheTests(StaffTreeTestCase):
+    def worker(self, name, **options):
+        """A tiered cache with its own local tier, as in another worker process"""
+        return TieredCache('shared', {'OPTIONS': {'LOCAL_NAME': f'{self.id()}-{name}', **options}})
+
+    def test_invalidation_reaches_every_worker(self):
+        first, second = self.worker('first', GENERATION_TTL=0), self.worker('second', GENERATION_TTL=0)
+        first.set('roles:all', 'cached', 60)
+        first.set('users:42:profile', 'cached', 60)
+        first.set('users:43:profile', 'cached', 60)
+        self.assertEqual(second.get('roles:all'), 'cached')
+
+        first.invalidate('roles', 'users:42')
+        self.assertIsNone(second.get('roles:all'))
+        self.assertIsNone(second.get('users:42:profile'))
+        self.assertEqual(second.get('users:43:profile'), 'cached')
+
+        second.invalidate('users')
+        self.assertIsNone(first.get('users:43:profile'))
+
+    def test_stats_per_tier(self):
+        first, second = self.worker('first'), self.worker('second')
+        self.assertIsNone(first.get('roles:all'))
+        first.set('roles:all', ['admin'], 60)
+        second.get('roles:all')
+        value = second.get('roles:all')
+        value.append('mutated')
+        self.assertEqual(second.get('roles:all'), ['admin'])
+
+        self.assertEqual(
+            {stat: second.stats()[stat] for stat in ('local_hits', 'shared_hits', 'shared_misses')},
+            {'local_hits': 2, 'shared_hits': 1, 'shared_misses': 0},
+        )
+        self.assertEqual(first.stats()['shared_misses'], 1)
+
+    def test_role_changes_evict_cached_roles(self):
+        self.assertEqual(UserRole.cached_by_id()[self.roles['manager'].pk].description, '')
+        with self.assertNumQueries(0):
+            UserRole.cached_by_id()
+
+        self.roles['manager'].description = 'Runs a store'
+        self.roles['manager'].save()
+        self.assertEqual(UserRole.cached_by_id()[self.roles['manager'].pk].description, 'Runs a store')
+
+    def test_logins_invalidate_nothing(self):
+        cache = caches['default']
+        invalidations = cache.stats()['invalidations']
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('staff-login'), {'email': self.cashiers[0].email, 'password': 'pw'},
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(cache.stats()['invalidations'], invalidations)
+
+    def test_role_list_reads_roles_from_the_cache(self):
+        client = self.client_for(self.managers[0])
+        cold = client.get(reverse('role-list'))
+        with CaptureQueriesContext(connection) as warm:
+            self.assertEqual(client.get(reverse('role-list')).json(), cold.json())
+        self.assertEqual(cold.json(), [{'id': self.roles['cashier'].pk, 'role': 'cashier', 'description': ''}])
+        self.assertFalse([query for query in warm if 'FROM "customer_userrole"' in query['sql']])
+        self.assertIn('api_app_cache_hits_total{tier="local"}', metrics.render(metrics.registry.collect()))
+
+
+class OtpMailTests(TestCase):
+    def test_compiled_email_matches_the_template(self):
+        text, html = otp_email.render('123456')
+        self.assertEqual(html, render_to_string('emails/otp_email.html', {'otp_code': '123456'}))
+        self.assertEqual(text, strip_tags(html))
+
+    def test_pool_reuses_a_connection_and_reconnects_when_dropped(self):
+        with SMTPSink() as sink, override_settings(**sink.settings()):
+            for i in range(3):
+                self.assertTrue(send_otp_email(f'user{i}@example.com', f'00000{i}'))
+            self.assertEqual((sink.connections, sink.messages), (1, 3))
+
+            sink.drop_connections()
+            self.assertTrue(send_otp_email('user3@example.com', '000003'))
+            self.assertEqual((sink.connections, sink.messages), (2, 4))
+            get_mail_pool().close()
+
+
+class JWTAuthenticationTests(StaffTreeTestCase):
+    def get_roles(self, client):
+        return client.get(reverse('role-list'))
+
+    @contextmanager
+    def jwt_settings(self, **values):
+        # simplejwt's modules keep the api_settings they imported, so
+        # override_settings(SIMPLE_JWT=...) does not reach them
+        with ExitStack() as stack:
+            for module in (jwt_authentication, jwt_tokens):
+                for name, value in values.items():
+                    stack.enter_context(mock.patch.object(module.api_settings, name, value))
+            yield
+
+    def test_user_and_role_load_in_one_query(self):
+        client = self.client_for(self.managers[0])
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get_roles(client).status_code, 200)
+        user_queries = [query for query in queries if 'FROM "customer_user"' in query['sql']]
+        self.assertEqual(len(user_queries), 1)
+        self.assertIn('JOIN "customer_userrole"', user_queries[0]['sql'])
+
+    def test_password_change_revokes_tokens(self):
+        with self.jwt_settings(CHECK_REVOKE_TOKEN=True):
+            client = self.client_for(self.managers[0])
+            self.assertEqual(self.get_roles(client).status_code, 200)
+            manager = User.objects.get(pk=self.managers[0].pk)
+            manager.set_password('changed')
+            manager.save()
+            response = self.get_roles(client)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.data['code'], 'password_changed')
+
+    def test_inactive_users_are_rejected(self):
+        client = self.client_for(self.managers[0])
+        User.objects.filter(pk=self.managers[0].pk).update(is_active=False)
+        self.assertEqual(self.get_roles(client).status_code, 401)
+
+    def test_inactive_check_follows_the_setting(self):
+        client = self.client_for(self.managers[0])
+        User.objects.filter(pk=self.managers[0].pk).update(is_active=False)
+        with self.jwt_settings(CHECK_USER_IS_ACTIVE=False):
+            self.assertEqual(self.get_roles(client).status_code, 200)
+
+
+class AuditLogTests(StaffTreeTestCase):
+    def audit_log(self, **config):
+        return AuditLog({**audit.DEFAULTS, 'FLUSH_INTERVAL': None, **config})
+
+    def test_delete_is_logged_when_it_commits(self):
+        client = self.client_for(self.admin)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.delete(reverse('user-detail', kwargs={'id': self.cashiers[0].pk}))
+        self.assertEqual(response.status_code, 204)
+        get_audit_log().flush()
+        event = AuditEvent.objects.get(action='staff.delete')
+        self.assertEqual((event.actor_id, event.target_id), (self.admin.pk, self.cashiers[0].pk))
+
+    def test_failed_delete_is_not_logged(self):
+        client = self.client_for(self.admin)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks, \
+                mock.patch.object(User, 'delete', side_effect=IntegrityError('boom')):
+            with self.assertRaises(IntegrityError):
+                client.delete(reverse('user-detail', kwargs={'id': self.cashiers[0].pk}))
+        self.assertEqual(callbacks, [])
+        self.assertEqual(len(get_audit_log().buffer), 0)
+
+    def test_full_buffer_drops_and_counts(self):
+        audit_log = self.audit_log(BUFFER_SIZE=2)
+        for i in range(3):
+            audit_log.record({'action': 'staff.update', 'actor_id': self.admin.pk, 'target_type': 'user',
+                              'target_id': i, 'changes': {}, 'created_at': timezone.now()})
+        self.assertEqual((len(audit_log.buffer), audit_log.dropped), (2, 1))
+        self.assertEqual(audit_log.flush(), 2)
+        self.assertEqual(AuditEvent.objects.count(), 2)
+
+    def test_file_sink_writes_one_file_per_month(self):
+        with tempfile.TemporaryDirectory() as directory:
+            sink = audit.FileSink(directory)
+            june, july = timezone.now().replace(month=6, day=30), timezone.now().replace(month=7, day=1)
+            sink.write([
+                {'action': 'staff.create', 'actor_id': 1, 'created_at': june},
+                {'action': 'staff.delete', 'actor_id': 2, 'created_at': july},
+            ])
+            self.assertEqual(sorted(path.name for path in Path(directory).iterdir()),
+                             [f'audit-{june:%Y}-06.log', f'audit-{july:%Y}-07.log'])
+            events = list(sink.read(june - timedelta(days=1), july + timedelta(days=1), actor_id=2))
+            self.assertEqual([event['action'] for event in events], ['staff.delete'])
+
+    def test_close_stops_the_flusher_and_writes_pending_events(self):
+        with tempfile.TemporaryDirectory() as directory:
+            audit_log = self.audit_log(SINK='file', DIRECTORY=directory, FLUSH_INTERVAL=60)
+            audit_log.record({'action': 'staff.create', 'actor_id': 1, 'created_at': timezone.now()})
+            self.assertTrue(audit_log._thread.is_alive())
+            audit_log.close()
+            self.assertFalse(audit_log._thread.is_alive())
+            lines = [line for path in Path(directory).iterdir() for line in path.read_text().splitlines()]
+            self.assertEqual(len(lines), 1)
+
+    def test_flusher_keeps_its_connection_until_it_stops(self):
+        audit_log = self.audit_log(FLUSH_INTERVAL=60)
+        flushed = threading.Event()
+
+        def write(events):
+            flushed.set()
+            if events[0]['target_id'] is None:
+                raise IntegrityError('boom')
+
+        with mock.patch.object(audit_log.sink, 'write', side_effect=write), \
+                mock.patch.object(audit_log.sink, 'recover') as recover, \
+                mock.patch.object(audit_log.sink, 'close') as close:
+            for target_id in (1, 2, None):
+                flushed.clear()
+                audit_log.record({'action': 'staff.update', 'target_id': target_id})
+                audit_log._wakeup.set()
+                self.assertTrue(flushed.wait(5))
+            audit_log.close()
+        # Only the failed write checks the connection; it is closed once, on shutdown
+        recover.assert_called_once_with()
+        close.assert_called_once_with()
+
+
+class TokenPruningTests(StaffTreeTestCase):
+    def issue(self, count, expires_at):
+        return OutstandingToken.objects.bulk_create([
+            OutstandingToken(user=self.customer, jti=uuid.uuid4().hex, token='t', expires_at=expires_at)
+            for _ in range(count)
+        ])
+
+    def test_command_prunes_expired_tokens_in_batches(self):
+        now = timezone.now()
+        expired = self.issue(5, now - timedelta(days=1))
+        BlacklistedToken.objects.bulk_create([BlacklistedToken(token=token) for token in expired[:3]])
+        live = self.issue(3, now + timedelta(days=1))
+
+        out = StringIO()
+        call_command('prune_tokens', batch_size=2, pause=0, stdout=out)
+        self.assertIn('Removed 5 outstanding and 3 blacklisted tokens in 3 batches', out.getvalue())
+        self.assertEqual(set(OutstandingToken.objects.values_list('pk', flat=True)), {token.pk for token in live})
+        self.assertFalse(BlacklistedToken.objects.exists())
+
+    def test_blacklist_rows_go_before_their_tokens(self):
+        expired = self.issue(2, timezone.now() - timedelta(days=1))
+        BlacklistedToken.objects.create(token=expired[0])
+        with CaptureQueriesContext(connection) as queries:
+            prune_expired_tokens(batch_size=10)
+        deletes = [query['sql'].split('"')[1] for query in queries if query['sql'].startswith('DELETE')]
+        self.assertEqual(deletes, ['token_blacklist_blacklistedtoken', 'token_blacklist_outstandingtoken'])
+
+    def test_expiries_interleaved_across_the_primary_key(self):
+        now = timezone.now()
+        live = []
+        for _ in range(3):
+            live += self.issue(2, now + timedelta(days=1))
+            self.issue(1, now - timedelta(days=1))
+        result = prune_expired_tokens(batch_size=2)
+        self.assertEqual((result.outstanding_deleted, result.batches), (3, 2))
+        self.assertEqual(set(OutstandingToken.objects.values_list('pk', flat=True)), {token.pk for token in live})
+
+    def test_expiry_is_indexed(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, OutstandingToken._meta.db_table)
+        self.assertEqual(constraints['outstandingtoken_expires_at_idx']['columns'], ['expires_at', 'id'])
+
+
+@override_settings(WEBHOOKS={'ENDPOINTS': [{'url': 'http://hooks.example.com/', 'events': ['*']}]})
+class ArchiveTests(StaffTreeTestCase):
+    def setUp(self):
+        super().setUp()
+        User.objects.filter(pk=self.customer.pk).update(last_login=timezone.now() - timedelta(days=400))
+        self.customer_pk = self.customer.pk
+
+    def post(self, route, data):
+        return self.client.post(reverse(route), data, content_type='application/json')
+
+    def test_archive_moves_cold_customers_only(self):
+        result = archive_customers(batch_size=1)
+        self.assertEqual((result.archived, result.batches), (1, 1))
+        self.assertFalse(User.objects.filter(pk=self.customer_pk).exists())
+        self.assertEqual(ArchivedCustomer.objects.get().pk, self.customer_pk)
+        self.assertEqual(User.objects.count(), 10)
+
+    def test_archive_and_rehydrate_are_not_lifecycle_events(self):
+        deliveries = WebhookDelivery.objects.count()
+        archive_customers()
+        self.assertFalse(UserDeletion.objects.exists())
+
+        customer = rehydrate_customer('Customer@Example.com')
+        self.assertEqual(customer.pk, self.customer_pk)
+        self.assertEqual(customer.date_joined, self.customer.date_joined)
+        self.assertFalse(ArchivedCustomer.objects.exists())
+        self.assertEqual(WebhookDelivery.objects.count(), deliveries)
+
+    def test_login_with_wrong_password_leaves_the_archive_alone(self):
+        archive_customers()
+        response = self.post('customer-login', {'email': 'customer@example.com', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 401)
+        self.assertTrue(ArchivedCustomer.objects.filter(pk=self.customer_pk).exists())
+        self.assertFalse(User.objects.filter(pk=self.customer_pk).exists())
+
+    def test_login_rehydrates_after_the_password_matches(self):
+        archive_customers()
+        response = self.post('customer-login', {'email': 'customer@example.com', 'password': 'pw'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['user']['id'], self.customer_pk)
+        self.assertFalse(ArchivedCustomer.objects.exists())
+
+    def test_rehydrating_login_hashes_the_password_once(self):
+        archive_customers()
+        with mock.patch('django.contrib.auth.hashers.check_password', wraps=check_password) as archived_check, \
+                mock.patch('customer.hashing.check_user_password') as live_check:
+            response = self.post('customer-login', {'email': 'customer@example.com', 'password': 'pw'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(archived_check.call_count, 1)
+        live_check.assert_not_called()
+
+    def test_inactive_customers_stay_archived(self):
+        archive_customers()
+        ArchivedCustomer.objects.update(is_active=False)
+        response = self.post('customer-login', {'email': 'customer@example.com', 'password': 'pw'})
+        self.assertEqual(response.status_code, 401)
+        self.assertTrue(ArchivedCustomer.objects.filter(pk=self.customer_pk).exists())
+
+    def test_table_sizes_are_exported(self):
+        archive_customers()
+        with override_settings(METRICS={'ENABLED': True}):
+            text = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('api_table_rows{table="archive"} 1\n', text)
+        self.assertIn('api_table_rows{table="users"} 10\n', text)
+
+    def test_password_reset_rehydrates_only_with_the_otp(self):
+        archive_customers()
+        self.assertEqual(self.post('forget-password', {'email': 'customer@example.com'}).status_code, 200)
+        self.assertEqual(len(mail.outbox), 1)
+        archived = ArchivedCustomer.objects.get()
+        self.assertIsNotNone(archived.otp_reset_code)
+
+        reset = {'email': 'customer@example.com', 'password': 'new-secret-1', 'confirm_password': 'new-secret-1'}
+        wrong = '000000' if archived.otp_reset_code != '000000' else '111111'
+        self.assertEqual(self.post('reset-password', {**reset, 'otp': wrong}).status_code, 400)
+        self.assertTrue(ArchivedCustomer.objects.exists())
+
+        self.assertEqual(self.post('reset-password', {**reset, 'otp': archived.otp_reset_code}).status_code, 200)
+        self.assertFalse(ArchivedCustomer.objects.exists())
+        self.assertTrue(User.objects.get(pk=self.customer_pk).check_password('new-secret-1'))
+
+
+@override_settings(CHANGE_FEED_SETTLE_SECONDS=0)
+class ChangeFeedTests(StaffTreeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = self.client_for(self.admin)
+        # Every seeded user was last changed at the same moment
+        self.moment = timezone.now() - timedelta(minutes=5)
+        User.objects.update(updated_at=self.moment)
+
+    def feed(self, cursor=None, **params):
+        if cursor:
+            params['cursor'] = cursor
+        response = self.client.get(reverse('change-feed'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def drain(self, cursor=None, limit=100):
+        """(changed ids, deleted ids, final cursor) of every page after ``cursor``"""
+        changed, deleted = [], []
+        while True:
+            page = self.feed(cursor, limit=limit)
+            changed += [row['id'] for row in page['changes']]
+            deleted += [row['id'] for row in page['deletions']]
+            cursor = page['next_cursor']
+            if not page['has_more']:
+                return changed, deleted, cursor
+
+    def test_cursor_round_trip(self):
+        position = {'c': [self.moment.isoformat(), 7], 'd': [self.moment.isoformat(), 2]}
+        self.assertEqual(decode_cursor(encode_cursor(position)),
+                         {'c': (self.moment, 7), 'd': (self.moment, 2)})
+        self.assertNotIn('=', encode_cursor(position))
+        response = self.client.get(reverse('change-feed'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_equal_timestamps_are_paged_by_id(self):
+        changed, _, _ = self.drain(limit=3)
+        self.assertEqual(changed, sorted(User.objects.values_list('pk', flat=True)))
+
+    def test_unsettled_rows_are_held_back(self):
+        _, _, cursor = self.drain()
+        self.customer.name = 'Renamed'
+        self.customer.save()
+        with override_settings(CHANGE_FEED_SETTLE_SECONDS=60):
+            self.assertEqual(self.feed(cursor)['changes'], [])
+        self.assertEqual([row['id'] for row in self.feed(cursor)['changes']], [self.customer.pk])
+
+    def test_deletions_are_served_as_tombstones(self):
+        _, _, cursor = self.drain()
+        cashier_pk = self.cashiers[0].pk
+        self.cashiers[0].delete()
+        changed, deleted, _ = self.drain(cursor)
+        self.assertEqual(deleted, [cashier_pk])
+        self.assertNotIn(cashier_pk, changed)
+
+    def test_reports_of_a_deleted_creator_are_republished(self):
+        _, _, cursor = self.drain()
+        manager = self.managers[0]
+        manager.delete()
+        page = self.feed(cursor)
+        reports = {row['id']: row for row in page['changes']}
+        self.assertEqual(set(reports), {cashier.pk for cashier in self.cashiers[:3]})
+        self.assertTrue(all(row['created_by'] is None for row in reports.values()))
+
+    def test_moved_subtrees_are_republished(self):
+        _, _, cursor = self.drain()
+        manager = self.managers[0]
+        manager.created_by = self.root
+        manager.save()
+        changed, _, _ = self.drain(cursor)
+        self.assertEqual(set(changed), {manager.pk} | {cashier.pk for cashier in self.cashiers[:3]})
+
+
+class CachedBasicAuthenticationTests(StaffTreeTestCase):
+    def setUp(self):
+        super().setUp()
+        credential_cache.clear()
+        self.addCleanup(credential_cache.clear)
+
+    def get(self, email, password):
+        token = base64.b64encode(f'{email}:{password}'.encode()).decode()
+        return self.client.get(reverse('role-list'), HTTP_AUTHORIZATION=f'Basic {token}')
+
+    def verifications(self):
+        return mock.patch('customer.hashing.check_user_password', wraps=hashing.check_user_password)
+
+    def test_hit_skips_the_password_hash(self):
+        with self.verifications() as check:
+            self.assertEqual(self.get(self.admin.email, 'pw').status_code, 200)
+            self.assertEqual(self.get(self.admin.email, 'pw').status_code, 200)
+        self.assertEqual(check.call_count, 1)
+        self.assertEqual(len(credential_cache), 1)
+
+    def test_password_change_evicts_the_user(self):
+        self.assertEqual(self.get(self.admin.email, 'pw').status_code, 200)
+        self.admin.set_password('new-secret-1')
+        self.admin.save()
+        invalidate_credentials(self.admin)
+        self.assertEqual(len(credential_cache), 0)
+        self.assertEqual(self.get(self.admin.email, 'pw').status_code, 401)
+        self.assertEqual(self.get(self.admin.email, 'new-secret-1').status_code, 200)
+
+    def test_deactivated_user_is_rejected_despite_the_cache(self):
+        self.assertEqual(self.get(self.admin.email, 'pw').status_code, 200)
+        User.objects.filter(pk=self.admin.pk).update(is_active=False)
+        self.assertEqual(self.get(self.admin.email, 'pw').status_code, 401)
+        self.assertEqual(len(credential_cache), 0)
+
+    def test_wrong_passwords_are_not_cached(self):
+        with self.verifications() as check:
+            for _ in range(2):
+                self.assertEqual(self.get(self.admin.email, 'wrong').status_code, 401)
+        self.assertEqual(check.call_count, 2)
+        self.assertEqual(len(credential_cache), 0)
+
+
+class ApiKeyTests(StaffTreeTestCase):
+    def setUp(self):
+        super().setUp()
+        api_key_cache.clear()
+        self.addCleanup(api_key_cache.clear)
+
+    def key_client(self, user, scopes):
+        _, raw_key = ApiKey.generate(user=user, name='ci', scopes=scopes)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Api-Key {raw_key}')
+        return client
+
+    def register(self, client, role):
+        return client.post(reverse('user-register'), {
+            'name': 'New', 'email': f'new-{role}@example.com', 'password': 'secret-pass-1',
+            'role': role, 'role_id': self.roles[role].pk,
+        }, format='json')
+
+    def test_key_authenticates_and_is_cached_by_prefix(self):
+        client = self.key_client(self.admin, ['view_cashier'])
+        with CaptureQueriesContext(connection) as first:
+            self.assertEqual(client.get(reverse('user-list')).status_code, 200)
+        with CaptureQueriesContext(connection) as second:
+            self.assertEqual(client.get(reverse('user-list')).status_code, 200)
+        self.assertEqual(len(second), len(first) - 1)
+
+        prefix = client._credentials['HTTP_AUTHORIZATION'].split()[1].split('.')[0]
+        wrong = APIClient()
+        wrong.credentials(HTTP_AUTHORIZATION=f'Api-Key {prefix}.not-the-secret')
+        self.assertEqual(wrong.get(reverse('user-list')).status_code, 401)
+
+    def test_revoked_key_is_rejected_at_once(self):
+        response = self.client_for(self.admin).post(reverse('api-key-list'), {
+            'name': 'ci', 'scopes': ['view_cashier'],
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Api-Key {response.json()['key']}")
+        self.assertEqual(client.get(reverse('user-list')).status_code, 200)
+
+        revoke = self.client_for(self.admin).delete(reverse('api-key-revoke', kwargs={'id': response.json()['id']}))
+        self.assertEqual(revoke.status_code, 204)
+        self.assertEqual(client.get(reverse('user-list')).status_code, 401)
+
+    def test_add_scope_only_creates_its_role(self):
+        # Admins create managers, but not with a key scoped to cashiers
+        self.assertEqual(self.register(self.key_client(self.admin, ['add_cashier']), 'manager').status_code, 403)
+        self.assertEqual(self.register(self.key_client(self.admin, ['add_manager']), 'manager').status_code, 201)
+
+    def test_superuser_key_is_limited_to_its_scopes(self):
+        client = self.key_client(self.root, ['add_cashier'])
+        self.assertEqual(self.register(client, 'manager').status_code, 403)
+        self.assertEqual(self.register(client, 'cashier').status_code, 201)
+
+    def test_view_scope_only_reads_its_role(self):
+        client = self.key_client(self.admin, ['view_cashier'])
+        listed = {row['id'] for row in client.get(reverse('user-list')).json()}
+        self.assertEqual(listed, {cashier.pk for cashier in self.cashiers})
+
+        manager = self.managers[0]
+        self.assertEqual(client.get(reverse('user-detail', kwargs={'id': manager.pk})).status_code, 404)
+        batch = client.get(reverse('user-batch'), {'ids': f'{manager.pk},{self.cashiers[0].pk}'}).json()
+        self.assertEqual(batch['not_found'], [manager.pk])
+
+    def test_change_scope_only_changes_its_role(self):
+        client = self.key_client(self.admin, ['view_manager', 'change_cashier'])
+        manager_url = reverse('user-detail', kwargs={'id': self.managers[0].pk})
+        self.assertEqual(client.patch(manager_url, {'name': 'Renamed'}, format='json').status_code, 404)
+        cashier_url = reverse('user-detail', kwargs={'id': self.cashiers[0].pk})
+        self.assertEqual(client.patch(cashier_url, {'name': 'Renamed'}, format='json').status_code, 200)
+        # Promoting needs the right to create the new role
+        response = client.patch(cashier_url, {'role_id': self.roles['manager'].pk}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_views_without_scope_checks_deny_keys(self):
+        client = self.key_client(self.admin, ['view_cashier', 'view_manager'])
+        self.assertEqual(client.get(reverse('role-list')).status_code, 403)
+        refresh = str(RefreshToken.for_user(self.admin))
+        self.assertEqual(client.post(reverse('logout'), {'refresh': refresh}, format='json').status_code, 403)
+        self.assertFalse(BlacklistedToken.objects.exists())
+
+    def test_user_changes_reach_cached_keys_in_every_worker(self):
+        client = self.key_client(self.admin, ['view_manager', 'view_cashier'])
+        self.assertEqual(client.get(reverse('user-list')).status_code, 200)
+
+        # Another worker demotes the admin: its save invalidates users:<pk> in the shared tier
+        other = TieredCache('shared', {'OPTIONS': {'LOCAL_NAME': f'{self.id()}-other'}})
+        User.objects.filter(pk=self.admin.pk).update(role=self.roles['cashier'])
+        other.invalidate(f'users:{self.admin.pk}')
+        # ...which this worker picks up once its remembered generation expires
+        caches['default'].state.generations.clear()
+        self.assertEqual(client.get(reverse('user-list')).status_code, 403)
+
+    def test_logins_keep_cached_keys(self):
+        client = self.key_client(self.admin, ['view_cashier'])
+        self.assertEqual(client.get(reverse('user-list')).status_code, 200)
+        self.client.post(reverse('staff-login'), {'email': self.admin.email, 'password': 'pw'},
+                         content_type='application/json')
+        with self.assertNumQueries(1):  # the listing; the key is still cached
+            self.assertEqual(client.get(reverse('user-list')).status_code, 200)
+
+    def test_keys_cannot_manage_roles(self):
+        client = self.key_client(self.admin, ['change_cashier', 'delete_cashier', 'change_manager', 'delete_manager'])
+        url = reverse('role-detail', kwargs={'id': self.roles['cashier'].pk})
+        self.assertEqual(client.patch(url, {'description': 'Rewritten'}, format='json').status_code, 403)
+        self.assertEqual(client.delete(url).status_code, 403)
+        self.assertTrue(UserRole.objects.filter(pk=self.roles['cashier'].pk, description='').exists())
@@ -1,7 +1,13 @@
 from django.urls import path
 from rest_framework_simplejwt.views import TokenRefreshView
 from . import views
-from .views_staff import StaffRegisterView, StaffListView, StaffDetailView, RoleListView
+from .views_sync import ChangeFeedView
+from .views_keys import ApiKeyListView, ApiKeyRevokeView
+from .views_staff import (
+    StaffRegisterView, StaffListView, StaffDetailView, StaffSubtreeView, StaffAncestorsView, RoleListView,
+    StaffBatchView, StaffBulkCreateView, StaffBulkStatusView, StaffBulkRoleView, StaffBulkDeleteView,
+    ProfileTokenView,
+)
 
 urlpatterns = [
     # Authentication endpoints
@@ -14,8 +20,23 @@ urlpatterns = [
     # User management endpoints (for staff)
     path('user/register/', StaffRegisterView.as_view(), name='user-register'),
     path('user/', StaffListView.as_view(), name='user-list'),
+    path('user/batch/', StaffBatchView.as_view(), name='user-batch'),
+    path('user/bulk/', StaffBulkCreateView.as_view(), name='user-bulk-create'),
+    path('user/bulk/status/', StaffBulkStatusView.as_view(), name='user-bulk-status'),
+    path('user/bulk/role/', StaffBulkRoleView.as_view(), name='user-bulk-role'),
+    path('user/bulk/delete/', StaffBulkDeleteView.as_view(), name='user-bulk-delete'),
     path('user/<int:id>/', StaffDetailView.as_view(), name='user-detail'),
+    path('user/<int:id>/subtree/', StaffSubtreeView.as_view(), name='user-subtree'),
+    path('user/<int:id>/ancestors/', StaffAncestorsView.as_view(), name='user-ancestors'),
     path('user/roles/', RoleListView.as_view(), name='role-list'),
+    path('user/profile-token/', ProfileTokenView.as_view(), name='profile-token'),
+    
+    # API keys for machine clients
+    path('keys/', ApiKeyListView.as_view(), name='api-key-list'),
+    path('keys/<int:id>/', ApiKeyRevokeView.as_view(), name='api-key-revoke'),
+    
+    # Incremental sync for downstream systems
+    path('changes/', ChangeFeedView.as_view(), name='change-feed'),
     
     # Common auth endpoints
     path('auth/logout/', views.LogoutView.as_view(), name='logout'),
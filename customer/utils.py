@@ -1,9 +1,10 @@
 import logging
 from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags
 from django.conf import settings
 
+from .mail import get_mail_pool, otp_email
+from .metrics import email_failures, emails_sent
+
 # Set up logging
 logger = logging.getLogger(__name__)
 def send_otp_email(email, otp_code):
@@ -17,13 +18,8 @@ def send_otp_email(email, otp_code):
     subject = 'Your One-Time Password (OTP)'
     
     try:
-        # Render HTML content
-        html_content = render_to_string('emails/otp_email.html', {
-            'otp_code': otp_code,
-        })
-        
-        # Create text version (for non-HTML email clients)
-        text_content = strip_tags(html_content)
+        # Fill the code into the precompiled HTML and text versions
+        text_content, html_content = otp_email.render(otp_code)
         
         # Create email
         email_message = EmailMultiAlternatives(
@@ -36,12 +32,14 @@ def send_otp_email(email, otp_code):
         # Attach HTML content
         email_message.attach_alternative(html_content, "text/html")
         
-        # Send email
-        email_message.send()
+        # Send email on a pooled connection
+        get_mail_pool().send(email_message)
+        emails_sent.inc(template='otp')
         logger.info(f"OTP email sent to {email}")
         return True
         
     except Exception as e:
+        email_failures.inc(template='otp')
         logger.error(f"Error sending OTP email to {email}: {str(e)}")
         # For debugging purposes, print the OTP to console in development
         if settings.DEBUG:
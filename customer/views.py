@@ -1,12 +1,18 @@
-from rest_framework import status, views, generics, permissions
+from rest_framework import status, views, generics
 from rest_framework.response import Response
-from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
+from rest_framework.permissions import AllowAny
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.core.mail import send_mail
 from django.conf import settings
 from django.utils import timezone
 from django.contrib.auth import get_user_model
-from .models import Customer, Staff, UserRole
+from django.db import IntegrityError, transaction
+from .models import ArchivedCustomer, Customer, Staff, UserRole
+from .permissions import IsAdminUser, IsAuthenticated, IsManagerUser, IsNotApiKey
+from . import audit, metrics, webhooks
+from .archive import rehydrate_customer
+from .idempotency import IdempotentMixin
+from .authentication import invalidate_credentials
 from .serializers import (
     CustomerSerializer, 
     CustomerLoginSerializer, 
@@ -17,27 +23,12 @@ from .serializers import (
     UserRoleSerializer,
     ForgetPasswordSerializer,
     ResetPasswordSerializer,
-    UserSerializer
+    UserSerializer,
+    duplicate_email_errors,
 )
 
 User = get_user_model()
 
-class IsStaffUser(permissions.BasePermission):
-    def has_permission(self, request, view):
-        return request.user and request.user.is_staff
-
-class IsAdminUser(permissions.BasePermission):
-    def has_permission(self, request, view):
-        return request.user and request.user.is_admin
-
-class IsManagerUser(permissions.BasePermission):
-    def has_permission(self, request, view):
-        return request.user and request.user.is_manager
-
-class IsCashierUser(permissions.BasePermission):
-    def has_permission(self, request, view):
-        return request.user and request.user.is_cashier
-
 class AuthView(views.APIView):
     permission_classes = [AllowAny]
 
@@ -56,7 +47,7 @@ class AuthView(views.APIView):
             }
         })
 
-class ForgetPasswordView(views.APIView):
+class ForgetPasswordView(IdempotentMixin, views.APIView):
     permission_classes = [AllowAny]
     
     def post(self, request):
@@ -69,7 +60,12 @@ class ForgetPasswordView(views.APIView):
             user_model = Staff if user_type == 'staff' else Customer
             
             try:
-                user = user_model.objects.get(email=email)
+                user = user_model.objects.get_by_email(email)
+            except user_model.DoesNotExist:
+                # An archived customer gets the OTP on the archived row; it moves back on reset
+                user = ArchivedCustomer.objects.with_email(email).first() if user_model is Customer else None
+            
+            if user is not None:
                 # Generate and send OTP
                 otp = user.generate_otp()
                 
@@ -83,14 +79,13 @@ class ForgetPasswordView(views.APIView):
                     'otp_sent': True
                 }, status=status.HTTP_200_OK)
                 
-            except user_model.DoesNotExist:
-                # For security, don't reveal if the email exists or not
-                return Response({
-                    'message': 'If an account exists with this email, an OTP has been sent',
-                    'email': email,
-                    'otp_sent': False
-                }, status=status.HTTP_200_OK)
-                
+            # For security, don't reveal if the email exists or not
+            return Response({
+                'message': 'If an account exists with this email, an OTP has been sent',
+                'email': email,
+                'otp_sent': False
+            }, status=status.HTTP_200_OK)
+            
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 class ResetPasswordView(views.APIView):
@@ -108,8 +103,16 @@ class ResetPasswordView(views.APIView):
             user_model = Staff if user_type == 'staff' else Customer
             
             try:
-                user = user_model.objects.get(email=email)
-                if not user.is_otp_valid(otp):
+                try:
+                    user = user_model.objects.select_related('role').get_by_email(email)
+                    otp_valid = user.is_otp_valid(otp)
+                except user_model.DoesNotExist:
+                    if user_model is not Customer or not ArchivedCustomer.objects.with_email(email).exists():
+                        raise
+                    # The OTP was issued on the archived row, which only moves back once it matches
+                    user = rehydrate_customer(email, verify=lambda archived: archived.is_otp_valid(otp))
+                    otp_valid = user is not None
+                if not otp_valid:
                     return Response({
                         'error': 'Invalid or expired OTP'
                     }, status=status.HTTP_400_BAD_REQUEST)
@@ -118,6 +121,8 @@ class ResetPasswordView(views.APIView):
                 user.set_password(password)
                 user.clear_otp()
                 user.save()
+                invalidate_credentials(user)
+                webhooks.emit('user.password_reset', webhooks.user_payload(user))
                 return Response({
                     'message': 'Password reset successfully'
                 }, status=status.HTTP_200_OK)
@@ -161,17 +166,30 @@ class CustomerLoginView(views.APIView):
             password = serializer.validated_data['password']
             
             try:
-                user = Customer.objects.get(email=email)
-                if not user.check_password(password):
+                try:
+                    user = Customer.objects.get_by_email(email)
+                    password_valid = user.check_password(password)
+                except Customer.DoesNotExist:
+                    # Only an active customer with the right password is moved back, hashing once
+                    user = rehydrate_customer(
+                        email, verify=lambda archived: archived.is_active and archived.check_password(password)
+                    )
+                    if user is None:
+                        raise
+                    password_valid = True
+                if not password_valid:
+                    metrics.auth_attempts.inc(mechanism='customer_login', outcome='invalid_credentials')
                     return Response({"error": "Invalid credentials"}, status=status.HTTP_401_UNAUTHORIZED)
                 
                 if not user.is_active:
+                    metrics.auth_attempts.inc(mechanism='customer_login', outcome='inactive')
                     return Response({"error": "Account is not active"}, status=status.HTTP_401_UNAUTHORIZED)
                 
                 # Generate tokens
                 refresh = RefreshToken.for_user(user)
                 user.last_login = timezone.now()
                 user.save()
+                metrics.auth_attempts.inc(mechanism='customer_login', outcome='success')
                 
                 return Response({
                     'refresh': str(refresh),
@@ -180,30 +198,53 @@ class CustomerLoginView(views.APIView):
                 })
                 
             except Customer.DoesNotExist:
+                metrics.auth_attempts.inc(mechanism='customer_login', outcome='unknown_user')
                 return Response({"error": "Invalid credentials"}, status=status.HTTP_401_UNAUTHORIZED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-class CustomerRegisterView(views.APIView):
+class CustomerRegisterView(IdempotentMixin, views.APIView):
     permission_classes = [AllowAny]
+    replay_redacted_fields = ('refresh', 'access')
+    
+    @classmethod
+    def reissue_replay(cls, data):
+        # Tokens aren't kept with the stored response; a replay gets new ones
+        user = Customer.objects.filter(pk=data['user']['id'], is_active=True).first()
+        if user is None:
+            return None
+        refresh = RefreshToken.for_user(user)
+        return {'refresh': str(refresh), 'access': str(refresh.access_token), **data}
     
     def post(self, request):
         serializer = CustomerRegisterSerializer(data=request.data)
-        if serializer.is_valid():
-            user = serializer.save()
-            
-            # Generate tokens
-            refresh = RefreshToken.for_user(user)
-            
-            return Response({
-                'refresh': str(refresh),
-                'access': str(refresh.access_token),
-                'user': CustomerSerializer(user).data
-            }, status=status.HTTP_201_CREATED)
+        if not serializer.is_valid():
+            return self.registration_failed(serializer.errors)
+        
+        try:
+            # The user, its webhook events and its outstanding token commit together
+            with transaction.atomic():
+                user = serializer.save()
+                webhooks.emit('customer.registered', webhooks.user_payload(user))
+                refresh = RefreshToken.for_user(user)
+        except IntegrityError:
+            # Duplicates are caught by the unique index instead of a SELECT up front
+            email = User.objects.normalize_email(serializer.validated_data['email'])
+            if not User.objects.with_email(email).exists():
+                raise
+            return self.registration_failed(duplicate_email_errors())
+        
+        return Response({
+            'refresh': str(refresh),
+            'access': str(refresh.access_token),
+            'user': CustomerSerializer(user).data
+        }, status=status.HTTP_201_CREATED)
+    
+    def registration_failed(self, errors):
         return Response({
             'status': 'error',
             'code': status.HTTP_400_BAD_REQUEST,
             'message': 'Registration failed',
-            'errors': serializer.errors,
+            'errors': errors,
             'timestamp': timezone.now().isoformat()
         }, status=status.HTTP_400_BAD_REQUEST)
 
@@ -218,17 +259,20 @@ class StaffLoginView(views.APIView):
             password = serializer.validated_data['password']
             
             try:
-                user = Staff.objects.get(email=email)
+                user = Staff.objects.select_related('role').get_by_email(email)
                 if not user.check_password(password):
+                    metrics.auth_attempts.inc(mechanism='staff_login', outcome='invalid_credentials')
                     return Response({"error": "Invalid credentials"}, status=status.HTTP_401_UNAUTHORIZED)
                 
                 if not user.is_active:
+                    metrics.auth_attempts.inc(mechanism='staff_login', outcome='inactive')
                     return Response({"error": "Account is not active"}, status=status.HTTP_401_UNAUTHORIZED)
                 
                 # Generate tokens
                 refresh = RefreshToken.for_user(user)
                 user.last_login = timezone.now()
                 user.save()
+                metrics.auth_attempts.inc(mechanism='staff_login', outcome='success')
                 
                 return Response({
                     'refresh': str(refresh),
@@ -237,6 +281,7 @@ class StaffLoginView(views.APIView):
                 })
                 
             except Staff.DoesNotExist:
+                metrics.auth_attempts.inc(mechanism='staff_login', outcome='unknown_user')
                 return Response({"error": "Invalid credentials"}, status=status.HTTP_401_UNAUTHORIZED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -270,12 +315,27 @@ class StaffDetailView(generics.RetrieveUpdateDestroyAPIView):
 
 # Role Management Views
 class UserRoleListView(generics.ListCreateAPIView):
-    permission_classes = [IsAdminUser]
+    # Roles define what key scopes mean, so keys can't manage them
+    permission_classes = [IsAdminUser, IsNotApiKey]
     queryset = UserRole.objects.all()
     serializer_class = UserRoleSerializer
 
 class UserRoleDetailView(generics.RetrieveUpdateDestroyAPIView):
-    permission_classes = [IsAdminUser]
+    permission_classes = [IsAdminUser, IsNotApiKey]
     queryset = UserRole.objects.all()
     serializer_class = UserRoleSerializer
     lookup_field = 'id'
+    
+    def perform_update(self, serializer):
+        before = audit.snapshot(serializer.instance, serializer.validated_data)
+        instance = serializer.save()
+        after = audit.snapshot(instance, serializer.validated_data)
+        audit.record('role.update', self.request.user, instance, {
+            field: [before[field], after[field]] for field in after if before[field] != after[field]
+        })
+    
+    def perform_destroy(self, instance):
+        # The event is queued only if the delete commits
+        with transaction.atomic():
+            audit.record('role.delete', self.request.user, instance, {'role': instance.role})
+            super().perform_destroy(instance)
@@ -0,0 +1,46 @@
+from django.utils import timezone
+from rest_framework import generics, status
+from rest_framework.response import Response
+
+from .authentication import api_key_cache
+from .models import ApiKey
+from .permissions import IsAuthenticated, IsNotApiKey, IsStaffUser
+from .serializers import ApiKeySerializer
+
+
+class ApiKeyListView(generics.ListCreateAPIView):
+    """
+    View for listing and creating the current user's API keys.
+    The raw key is only returned once, in the create response.
+    """
+    serializer_class = ApiKeySerializer
+    permission_classes = [IsAuthenticated, IsStaffUser, IsNotApiKey]
+
+    def get_queryset(self):
+        return ApiKey.objects.filter(user=self.request.user).order_by('-created_at')
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        api_key, raw_key = ApiKey.generate(user=request.user, **serializer.validated_data)
+        return Response(
+            {**ApiKeySerializer(api_key).data, 'key': raw_key},
+            status=status.HTTP_201_CREATED,
+        )
+
+
+class ApiKeyRevokeView(generics.DestroyAPIView):
+    """
+    View for revoking one of the current user's API keys.
+    """
+    serializer_class = ApiKeySerializer
+    permission_classes = [IsAuthenticated, IsStaffUser, IsNotApiKey]
+    lookup_field = 'id'
+
+    def get_queryset(self):
+        return ApiKey.objects.filter(user=self.request.user, revoked_at__isnull=True)
+
+    def perform_destroy(self, instance):
+        instance.revoked_at = timezone.now()
+        instance.save(update_fields=['revoked_at'])
+        api_key_cache.delete(instance.prefix)
@@ -0,0 +1,15 @@
+from django.http import Http404, HttpResponse
+
+from .metrics import get_config, registry, render
+
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint, summed over every worker in multiprocess mode.
+    Only served to ALLOWED_IPS; everyone else gets a 404.
+    """
+    config = get_config()
+    if request.META.get('REMOTE_ADDR') not in config['ALLOWED_IPS']:
+        raise Http404
+    families = registry.collect(config['MULTIPROCESS_DIR'])
+    return HttpResponse(render(families), content_type='text/plain; version=0.0.4; charset=utf-8')
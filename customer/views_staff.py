@@ -1,16 +1,42 @@
 from rest_framework import status, generics
+from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
 from .models import UserRole
-from .serializers import StaffRegisterSerializer, StaffSerializer
-from .permissions import IsSuperUser, IsAdminUser, IsManagerUser, CanCreateStaff
+from .serializers import (
+    StaffBatchLookupSerializer, StaffBulkCreateSerializer, StaffBulkIdsSerializer, StaffBulkRoleSerializer,
+    StaffBulkStatusSerializer, StaffRegisterSerializer, StaffSerializer, duplicate_email_errors,
+)
+from .permissions import (
+    IsAuthenticated, IsSuperUser, IsAdminUser, IsManagerUser, IsNotApiKey, IsStaffUser, CanCreateStaff,
+)
+from .authorization import get_auth_context, request_action
+from .idempotency import IdempotentMixin
+from .profiling import get_config as get_profiling_config, make_profile_token
+from . import audit, staff_bulk
 
 User = get_user_model()
 
-class StaffRegisterView(APIView):
+class StaffScopeMixin:
+    """
+    Restricts staff querysets to the users the requester may manage, and for
+    API keys to the roles their scopes cover for the request's action.
+    """
+    def get_queryset(self):
+        staff = User.objects.filter(is_staff=True).select_related('role')
+        roles = get_auth_context(self.request).scoped_roles(request_action(self.request, self))
+        if roles is not None:
+            staff = staff.filter(role__role__in=roles)
+        # Managers can only see staff below them in the hierarchy
+        if get_auth_context(self.request).role == 'manager':
+            return staff.subtree_of(self.request.user)
+        # Admins can see all staff except superusers
+        return staff.exclude(is_superuser=True)
+
+class StaffRegisterView(IdempotentMixin, APIView):
     """
     View for registering new staff members.
     Only authenticated users with proper permissions can create staff members.
@@ -24,7 +50,17 @@ class StaffRegisterView(APIView):
         )
         
         if serializer.is_valid():
-            staff_user = serializer.save()
+            try:
+                with transaction.atomic():
+                    staff_user = serializer.save()
+            except IntegrityError:
+                if not User.objects.with_email(serializer.validated_data['email']).exists():
+                    raise
+                return Response(duplicate_email_errors(), status=status.HTTP_400_BAD_REQUEST)
+            audit.record('staff.create', request.user, staff_user, {
+                'email': staff_user.email,
+                'role': staff_user.role,
+            })
             return Response(
                 {
                     'message': 'Staff user created successfully',
@@ -34,7 +70,7 @@ class StaffRegisterView(APIView):
             )
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-class StaffListView(generics.ListAPIView):
+class StaffListView(StaffScopeMixin, generics.ListAPIView):
     """
     View for listing all staff members.
     Accessible by admin and manager users.
@@ -42,17 +78,8 @@ class StaffListView(generics.ListAPIView):
     serializer_class = StaffSerializer
     permission_classes = [IsAuthenticated, (IsAdminUser | IsManagerUser)]
     
-    def get_queryset(self):
-        # Managers can only see cashiers they created
-        if self.request.user.role and self.request.user.role.role == 'manager':
-            return User.objects.filter(
-                is_staff=True,
-                created_by=self.request.user
-            )
-        # Admins can see all staff except superusers
-        return User.objects.filter(is_staff=True).exclude(is_superuser=True)
 
-class StaffDetailView(generics.RetrieveUpdateDestroyAPIView):
+class StaffDetailView(StaffScopeMixin, generics.RetrieveUpdateDestroyAPIView):
     """
     View for retrieving, updating, or deleting a staff member.
     """
@@ -61,24 +88,184 @@ class StaffDetailView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [IsAuthenticated, (IsAdminUser | IsManagerUser)]
     lookup_field = 'id'
     
-    def get_queryset(self):
-        # Managers can only manage cashiers they created
-        if self.request.user.role and self.request.user.role.role == 'manager':
-            return User.objects.filter(
-                is_staff=True,
-                created_by=self.request.user
-            )
-        # Admins can manage all staff except superusers
-        return User.objects.filter(is_staff=True).exclude(is_superuser=True)
     
     def destroy(self, request, *args, **kwargs):
         # Only allow admins to delete staff members
-        if not (request.user.is_superuser or request.user.role.role == 'admin'):
+        context = get_auth_context(request)
+        if not (context.is_superuser or context.role == 'admin'):
             return Response(
                 {'error': 'You do not have permission to perform this action'},
                 status=status.HTTP_403_FORBIDDEN
             )
         return super().destroy(request, *args, **kwargs)
+    
+    def perform_update(self, serializer):
+        before = audit.snapshot(serializer.instance, serializer.validated_data)
+        instance = serializer.save()
+        after = audit.snapshot(instance, serializer.validated_data)
+        audit.record('staff.update', self.request.user, instance, {
+            field: [before[field], after[field]] for field in after if before[field] != after[field]
+        })
+    
+    def perform_destroy(self, instance):
+        # The event is queued only if the delete commits
+        with transaction.atomic():
+            audit.record('staff.delete', self.request.user, instance, {'email': instance.email})
+            super().perform_destroy(instance)
+
+class StaffBatchView(StaffScopeMixin, generics.GenericAPIView):
+    """
+    View for retrieving many staff members at once, by id or by email.
+    One query for the whole batch, with the same scoping as StaffDetailView;
+    users that don't exist or are out of scope are returned as null.
+    """
+    serializer_class = StaffSerializer
+    permission_classes = [IsAuthenticated, (IsAdminUser | IsManagerUser)]
+    
+    def get(self, request):
+        lookup = StaffBatchLookupSerializer(data=request.query_params)
+        lookup.is_valid(raise_exception=True)
+        if lookup.validated_data.get('ids'):
+            keys = list(dict.fromkeys(lookup.validated_data['ids']))
+            found = self.get_queryset().in_bulk(keys)
+            normalize = int
+        else:
+            keys = list(dict.fromkeys(lookup.validated_data['emails']))
+            # Emails match case-insensitively, like logins
+            found = {user.email.lower(): user for user in self.get_queryset().with_emails(keys)}
+            normalize = str.lower
+        
+        return Response({
+            'results': {
+                str(key): self.get_serializer(found[normalize(key)]).data if normalize(key) in found else None
+                for key in keys
+            },
+            'not_found': [key for key in keys if normalize(key) not in found],
+        })
+
+class StaffBulkMixin(StaffScopeMixin):
+    """
+    Validates a bulk request and reports one result per item (see staff_bulk).
+    200/201 when every item was applied, 207 when only some were, 400 when none.
+    """
+    serializer_class = StaffSerializer
+    success_status = status.HTTP_200_OK
+    
+    def bulk_response(self, result):
+        if not result.failed:
+            code = self.success_status
+        elif result.applied:
+            code = status.HTTP_207_MULTI_STATUS
+        else:
+            code = status.HTTP_400_BAD_REQUEST
+        return Response({
+            'results': [
+                {
+                    'index': item.index,
+                    'id': item.id,
+                    'status': item.status,
+                    **({'errors': item.errors} if item.errors else {}),
+                    **({'user': self.get_serializer(item.user).data} if item.user and item.status != 'error' else {}),
+                }
+                for item in result.items
+            ],
+            'applied': result.applied,
+            'failed': result.failed,
+        }, status=code)
+
+class StaffBulkCreateView(IdempotentMixin, StaffBulkMixin, generics.GenericAPIView):
+    """
+    View for creating many staff members at once, all reporting to the requester.
+    """
+    permission_classes = [IsAuthenticated, (IsSuperUser | IsAdminUser | IsManagerUser)]
+    success_status = status.HTTP_201_CREATED
+    
+    def post(self, request):
+        serializer = StaffBulkCreateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return self.bulk_response(staff_bulk.create_staff(
+            request.user, get_auth_context(request),
+            serializer.validated_data['users'], serializer.validated_data['atomic'],
+        ))
+
+class StaffBulkStatusView(StaffBulkMixin, generics.GenericAPIView):
+    """
+    View for activating or deactivating many staff members at once.
+    """
+    permission_classes = [IsAuthenticated, (IsAdminUser | IsManagerUser)]
+    scope_action = 'change'
+    
+    def post(self, request):
+        serializer = StaffBulkStatusSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return self.bulk_response(staff_bulk.set_active(
+            request.user, self.get_queryset(), serializer.validated_data['ids'],
+            serializer.validated_data['is_active'], serializer.validated_data['atomic'],
+        ))
+
+class StaffBulkRoleView(StaffBulkMixin, generics.GenericAPIView):
+    """
+    View for moving many staff members to another role.
+    """
+    permission_classes = [IsAuthenticated, (IsAdminUser | IsManagerUser)]
+    scope_action = 'change'
+    
+    def post(self, request):
+        serializer = StaffBulkRoleSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        role = serializer.validated_data['role']
+        context = get_auth_context(request)
+        if not context.can_create(role.role):
+            return Response({
+                'role_id': [f"You can only assign these roles: {', '.join(context.creatable_roles)}"]
+            }, status=status.HTTP_400_BAD_REQUEST)
+        return self.bulk_response(staff_bulk.set_role(
+            request.user, self.get_queryset(), serializer.validated_data['ids'],
+            role, serializer.validated_data['atomic'],
+        ))
+
+class StaffBulkDeleteView(StaffBulkMixin, generics.GenericAPIView):
+    """
+    View for deleting many staff members at once. Admins only, as for single deletes.
+    """
+    permission_classes = [IsAuthenticated, (IsSuperUser | IsAdminUser)]
+    scope_action = 'delete'
+    
+    def post(self, request):
+        serializer = StaffBulkIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return self.bulk_response(staff_bulk.delete_staff(
+            request.user, self.get_queryset(), serializer.validated_data['ids'],
+            serializer.validated_data['atomic'],
+        ))
+
+class StaffSubtreeView(StaffScopeMixin, generics.ListAPIView):
+    """
+    View for listing every staff member below a user, at any depth.
+    """
+    serializer_class = StaffSerializer
+    permission_classes = [IsAuthenticated, (IsAdminUser | IsManagerUser)]
+    
+    def get_root(self):
+        if self.kwargs['id'] == self.request.user.pk:
+            return self.request.user
+        return get_object_or_404(super().get_queryset(), id=self.kwargs['id'])
+    
+    def get_queryset(self):
+        return super().get_queryset().subtree_of(self.get_root()).order_by('hierarchy_path', 'id')
+
+class StaffAncestorsView(StaffScopeMixin, generics.ListAPIView):
+    """
+    View for listing the creator chain of a staff member, root first.
+    """
+    serializer_class = StaffSerializer
+    permission_classes = [IsAuthenticated, (IsAdminUser | IsManagerUser)]
+    
+    def get_queryset(self):
+        scope = super().get_queryset()
+        user = get_object_or_404(scope, id=self.kwargs['id'])
+        # Only the part of the chain the requester may see, e.g. not a manager's own admins
+        return scope.ancestors_of(user)
 
 class RoleListView(APIView):
     """
@@ -87,15 +274,26 @@ class RoleListView(APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
-        if request.user.is_superuser:
-            roles = UserRole.objects.all()
-        elif request.user.role:
-            allowed_roles = UserRole.ROLE_HIERARCHY.get(request.user.role.role, [])
-            roles = UserRole.objects.filter(role__in=allowed_roles)
-        else:
-            roles = UserRole.objects.none()
-            
+        context = get_auth_context(request)
+        roles = sorted(UserRole.cached_by_id().values(), key=lambda role: role.pk)
+        if not context.is_superuser:
+            roles = [role for role in roles if context.role and role.role in context.creatable_roles]
+
         return Response([
             {'id': role.id, 'role': role.role, 'description': role.description}
             for role in roles
         ])
+
+class ProfileTokenView(APIView):
+    """
+    View for issuing a signed X-Profile header value.
+    Requests carrying it are profiled by ProfilingMiddleware.
+    """
+    permission_classes = [IsAuthenticated, IsStaffUser, IsNotApiKey]
+    
+    def post(self, request):
+        return Response({
+            'header': 'X-Profile',
+            'token': make_profile_token(request.user),
+            'expires_in': get_profiling_config()['TOKEN_MAX_AGE'],
+        }, status=status.HTTP_201_CREATED)
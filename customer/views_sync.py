@@ -0,0 +1,119 @@
+import base64
+import binascii
+import json
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework import serializers, status
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from .authorization import get_auth_context
+from .models import User, UserDeletion
+from .permissions import IsAdminUser, IsAuthenticated, IsSuperUser
+from .serializers import UserSerializer
+
+
+class ChangeFeedUserSerializer(UserSerializer):
+    class Meta(UserSerializer.Meta):
+        fields = UserSerializer.Meta.fields + [
+            'is_staff', 'role', 'created_by', 'phone_number', 'address', 'updated_at'
+        ]
+
+
+class ChangeFeedUserDeletionSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(source='user_id')
+
+    class Meta:
+        model = UserDeletion
+        fields = ['id', 'user_type', 'deleted_at']
+
+
+def encode_cursor(position):
+    raw = json.dumps(position, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Cursor positions are {"c": [updated_at, id], "d": [deleted_at, id]}; a
+    missing stream starts from the beginning.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        position = json.loads(raw)
+        return {
+            stream: (datetime.fromisoformat(position[stream][0]), int(position[stream][1]))
+            for stream in ('c', 'd') if stream in position
+        }
+    except (binascii.Error, ValueError, TypeError, KeyError, IndexError):
+        raise serializers.ValidationError({'cursor': 'Invalid cursor'})
+
+
+def after(queryset, field, position):
+    """Rows strictly after (timestamp, id) in (field, id) order"""
+    if position is None:
+        return queryset
+    moment, pk = position
+    return queryset.filter(Q(**{f'{field}__gt': moment}) | Q(**{field: moment, 'id__gt': pk}))
+
+
+class ChangeFeedView(APIView):
+    """
+    Incremental feed of users created, updated or deleted since a cursor.
+
+    Rows are read in (updated_at, id) order from the matching index and
+    deletions from the UserDeletion tombstones. Rows newer than
+    CHANGE_FEED_SETTLE_SECONDS are held back so a transaction that commits
+    late with an older timestamp is not skipped.
+    """
+    permission_classes = [IsAuthenticated, (IsAdminUser | IsSuperUser)]
+    default_page_size = 100
+    max_page_size = 1000
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get('limit', self.default_page_size))
+        except ValueError:
+            size = self.default_page_size
+        return max(1, min(size, self.max_page_size))
+
+    def get(self, request):
+        cursor = request.query_params.get('cursor')
+        position = decode_cursor(cursor) if cursor else {}
+        limit = self.get_page_size(request)
+        settled = timezone.now() - timedelta(seconds=getattr(settings, 'CHANGE_FEED_SETTLE_SECONDS', 2))
+
+        users = User.objects.filter(updated_at__lt=settled)
+        deletions = UserDeletion.objects.filter(deleted_at__lt=settled)
+        roles = get_auth_context(request).scoped_roles('view')
+        if roles is not None:
+            # API keys only see staff of the roles their scopes cover
+            users = users.filter(role__role__in=roles)
+            deletions = deletions.filter(user_type='staff')
+        user_type = request.query_params.get('user_type')
+        if user_type:
+            users = users.filter(user_type=user_type)
+            deletions = deletions.filter(user_type=user_type)
+
+        changes = list(after(users, 'updated_at', position.get('c')).order_by('updated_at', 'id')[:limit + 1])
+        removed = list(after(deletions, 'deleted_at', position.get('d')).order_by('deleted_at', 'id')[:limit + 1])
+        has_more = len(changes) > limit or len(removed) > limit
+        changes, removed = changes[:limit], removed[:limit]
+
+        next_position = {
+            stream: [value.isoformat(), pk] for stream, (value, pk) in position.items()
+        }
+        if changes:
+            next_position['c'] = [changes[-1].updated_at.isoformat(), changes[-1].pk]
+        if removed:
+            next_position['d'] = [removed[-1].deleted_at.isoformat(), removed[-1].pk]
+
+        return Response({
+            'changes': ChangeFeedUserSerializer(changes, many=True).data,
+            'deletions': ChangeFeedUserDeletionSerializer(removed, many=True).data,
+            'next_cursor': encode_cursor(next_position),
+            'has_more': has_more,
+        }, status=status.HTTP_200_OK)
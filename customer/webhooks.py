@@ -0,0 +1,296 @@
+"""
+Webhook delivery of user lifecycle events through a transactional outbox.
+
+``emit()`` writes an ``OutboxEvent`` and one ``WebhookDelivery`` per
+subscribed endpoint in the caller's transaction, so an event exists exactly
+when the change it describes was committed. ``WebhookDispatcher`` (run by
+``manage.py dispatch_webhooks``) claims due deliveries in batches, POSTs them
+to each endpoint as one JSON document over pooled keep-alive connections and
+reschedules failures with exponential backoff. A per-endpoint circuit breaker
+stops hammering endpoints that keep failing.
+
+Settings (``WEBHOOKS``):
+    ENDPOINTS          [{'url': ..., 'events': ['*'] or [...], 'secret': ...}]
+    BATCH_SIZE         events per POST
+    CONCURRENCY        endpoints delivered to in parallel
+    TIMEOUT            socket timeout in seconds
+    MAX_ATTEMPTS       attempts before a delivery is marked failed
+    BACKOFF_BASE       first retry delay in seconds, doubled on every attempt
+    BACKOFF_MAX        upper bound of the retry delay
+    FAILURE_THRESHOLD  consecutive failures that open an endpoint's breaker
+    RESET_TIMEOUT      seconds an open breaker waits before a trial request
+"""
+import hashlib
+import hmac
+import http.client
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OutboxEvent, WebhookDelivery
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENDPOINTS': [],
+    'BATCH_SIZE': 100,
+    'CONCURRENCY': 4,
+    'TIMEOUT': 5.0,
+    'MAX_ATTEMPTS': 8,
+    'BACKOFF_BASE': 5.0,
+    'BACKOFF_MAX': 3600.0,
+    'FAILURE_THRESHOLD': 5,
+    'RESET_TIMEOUT': 60.0,
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'WEBHOOKS', {})}
+
+
+def subscribed_endpoints(event_type):
+    return [
+        endpoint for endpoint in get_config()['ENDPOINTS']
+        if '*' in endpoint.get('events', ['*']) or event_type in endpoint.get('events', [])
+    ]
+
+
+def user_payload(user):
+    return {
+        'id': user.pk,
+        'email': user.email,
+        'name': user.name,
+        'user_type': user.user_type,
+        'is_active': user.is_active,
+        'role': user.role.role if user.role_id else None,
+        'created_by': user.created_by_id,
+    }
+
+
+def emit(event_type, payload):
+    """
+    Record an event for every endpoint subscribed to it.
+    Costs nothing when no endpoint is subscribed.
+    """
+    endpoints = subscribed_endpoints(event_type)
+    if not endpoints:
+        return None
+
+    with transaction.atomic():
+        event = OutboxEvent.objects.create(event_type=event_type, payload=payload)
+        WebhookDelivery.objects.bulk_create([
+            WebhookDelivery(event=event, endpoint=endpoint['url']) for endpoint in endpoints
+        ])
+    return event
+
+
+def emit_many(event_type, payloads):
+    """emit() for many payloads of one event type, in two INSERTs"""
+    endpoints = subscribed_endpoints(event_type)
+    if not endpoints or not payloads:
+        return []
+
+    with transaction.atomic():
+        events = OutboxEvent.objects.bulk_create([
+            OutboxEvent(event_type=event_type, payload=payload) for payload in payloads
+        ])
+        WebhookDelivery.objects.bulk_create([
+            WebhookDelivery(event=event, endpoint=endpoint['url']) for event in events for endpoint in endpoints
+        ])
+    return events
+
+
+class CircuitBreaker:
+    """Closed -> open after N consecutive failures -> half-open after a timeout"""
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow_request(self):
+        return self.state != 'open'
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold or self.state == 'half-open':
+            self.opened_at = time.monotonic()
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections per host, shared by the sender threads"""
+
+    def __init__(self, timeout, max_idle=4):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _idle_for(self, key):
+        with self._lock:
+            return self._idle.setdefault(key, queue.LifoQueue(self.max_idle))
+
+    def request(self, url, body, headers):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        idle = self._idle_for(key)
+        try:
+            conn = idle.get_nowait()
+        except queue.Empty:
+            conn_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+            conn = conn_class(parts.hostname, parts.port, timeout=self.timeout)
+
+        path = parts.path or '/'
+        if parts.query:
+            path = f'{path}?{parts.query}'
+        try:
+            conn.request('POST', path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+        except Exception:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            try:
+                idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+        return response.status
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                while not idle.empty():
+                    idle.get_nowait().close()
+            self._idle.clear()
+
+
+class WebhookDispatcher:
+    def __init__(self, config=None):
+        self.config = config or get_config()
+        self.endpoints = {endpoint['url']: endpoint for endpoint in self.config['ENDPOINTS']}
+        self.breakers = {}
+        self.pool = ConnectionPool(self.config['TIMEOUT'], max_idle=self.config['CONCURRENCY'])
+        self.executor = ThreadPoolExecutor(self.config['CONCURRENCY'], thread_name_prefix='webhook')
+
+    def breaker_for(self, url):
+        if url not in self.breakers:
+            self.breakers[url] = CircuitBreaker(self.config['FAILURE_THRESHOLD'], self.config['RESET_TIMEOUT'])
+        return self.breakers[url]
+
+    def claim(self, limit):
+        """
+        Lease up to ``limit`` due deliveries so concurrent dispatchers skip them.
+        A crashed dispatcher's lease simply expires and the rows become due again.
+        """
+        now = timezone.now()
+        due = WebhookDelivery.objects.filter(status='pending', next_attempt_at__lte=now).order_by('next_attempt_at')
+        with transaction.atomic():
+            if connection.features.has_select_for_update_skip_locked:
+                due = due.select_for_update(skip_locked=True)
+            ids = list(due.values_list('pk', flat=True)[:limit])
+            lease = now + timedelta(seconds=self.config['TIMEOUT'] * 3)
+            WebhookDelivery.objects.filter(pk__in=ids).update(next_attempt_at=lease)
+        return list(WebhookDelivery.objects.filter(pk__in=ids).select_related('event').order_by('event_id'))
+
+    def send(self, url, deliveries):
+        body = json.dumps({
+            'events': [
+                {
+                    'id': delivery.event_id,
+                    'type': delivery.event.event_type,
+                    'created_at': delivery.event.created_at,
+                    'data': delivery.event.payload,
+                }
+                for delivery in deliveries
+            ]
+        }, cls=DjangoJSONEncoder).encode()
+        headers = {'Content-Type': 'application/json'}
+        secret = self.endpoints.get(url, {}).get('secret')
+        if secret:
+            headers['X-Webhook-Signature'] = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+        status_code = self.pool.request(url, body, headers)
+        if not 200 <= status_code < 300:
+            raise RuntimeError(f'HTTP {status_code}')
+
+    def retry_delay(self, attempts):
+        delay = min(self.config['BACKOFF_BASE'] * 2 ** (attempts - 1), self.config['BACKOFF_MAX'])
+        return delay * random.uniform(0.8, 1.2)
+
+    def run_once(self):
+        """Deliver one round of due events; returns (delivered, failed) counts"""
+        deliveries = self.claim(self.config['BATCH_SIZE'] * max(len(self.endpoints), 1))
+        by_endpoint = {}
+        for delivery in deliveries:
+            by_endpoint.setdefault(delivery.endpoint, []).append(delivery)
+
+        futures = {}
+        for url, pending in by_endpoint.items():
+            if not self.breaker_for(url).allow_request():
+                self.reschedule(pending, 'Circuit breaker open', count_attempt=False)
+                continue
+            for start in range(0, len(pending), self.config['BATCH_SIZE']):
+                batch = pending[start:start + self.config['BATCH_SIZE']]
+                futures[self.executor.submit(self.send, url, batch)] = (url, batch)
+
+        delivered = failed = 0
+        for future, (url, batch) in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning(f"Webhook delivery of {len(batch)} events to {url} failed: {e}")
+                self.breaker_for(url).record_failure()
+                self.reschedule(batch, str(e))
+                failed += len(batch)
+            else:
+                self.breaker_for(url).record_success()
+                WebhookDelivery.objects.filter(pk__in=[d.pk for d in batch]).update(
+                    status='delivered', delivered_at=timezone.now(), attempts=F('attempts') + 1, last_error=''
+                )
+                delivered += len(batch)
+        return delivered, failed
+
+    def reschedule(self, deliveries, error, count_attempt=True):
+        now = timezone.now()
+        for delivery in deliveries:
+            attempts = delivery.attempts + (1 if count_attempt else 0)
+            exhausted = attempts >= self.config['MAX_ATTEMPTS']
+            WebhookDelivery.objects.filter(pk=delivery.pk).update(
+                attempts=attempts,
+                status='failed' if exhausted else 'pending',
+                next_attempt_at=now + timedelta(seconds=self.retry_delay(max(attempts, 1))),
+                last_error=error,
+            )
+
+    def close(self):
+        self.executor.shutdown()
+        self.pool.close()